@@ -0,0 +1,74 @@
+function ObjCounts = ObjByFilterSeries(Image, Filter, ObjThrs, limQuant, RescaleThr, ObjIntensityThr, closeHoles, ObjSizeThr, DetectionBias, CheckThresholds)
+% OBJBYFILTERSERIES Number of objects detected by cpsub.ObjByFilter for
+% every threshold in ObjThrs, computed in a single call.
+%
+% Rescaling and filtering do not depend on the threshold, so they are done
+% once by cpsub.ObjByFilter (its third output is the filtered image). The
+% filtered image is then thresholded, hole-filled and labelled for each
+% threshold. If an intensity or size filter on the objects is requested,
+% cpsub.ObjByFilter is called for every threshold instead.
+%
+% No pixel exceeds a threshold at or above the maximum of the filtered
+% image, so the count of such thresholds is zero and they are not
+% labelled. The optional CheckThresholds (default 0) calls
+% cpsub.ObjByFilter on its own for up to that many thresholds spread over
+% the series and raises an error if a count differs.
+%
+% ObjCounts is a row vector with one object count per threshold.
+
+if nargin < 10
+    CheckThresholds = 0;
+end
+
+ObjThrs = double(ObjThrs(:)');
+ObjCounts = zeros(1, numel(ObjThrs));
+if isempty(ObjThrs)
+    return
+end
+
+if ~isempty(ObjIntensityThr) || ~isempty(ObjSizeThr) || ~isempty(DetectionBias)
+    for i = 1:numel(ObjThrs)
+        ObjCounts(i) = cpsub.ObjByFilter(Image, Filter, ObjThrs(i), ...
+            limQuant, RescaleThr, ObjIntensityThr, closeHoles, ...
+            ObjSizeThr, DetectionBias);
+    end
+    return
+end
+
+[~, ~, FiltImage] = cpsub.ObjByFilter(Image, Filter, ObjThrs(1), ...
+    limQuant, RescaleThr, ObjIntensityThr, closeHoles, ObjSizeThr, ...
+    DetectionBias);
+
+Skipped = ObjThrs >= max(FiltImage(:));
+for i = find(~Skipped)
+    ObjCounts(i) = countObjects(FiltImage, ObjThrs(i), closeHoles);
+end
+
+if CheckThresholds > 0
+    [~, Order] = sort(ObjThrs);
+    Sample = Order(unique(round(linspace(1, numel(Order), ...
+        min(CheckThresholds, numel(Order))))));
+    for i = Sample
+        NumObjects = cpsub.ObjByFilter(Image, Filter, ObjThrs(i), ...
+            limQuant, RescaleThr, ObjIntensityThr, closeHoles, ...
+            ObjSizeThr, DetectionBias);
+        if NumObjects ~= ObjCounts(i)
+            error('ObjByFilterSeries:countMismatch', ...
+                ['Threshold %g: the series counts %d objects, ' ...
+                 'cpsub.ObjByFilter gives %d.'], ...
+                ObjThrs(i), ObjCounts(i), NumObjects);
+        end
+    end
+end
+
+end
+
+
+function NumObjects = countObjects(FiltImage, ObjThr, closeHoles)
+ObjImage = FiltImage > ObjThr;
+if closeHoles
+    ObjImage = imfill(ObjImage, 'holes');
+end
+SegmentationCC = bwconncomp(ObjImage);
+NumObjects = SegmentationCC.NumObjects;
+end
@@ -3,6 +3,9 @@ import numpy as np
 import argparse
 import os
 import os.path
+import histogram_percentile
+import intermediates
+import site_queue
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -11,11 +14,26 @@ def parse_arguments():
     )
     parser.add_argument(
         '-i', '--input_files', type=str, nargs='+', required=True,
-        help='list of input files to be aggregated (.pkl)'
+        help='list of input files to be aggregated (.arrow)'
     )
     parser.add_argument(
-        '-o', '--output_file', type=str, default='aggregated_limits.pkl',
-        help='filename for output file (.pkl)'
+        '-o', '--output_file', type=str, default='aggregated_limits.arrow',
+        help='filename for output file (.arrow)'
+    )
+    parser.add_argument(
+        '--lower_percentile', type=float, default=1.0,
+        help=('percentile of the pooled intensities of all sites of a '
+              'control reported as pooled lower limit (default: 1.0)')
+    )
+    parser.add_argument(
+        '--upper_percentile', type=float, default=99.5,
+        help=('percentile of the pooled intensities of all sites of a '
+              'control reported as pooled upper limit (default: 99.5)')
+    )
+    parser.add_argument(
+        '--site_queue', type=str, default=None,
+        help=('also write the sites with their limits to this queue for '
+              'spot count jobs run with --site_queue (optional)')
     )
 
     return(parser.parse_args())
@@ -33,19 +51,42 @@ def main(args):
     rescaling_limits_list = []
     for index, filename in enumerate(args.input_files):
         rescaling_limits_list.append(
-            pd.read_pickle(filename)
+            intermediates.read_table(filename)
         )
     rescaling_limits = pd.concat(rescaling_limits_list)
 
     grouped = rescaling_limits.groupby('control')
-    columns = grouped['lower_limit', 'upper_limit']
+    columns = grouped[['lower_limit', 'upper_limit']]
     aggregated_limits = columns.agg([
         np.mean, np.min, np.max,
         percentile(10), percentile(40),
         percentile(60), percentile(80)
     ])
 
-    aggregated_limits.to_pickle(args.output_file)
+    # exact percentiles of all pixels of a control, from the summed
+    # histograms of its sites
+    if 'histogram' in rescaling_limits:
+        for control, sites in grouped:
+            offset, counts = histogram_percentile.pool(
+                zip(sites['histogram_offset'], sites['histogram'])
+            )
+            limits = histogram_percentile.percentiles(
+                offset, counts, [args.lower_percentile, args.upper_percentile]
+            )
+            for column, limit in zip(['lower_limit', 'upper_limit'], limits):
+                aggregated_limits.loc[control, (column, 'pooled')] = limit
+
+    intermediates.write_table(aggregated_limits, args.output_file)
+
+    if args.site_queue is not None:
+        site_queue.create(
+            args.site_queue,
+            rescaling_limits.drop(
+                [c for c in histogram_percentile.HISTOGRAM_COLUMNS
+                 if c in rescaling_limits],
+                axis=1
+            ).reset_index(drop=True)
+        )
 
     aggregated_limits['lower_limit'].to_csv(
         os.path.splitext(
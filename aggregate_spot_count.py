@@ -0,0 +1,78 @@
+import argparse
+
+import pyarrow as pa
+
+import intermediates
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='aggregate_spot_count',
+        description=('Concatenates the spot count tables of all batches '
+                     'into a single csv file.')
+    )
+    parser.add_argument(
+        '-i', '--input_files', type=str, nargs='+', required=True,
+        help='list of input files to be aggregated (.arrow)'
+    )
+    parser.add_argument(
+        '-o', '--output_file', type=str,
+        default='aggregated_spot_count.csv',
+        help='filename for output file (.csv)'
+    )
+    parser.add_argument(
+        '-c', '--columns', type=str, nargs='+', default=None,
+        help='columns to be kept (default: all)'
+    )
+
+    return(parser.parse_args())
+
+
+def check_schemas(filenames, columns=None):
+    '''
+    Raise a ``ValueError`` unless the tables in ``filenames`` have the same
+    schema, restricted to ``columns`` if given. Empty tables are not
+    checked, as the types of their columns are not known.
+    '''
+    reference = None
+    for filename in filenames:
+        schema = intermediates.read_schema(filename).remove_metadata()
+        if columns is not None:
+            missing = [c for c in columns if c not in schema.names]
+            if missing:
+                raise ValueError(
+                    '%s lacks columns %s' % (filename, ', '.join(missing))
+                )
+            schema = pa.schema([schema.field(c) for c in columns])
+        if any(pa.types.is_null(field.type) for field in schema):
+            continue
+        if reference is None:
+            reference, reference_filename = schema, filename
+        elif not schema.equals(reference):
+            raise ValueError(
+                'schema of %s does not match that of %s:\n%s\n%s'
+                % (filename, reference_filename, schema, reference)
+            )
+
+
+def main(args):
+
+    check_schemas(args.input_files, args.columns)
+
+    tables = []
+    for filename in args.input_files:
+        table = intermediates.read_arrow(filename, args.columns)
+        if table.num_rows > 0:
+            tables.append(table.replace_schema_metadata(None))
+    if not tables:
+        raise ValueError('all input files are empty')
+
+    spot_count = pa.concat_tables(tables).to_pandas()
+    spot_count.to_csv(args.output_file, encoding='utf-8', index=False)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
@@ -0,0 +1,283 @@
+'''
+asyncio client for the part of the TissueMAPS API that the pipelines use.
+
+``TmClient`` sends one blocking request at a time per client, looks up the
+channel ID with an extra request before every image and logs in once per
+client, i.e. once per download thread of every job. :class:`AsyncTmClient`
+logs in once, keeps the experiment and channel IDs, and sends its requests
+over one pool of keep-alive connections (``aiohttp``) with at most
+``max_in_flight`` requests in flight, so that many small requests keep the
+network busy instead of waiting for round trips. ``download_images``
+fetches many (well, site, channel, z-plane) images at once.
+
+The stage scripts are synchronous: with ``--max_in_flight`` they use a
+:class:`PooledTmClient`, which runs an :class:`AsyncTmClient` in a
+background thread and can be shared by any number of threads in place of
+their own ``TmClient`` (see :class:`ClientFactory`).
+
+Requires ``aiohttp``.
+'''
+import asyncio
+import os
+import ssl
+import threading
+from urllib.parse import urlencode
+
+import numpy as np
+
+
+class AsyncTmClient(object):
+    '''
+    Client of the experiment ``experiment_name`` on a TissueMAPS server,
+    to be used as an asynchronous context manager. Failed image requests
+    (server errors and lost connections) are retried ``retries`` times.
+    '''
+
+    def __init__(self, host, port, username, password, experiment_name,
+                 max_in_flight=16, ca_bundle=None, retries=2):
+        self.experiment_name = experiment_name
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self._host = host
+        self._username = username
+        self._password = password
+        self._ca_bundle = ca_bundle
+        scheme = 'https' if port == 443 else 'http'
+        self._base_url = '{0}://{1}:{2}'.format(scheme, host, port)
+        self._session = None
+        self._headers = {'Host': host}
+        self._experiment_id = None
+        self._channel_ids = dict()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        '''Open the connection pool and log in'''
+        import aiohttp
+
+        ssl_context = None
+        if self._ca_bundle is not None:
+            ssl_context = ssl.create_default_context(
+                cafile=os.path.expanduser(
+                    os.path.expandvars(self._ca_bundle)
+                )
+            )
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_in_flight, ssl=ssl_context
+            ),
+            raise_for_status=True
+        )
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._lookup = asyncio.Lock()
+        async with self._session.post(
+                self._base_url + '/auth', headers=self._headers,
+                json={'username': self._username,
+                      'password': self._password}) as response:
+            token = (await response.json())['access_token']
+        self._headers['Authorization'] = 'JWT %s' % token
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _url(self, route, params=None):
+        url = self._base_url + '/api' + route
+        if params:
+            url += '?' + urlencode(params)
+        return url
+
+    async def _get_json(self, route, params=None):
+        async with self._in_flight:
+            async with self._session.get(
+                    self._url(route, params),
+                    headers=self._headers) as response:
+                return (await response.json())['data']
+
+    async def _get_id(self, route, name, kind):
+        data = await self._get_json(route, {'name': name})
+        if len(data) != 1:
+            raise ValueError(
+                '%s %s "%s"' % (
+                    'No' if len(data) == 0 else 'More than one', kind, name
+                )
+            )
+        return data[0]['id']
+
+    async def experiment_id(self):
+        async with self._lookup:
+            if self._experiment_id is None:
+                self._experiment_id = await self._get_id(
+                    '/experiments', self.experiment_name, 'experiment'
+                )
+        return self._experiment_id
+
+    async def channel_id(self, channel_name):
+        experiment_id = await self.experiment_id()
+        async with self._lookup:
+            if channel_name not in self._channel_ids:
+                self._channel_ids[channel_name] = await self._get_id(
+                    '/experiments/%s/channels' % experiment_id,
+                    channel_name, 'channel'
+                )
+        return self._channel_ids[channel_name]
+
+    async def get_sites(self, plate_name=None, well_name=None):
+        '''Sites of the experiment, like ``TmClient.get_sites``'''
+        params = dict()
+        if plate_name is not None:
+            params['plate_name'] = plate_name
+        if well_name is not None:
+            params['well_name'] = well_name
+        return await self._get_json(
+            '/experiments/%s/sites' % await self.experiment_id(), params
+        )
+
+    async def get_channels(self):
+        '''Channels of the experiment, like ``TmClient.get_channels``'''
+        return await self._get_json(
+            '/experiments/%s/channels' % await self.experiment_id()
+        )
+
+    async def download_channel_image(self, channel_name, plate_name,
+                                     well_name, well_pos_y, well_pos_x,
+                                     cycle_index=0, tpoint=0, zplane=0,
+                                     correct=True):
+        '''Image of a channel, like ``TmClient.download_channel_image``'''
+        import aiohttp
+
+        url = self._url(
+            '/experiments/%s/channels/%s/image-file' % (
+                await self.experiment_id(),
+                await self.channel_id(channel_name)
+            ),
+            {
+                'plate_name': plate_name,
+                'cycle_index': cycle_index,
+                'well_name': well_name,
+                'well_pos_x': well_pos_x,
+                'well_pos_y': well_pos_y,
+                'tpoint': tpoint,
+                'zplane': zplane,
+                'correct': correct
+            }
+        )
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._in_flight:
+                    async with self._session.get(
+                            url, headers=self._headers) as response:
+                        data = await response.read()
+                break
+            except aiohttp.ClientResponseError as error:
+                if error.status < 500 or attempt == self.retries:
+                    raise
+            except aiohttp.ClientConnectionError:
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(0.1 * 2 ** attempt)
+        # decoding releases the GIL, so it runs in a thread off the loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _decode, data
+        )
+
+    async def download_images(self, requests):
+        '''
+        Images of ``requests``, each a dict of the keyword arguments of
+        :meth:`download_channel_image`, in the same order
+        '''
+        return await asyncio.gather(*[
+            self.download_channel_image(**request) for request in requests
+        ])
+
+
+def _decode(data):
+    import cv2
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class PooledTmClient(object):
+    '''
+    Synchronous, thread-safe facade of an :class:`AsyncTmClient` that runs
+    in an event loop in a background thread. Calls from many threads share
+    its connection pool and in-flight limit. Takes the arguments of
+    :class:`AsyncTmClient`.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self._client = AsyncTmClient(*args, **kwargs)
+        self._run(self._client.open())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self._loop
+        ).result()
+
+    @property
+    def experiment_name(self):
+        return self._client.experiment_name
+
+    def get_sites(self, plate_name=None, well_name=None):
+        return self._run(self._client.get_sites(plate_name, well_name))
+
+    def get_channels(self):
+        return self._run(self._client.get_channels())
+
+    def download_channel_image(self, **kwargs):
+        return self._run(self._client.download_channel_image(**kwargs))
+
+    def download_images(self, requests):
+        '''See :meth:`AsyncTmClient.download_images`'''
+        return self._run(self._client.download_images(requests))
+
+    def close(self):
+        self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class ClientFactory(object):
+    '''
+    Callable that returns a client of the TissueMAPS API for the keyword
+    arguments of ``TmClient``: a new ``TmClient`` per call or, with
+    ``max_in_flight``, one :class:`PooledTmClient` shared by all callers.
+    '''
+
+    def __init__(self, max_in_flight=None, **kwargs):
+        self._max_in_flight = max_in_flight
+        self._kwargs = kwargs
+        self._pooled = None
+        self._lock = threading.Lock()
+
+    @property
+    def pooled(self):
+        '''Whether the clients are one shared :class:`PooledTmClient`'''
+        return self._max_in_flight is not None
+
+    def __call__(self):
+        if not self.pooled:
+            from tmclient import TmClient
+            return TmClient(**self._kwargs)
+        with self._lock:
+            if self._pooled is None:
+                self._pooled = PooledTmClient(
+                    max_in_flight=self._max_in_flight, **self._kwargs
+                )
+        return self._pooled
+
+    def close(self):
+        '''Close the shared client, if any'''
+        if self._pooled is not None:
+            self._pooled.close()
+            self._pooled = None
@@ -0,0 +1,109 @@
+'''
+Time collecting spot count rows with ResultBuilder against growing a
+DataFrame one row at a time, as the scripts used to do.
+
+Run from the repository root::
+
+    python -m benchmarks.accumulation --rows 1000 10000 100000
+'''
+from __future__ import print_function, absolute_import
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from result_builder import ResultBuilder
+
+
+COLUMNS = [
+    ('threshold', np.float64),
+    ('well', object),
+    ('site_x', np.int64),
+    ('site_y', np.int64),
+    ('spot_count', np.int64)
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='accumulation',
+        description=('Times accumulating result rows with ResultBuilder and '
+                     'with row-wise DataFrame growth.')
+    )
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+        help='numbers of rows to collect'
+    )
+    parser.add_argument(
+        '--thresholds', type=int, default=10,
+        help='rows added per site (default: 10)'
+    )
+    parser.add_argument(
+        '--max_rows_dataframe', type=int, default=20000,
+        help=('largest number of rows collected by growing a DataFrame, '
+              'which takes quadratic time (default: 20000)')
+    )
+
+    return(parser.parse_args())
+
+
+def collect_builder(n_rows, n_thresholds):
+    thresholds = np.linspace(0.01, 0.1, n_thresholds)
+    counts = np.arange(n_thresholds)
+    spot_count = ResultBuilder(COLUMNS)
+    for site in range(n_rows // n_thresholds):
+        spot_count.extend(
+            threshold=thresholds,
+            well='A01',
+            site_x=site,
+            site_y=0,
+            spot_count=counts
+        )
+    return spot_count.to_frame()
+
+
+def collect_dataframe(n_rows, n_thresholds):
+    thresholds = np.linspace(0.01, 0.1, n_thresholds)
+    spot_count = pd.DataFrame()
+    for site in range(n_rows // n_thresholds):
+        for threshold, count in zip(thresholds, range(n_thresholds)):
+            # equivalent of the removed DataFrame.append
+            spot_count = pd.concat([spot_count, pd.DataFrame({
+                'threshold': threshold,
+                'well': 'A01',
+                'site_x': site,
+                'site_y': 0,
+                'spot_count': count
+            }, index=[0])])
+    return spot_count
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main(args):
+    print('{0:>10} {1:>14} {2:>14} {3:>14}'.format(
+        'rows', 'builder [s]', 'per row [us]', 'DataFrame [s]'
+    ))
+    for n_rows in args.rows:
+        builder = timed(collect_builder, n_rows, args.thresholds)
+        if n_rows <= args.max_rows_dataframe:
+            dataframe = '{0:14.3f}'.format(
+                timed(collect_dataframe, n_rows, args.thresholds)
+            )
+        else:
+            dataframe = '{0:>14}'.format('-')
+        print('{0:10d} {1:14.3f} {2:14.2f} {3}'.format(
+            n_rows, builder, 1e6 * builder / n_rows, dataframe
+        ))
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
@@ -0,0 +1,505 @@
+'''
+Local stand-in for a TissueMAPS server, for benchmarking downloads offline.
+
+The server answers the requests that ``TmClient`` makes for the scripts of
+this repository: login, ``get_sites``, ``get_channels`` and
+``download_channel_image`` (with ``zplane`` and ``correct``). Images are
+sent as 16-bit PNG files like TissueMAPS sends them. They come from a
+:class:`~benchmarks.synthetic.SyntheticExperiment` or from a directory of
+``.npy`` files written by :func:`write_images`. Without ``correct``, an
+image is multiplied by a fixed illumination profile.
+
+Every request can be delayed by a latency, the responses of all requests
+share a bandwidth limit, and a fraction of the image requests can be made
+to fail with ``503 Service Unavailable``, e.g.::
+
+    python -m benchmarks.mock_tissuemaps --port 8080 --zplanes 20 \\
+        --latency 0.05 --bandwidth 20 --error_rate 0.01
+
+    python get_spot_count_threshold_series_3D.py -H localhost -P 8080 \\
+        -u user --password any -e synthetic ...
+
+Any user name and password are accepted. In process (e.g. in a benchmark
+run by CI), use :class:`MockTissueMAPS` as a context manager.
+'''
+from __future__ import print_function, absolute_import
+import argparse
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticExperiment
+
+
+_IMAGE_FILE = re.compile(
+    r'^(?P<plate>.+?)_(?P<well>[^_]+)_y(?P<y>\d+)_x(?P<x>\d+)_'
+    r'(?P<channel>.+)_z(?P<zplane>\d+)\.npy$'
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='mock_tissuemaps',
+        description=('Serves synthetic or stored images like a TissueMAPS '
+                     'server, with configurable latency, bandwidth and '
+                     'error rate.')
+    )
+    parser.add_argument(
+        '-H', '--host', default='localhost',
+        help='address to listen to (default: localhost)'
+    )
+    parser.add_argument(
+        '-P', '--port', type=int, default=8080,
+        help='port to listen to (default: 8080)'
+    )
+    parser.add_argument(
+        '-e', '--experiment', default='synthetic',
+        help='experiment name (default: synthetic)'
+    )
+    parser.add_argument(
+        '--image_dir', type=str, default=None,
+        help=('serve the .npy images in this directory instead of '
+              'synthetic sites')
+    )
+    parser.add_argument(
+        '--write_images', type=str, default=None, metavar='DIRECTORY',
+        help='write the synthetic images to DIRECTORY as .npy and exit'
+    )
+    parser.add_argument(
+        '--sites_per_well', type=int, default=4,
+        help='synthetic sites per well (default: 4)'
+    )
+    parser.add_argument(
+        '--shape', type=int, nargs=2, default=[512, 512],
+        help='height and width of the synthetic sites (default: 512 512)'
+    )
+    parser.add_argument(
+        '--zplanes', type=int, default=None,
+        help='z-planes of the synthetic FISH channel (default: 1)'
+    )
+    parser.add_argument(
+        '--fish_channels', type=str, nargs='+', default=['FISH'],
+        help='names under which the synthetic FISH channel is served'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='seed of the synthetic sites (default: 0)'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='seconds every request is delayed by (default: 0)'
+    )
+    parser.add_argument(
+        '--bandwidth', type=float, default=None,
+        help='total bandwidth of all responses in MB/s (default: unlimited)'
+    )
+    parser.add_argument(
+        '--error_rate', type=float, default=0.0,
+        help='fraction of image requests that fail with 503 (default: 0)'
+    )
+
+    return(parser.parse_args())
+
+
+def encode_png(image):
+    '''16-bit (or 8-bit) grayscale PNG file of the 2D array ``image``'''
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        depth, rows = 8, image
+    else:
+        depth, rows = 16, image.astype('>u2')
+    height, width = image.shape
+    # every row starts with filter type 0 (none)
+    raw = np.zeros((height, 1 + rows.itemsize * width), dtype=np.uint8)
+    raw[:, 1:] = rows.view(np.uint8).reshape(height, -1)
+
+    def chunk(kind, data):
+        return (
+            struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+        )
+
+    return (
+        b'\x89PNG\r\n\x1a\n' +
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth, 0, 0,
+                                   0, 0)) +
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 1)) +
+        chunk(b'IEND', b'')
+    )
+
+
+def illumination(shape):
+    '''Profile applied to images requested without ``correct``'''
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    r2 = (
+        ((y - (shape[0] - 1) / 2.0) / shape[0]) ** 2 +
+        ((x - (shape[1] - 1) / 2.0) / shape[1]) ** 2
+    )
+    return 1.0 - 0.6 * r2
+
+
+class SyntheticSource(object):
+    '''Images of a :class:`~benchmarks.synthetic.SyntheticExperiment`'''
+
+    def __init__(self, experiment, fish_channels=('FISH',)):
+        self.experiment = experiment
+        self.fish_channels = list(fish_channels)
+
+    def sites(self):
+        return [
+            dict(
+                plate_name=row['plate'], well_name=row['well'],
+                y=int(row['site_y']), x=int(row['site_x']),
+                height=int(row['height']), width=int(row['width'])
+            )
+            for _, row in self.experiment.metadata().iterrows()
+        ]
+
+    def channels(self):
+        zplanes = self.experiment.site_options.get('zplanes') or 1
+        return (
+            [(name, zplanes) for name in self.fish_channels] +
+            [('DAPI', 1), ('SE', 1)]
+        )
+
+    def image(self, channel_name, plate_name, well_name, well_pos_y,
+              well_pos_x, zplane):
+        if channel_name in self.fish_channels:
+            channel_name = 'FISH'
+        return self.experiment.download_channel_image(
+            channel_name=channel_name,
+            plate_name=plate_name,
+            well_name=well_name,
+            well_pos_y=well_pos_y,
+            well_pos_x=well_pos_x,
+            zplane=zplane
+        )
+
+
+class DirectorySource(object):
+    '''
+    Images stored as ``<plate>_<well>_y<y>_x<x>_<channel>_z<zplane>.npy``
+    in ``directory``
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = dict()
+        for filename in os.listdir(directory):
+            match = _IMAGE_FILE.match(filename)
+            if match is not None:
+                key = (
+                    match.group('channel'), match.group('plate'),
+                    match.group('well'), int(match.group('y')),
+                    int(match.group('x')), int(match.group('zplane'))
+                )
+                self._files[key] = os.path.join(directory, filename)
+
+    def sites(self):
+        sites = dict()
+        for key, path in sorted(self._files.items()):
+            site = key[1:5]
+            if site not in sites:
+                shape = np.load(path, mmap_mode='r').shape
+                sites[site] = dict(
+                    plate_name=site[0], well_name=site[1],
+                    y=site[2], x=site[3], height=shape[0], width=shape[1]
+                )
+        return list(sites.values())
+
+    def channels(self):
+        zplanes = dict()
+        for key in self._files:
+            zplanes[key[0]] = max(zplanes.get(key[0], 0), key[5] + 1)
+        return sorted(zplanes.items())
+
+    def image(self, channel_name, plate_name, well_name, well_pos_y,
+              well_pos_x, zplane):
+        path = self._files.get((
+            channel_name, plate_name, well_name, int(well_pos_y),
+            int(well_pos_x), int(zplane)
+        ))
+        if path is None:
+            return None
+        return np.load(path)
+
+
+def write_images(source, directory):
+    '''Write all images of ``source`` for a :class:`DirectorySource`'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for site in source.sites():
+        for channel_name, zplanes in source.channels():
+            for zplane in range(zplanes):
+                np.save(
+                    os.path.join(
+                        directory,
+                        '{0}_{1}_y{2:03d}_x{3:03d}_{4}_z{5:03d}.npy'.format(
+                            site['plate_name'], site['well_name'], site['y'],
+                            site['x'], channel_name, zplane
+                        )
+                    ),
+                    source.image(
+                        channel_name, site['plate_name'], site['well_name'],
+                        site['y'], site['x'], zplane
+                    )
+                )
+
+
+class Bandwidth(object):
+    '''Bandwidth of ``rate`` bytes per second shared by all responses'''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._available_at = time.time()
+
+    def send(self, write, data, chunk_size=64 * 1024):
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            with self._lock:
+                now = time.time()
+                self._available_at = (
+                    max(self._available_at, now) + len(chunk) / self.rate
+                )
+                wait = self._available_at - now
+            if wait > 0:
+                time.sleep(wait)
+            write(chunk)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keeps connections open for the sessions of TmClient
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json',
+              headers=()):
+        mock = self.server.mock
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if mock.bandwidth is None:
+            self.wfile.write(body)
+        else:
+            mock.bandwidth.send(self.wfile.write, body)
+        mock.count('bytes', len(body))
+
+    def _send_json(self, data, status=200):
+        self._send(status, json.dumps(data).encode('utf-8'))
+
+    def _delay(self):
+        mock = self.server.mock
+        mock.count('requests')
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+
+    def do_POST(self):
+        self._delay()
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path == '/auth':
+            self._send_json({'access_token': 'mock'})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        self._delay()
+        mock = self.server.mock
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = [p for p in url.path.split('/') if p]
+
+        if not parts:
+            self._send(200, b'')
+        elif parts == ['api', 'experiments']:
+            name = query.get('name', mock.experiment_name)
+            self._send_json({'data': [
+                {'id': mock.experiment_id, 'name': mock.experiment_name}
+            ] if name == mock.experiment_name else []})
+        elif (len(parts) < 4 or parts[:2] != ['api', 'experiments'] or
+                parts[2] != mock.experiment_id):
+            self._send_json({'error': 'not found'}, 404)
+        elif parts[3:] == ['sites']:
+            self._send_json({'data': [
+                dict(site, id=i) for i, site in enumerate(mock.source.sites())
+                if query.get('plate_name', site['plate_name']) ==
+                site['plate_name'] and
+                query.get('well_name', site['well_name']) == site['well_name']
+            ]})
+        elif parts[3:] == ['channels']:
+            self._send_json({'data': [
+                {
+                    'id': str(i), 'name': name,
+                    'layers': [
+                        {'tpoint': 0, 'zplane': z} for z in range(zplanes)
+                    ]
+                }
+                for i, (name, zplanes) in enumerate(mock.source.channels())
+                if query.get('name', name) == name
+            ]})
+        elif len(parts) == 6 and parts[3] == 'channels' and \
+                parts[5] == 'image-file':
+            self._image(parts[4], query)
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def _image(self, channel_id, query):
+        mock = self.server.mock
+        if mock.fail():
+            mock.count('errors')
+            self._send_json({'error': 'injected failure'}, 503)
+            return
+        channels = mock.source.channels()
+        image = None
+        if channel_id.isdigit() and int(channel_id) < len(channels):
+            channel_name = channels[int(channel_id)][0]
+            image = mock.source.image(
+                channel_name, query.get('plate_name'),
+                query.get('well_name'), int(query.get('well_pos_y', 0)),
+                int(query.get('well_pos_x', 0)),
+                int(query.get('zplane', 0))
+            )
+        if image is None:
+            self._send_json({'error': 'no such image'}, 404)
+            return
+        if query.get('correct', 'True') in ('False', 'false', '0'):
+            image = np.clip(
+                np.round(image * illumination(image.shape)), 0, 65535
+            ).astype(image.dtype)
+        self._send(200, encode_png(image), 'image/png', [(
+            'Content-Disposition',
+            'attachment; filename="{0}_{1}_y{2}_x{3}_z{4}.png"'.format(
+                channel_name, query.get('well_name'),
+                query.get('well_pos_y'), query.get('well_pos_x'),
+                query.get('zplane', 0)
+            )
+        )])
+
+
+class MockTissueMAPS(object):
+    '''
+    Server for experiment ``experiment_name`` with the images of
+    ``source`` (:class:`SyntheticSource` or :class:`DirectorySource`).
+    ``port`` 0 picks a free port, see :attr:`port`.
+    '''
+
+    def __init__(self, source, experiment_name='synthetic',
+                 host='localhost', port=0, latency=0.0, bandwidth=None,
+                 error_rate=0.0, seed=0):
+        self.source = source
+        self.experiment_name = experiment_name
+        self.experiment_id = '1'
+        self.latency = latency
+        self.bandwidth = None if bandwidth is None else Bandwidth(bandwidth)
+        self.error_rate = error_rate
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0}
+        self._random_state = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def fail(self):
+        '''Whether the current image request is made to fail'''
+        with self._lock:
+            return self._random_state.uniform() < self.error_rate
+
+    def start(self):
+        '''Serve in a background thread'''
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(args):
+
+    if args.image_dir is not None:
+        source = DirectorySource(args.image_dir)
+    else:
+        source = SyntheticSource(
+            SyntheticExperiment(
+                sites_per_well=args.sites_per_well,
+                seed=args.seed,
+                shape=tuple(args.shape),
+                zplanes=args.zplanes
+            ),
+            args.fish_channels
+        )
+    if args.write_images is not None:
+        write_images(source, args.write_images)
+        return
+
+    server = MockTissueMAPS(
+        source, args.experiment, args.host, args.port, args.latency,
+        None if args.bandwidth is None else args.bandwidth * 1e6,
+        args.error_rate, args.seed
+    )
+    print('serving experiment "%s" on http://%s:%d' % (
+        args.experiment, server.host, server.port
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print('%(requests)d requests, %(errors)d failed, %(bytes)d bytes'
+              % server.stats)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
@@ -0,0 +1,424 @@
+'''
+Time the stages of the spot detection pipelines one by one on synthetic
+sites (see benchmarks/synthetic.py) and write the timings to a JSON file,
+so that runs on different commits can be compared.
+
+The stages are those of the pipeline scripts, called in process on the
+images of a :class:`~benchmarks.synthetic.SyntheticExperiment`:
+
+extrema
+    get_intensity_extrema.get_extrema_of_sites on all sites
+site_selection
+    plan_sites.select_sites and assign_batches
+segmentation
+    segmentation.segment_cells on all sites (needs jtmodules)
+filtering
+    spot_detection.filter_image on all sites
+threshold_sweep
+    threshold_sweep.count_objects_series on the filtered sites
+aggregation
+    aggregate_rescaling_limits.py and aggregate_spot_count.py on one table
+    per site
+
+A stage whose modules cannot be imported is reported as skipped. Since the
+spots and cells of the sites are known, the results also hold the true
+and the detected numbers of spots and cells.
+
+Run from the repository root, e.g. for 3D stacks of 20 planes::
+
+    python -m benchmarks.stages --zplanes 20 --output before.json
+    python -m benchmarks.stages --zplanes 20 --output after.json
+    python -m benchmarks.stages --compare before.json after.json
+
+With a single ``--compare`` file, the stages are run and compared to it.
+'''
+from __future__ import print_function, absolute_import
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import scipy
+
+import intermediates
+import spot_detection
+from result_builder import ResultBuilder
+from threshold_sweep import count_objects_series
+from benchmarks.synthetic import SyntheticExperiment
+
+
+STAGES = [
+    'extrema', 'site_selection', 'segmentation', 'filtering',
+    'threshold_sweep', 'aggregation'
+]
+
+# filters of get_spot_count_threshold_series.py and
+# get_spot_count_threshold_series_3D.py
+FILTER_ARGS = {
+    2: ('2D LoG', 6.0),
+    3: ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+}
+IMG_LIMES = [0.01, 0.995]
+# rescale between the quantiles of every image
+RESCALE_THR = [0.0, 65535.0, 0.0, 65535.0]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='stages',
+        description=('Times the stages of the spot detection pipelines on '
+                     'synthetic smFISH sites.')
+    )
+    parser.add_argument(
+        '--stages', type=str, nargs='+', default=STAGES, choices=STAGES,
+        help='stages to time (default: all)'
+    )
+    parser.add_argument(
+        '--sites_per_well', type=int, default=4,
+        help='sites of the negative and of the positive well (default: 4)'
+    )
+    parser.add_argument(
+        '--shape', type=int, nargs=2, default=[512, 512],
+        help='height and width of the sites (default: 512 512)'
+    )
+    parser.add_argument(
+        '--zplanes', type=int, default=None,
+        help='number of z-planes of the FISH stacks (default: 2D images)'
+    )
+    parser.add_argument(
+        '--cells', type=int, default=12,
+        help='cells per site (default: 12)'
+    )
+    parser.add_argument(
+        '--spots_per_cell', type=float, default=20.0,
+        help=('mean number of spots per cell of the positive control; '
+              'negative cells have a tenth of it (default: 20)')
+    )
+    parser.add_argument(
+        '--psf_sigma', type=float, nargs=3, default=[1.5, 1.5, 1.0],
+        help='width of the PSF along y, x and z in pixels'
+    )
+    parser.add_argument(
+        '--spot_intensity', type=float, default=300.0,
+        help='peak intensity of a spot above background (default: 300)'
+    )
+    parser.add_argument(
+        '--background', type=float, default=100.0,
+        help='mean background intensity (default: 100)'
+    )
+    parser.add_argument(
+        '-t', '--thresholds', default=[0.01, 0.2, 0.01],
+        nargs=3, metavar=('start', 'end', 'step'), type=float,
+        help='thresholds of the threshold sweep'
+    )
+    parser.add_argument(
+        '--batches', type=int, default=2,
+        help='batches of the site selection (default: 2)'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='timed runs of every stage (default: 3)'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='seed of the synthetic sites (default: 0)'
+    )
+    parser.add_argument(
+        '-o', '--output', type=str, default=None,
+        help='filename for the results (.json)'
+    )
+    parser.add_argument(
+        '--compare', type=str, nargs='+', default=None,
+        metavar='RESULTS',
+        help=('report the change from a baseline results file to this run, '
+              'or to a second results file without running')
+    )
+
+    args = parser.parse_args()
+    if args.compare is not None and len(args.compare) > 2:
+        parser.error('--compare takes one or two results files')
+    return(args)
+
+
+@contextlib.contextmanager
+def working_directory():
+    '''Run in a new temporary directory, removed afterwards'''
+    previous = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='benchmark_')
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def time_extrema(experiment, state):
+    import get_intensity_extrema
+
+    sites = experiment.sites()
+    extrema = get_intensity_extrema.get_extrema_of_sites(
+        df=sites, client=experiment, channel_name='FISH',
+        plate_name=experiment.plate_name
+    )
+    state['extrema'] = sites.merge(extrema)
+
+
+def time_site_selection(experiment, state):
+    import plan_sites
+
+    plan = plan_sites.select_sites(
+        experiment.metadata(), experiment.plate_name, experiment.controls,
+        experiment.sites_per_well, experiment.seed
+    )
+    plan_sites.assign_batches(
+        plan.cost.values, plan.well.values, state['batches'],
+        plan.control.values
+    )
+
+
+def time_segmentation(experiment, state):
+    import segmentation
+
+    segmented_cells = 0
+    for _, row in experiment.sites().iterrows():
+        site = experiment.site(row['well'], row['site_y'], row['site_x'])
+        cells = segmentation.segment_cells(site.dapi, site.se)
+        segmented_cells += len(np.unique(cells[cells > 0]))
+    state['segmented_cells'] = segmented_cells
+
+
+def time_filtering(experiment, state):
+    filtered = []
+    op = None
+    for _, row in experiment.sites().iterrows():
+        site = experiment.site(row['well'], row['site_y'], row['site_x'])
+        if op is None:
+            op = spot_detection.fspecial_cp3d(*FILTER_ARGS[site.fish.ndim])
+        filtered.append(spot_detection.filter_image(
+            site.fish, op, IMG_LIMES, RESCALE_THR
+        ))
+    state['filtered'] = filtered
+
+
+def time_threshold_sweep(experiment, state):
+    if 'filtered' not in state:
+        time_filtering(experiment, state)
+    start = time.time()
+    state['spot_counts'] = [
+        count_objects_series(image, state['thresholds'])
+        for image in state['filtered']
+    ]
+    state['elapsed'] = time.time() - start
+
+
+def time_aggregation(experiment, state):
+    import aggregate_rescaling_limits
+    import aggregate_spot_count
+
+    if 'extrema' not in state:
+        time_extrema(experiment, state)
+    if 'spot_counts' not in state:
+        time_threshold_sweep(experiment, state)
+
+    with working_directory():
+        extrema_files = []
+        count_files = []
+        sites = experiment.sites()
+        for i, (_, row) in enumerate(sites.iterrows()):
+            extrema_files.append('extrema_%03d.arrow' % i)
+            intermediates.write_table(
+                state['extrema'].iloc[[i]], extrema_files[-1]
+            )
+            spot_count = ResultBuilder([
+                ('threshold', np.float64),
+                ('well', object),
+                ('site_x', np.int64),
+                ('site_y', np.int64),
+                ('spot_count', np.int64)
+            ])
+            spot_count.extend(
+                threshold=state['thresholds'],
+                well=row['well'],
+                site_x=row['site_x'],
+                site_y=row['site_y'],
+                spot_count=state['spot_counts'][i]
+            )
+            count_files.append('spot_count_%03d.arrow' % i)
+            intermediates.write_table(spot_count.to_frame(), count_files[-1])
+
+        start = time.time()
+        aggregate_rescaling_limits.main(argparse.Namespace(
+            input_files=extrema_files,
+            output_file='aggregated_limits.arrow',
+            lower_percentile=1.0,
+            upper_percentile=99.5,
+            site_queue=None
+        ))
+        aggregate_spot_count.main(argparse.Namespace(
+            input_files=count_files,
+            output_file='aggregated_spot_count.csv',
+            columns=None
+        ))
+        # only the aggregation itself is timed
+        state['elapsed'] = time.time() - start
+
+
+def run_stage(name, experiment, state, repeat):
+    '''Times of ``repeat`` runs of the stage, or the reason it is skipped'''
+    times = []
+    for _ in range(repeat):
+        state.pop('elapsed', None)
+        start = time.time()
+        try:
+            globals()['time_' + name](experiment, state)
+        except ImportError as error:
+            return {'skipped': 'cannot import: %s' % error}
+        times.append(state.pop('elapsed', time.time() - start))
+    return {
+        'times': times,
+        'best': min(times),
+        'median': float(np.median(times))
+    }
+
+
+def ground_truth(experiment, state):
+    truth = {'thresholds': [float(t) for t in state['thresholds']]}
+    sites = experiment.sites()
+    for control in ['negative', 'positive']:
+        spots = 0
+        detected = np.zeros(len(state['thresholds']), dtype=np.int64)
+        for i, (_, row) in enumerate(sites.iterrows()):
+            if row['control'] != control:
+                continue
+            site = experiment.site(row['well'], row['site_y'], row['site_x'])
+            spots += len(site.spots)
+            if 'spot_counts' in state:
+                detected += state['spot_counts'][i]
+        truth[control] = {'spots': spots}
+        if 'spot_counts' in state:
+            truth[control]['detected'] = detected.tolist()
+    truth['cells'] = int(sum(
+        experiment.site(row['well'], row['site_y'], row['site_x']).cells.max()
+        for _, row in sites.iterrows()
+    ))
+    if 'segmented_cells' in state:
+        truth['segmented_cells'] = int(state['segmented_cells'])
+    return truth
+
+
+def commit():
+    '''Commit of the repository, if it is a git checkout'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull
+            ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    print('{0:<16} {1:>14} {2:>14} {3:>10}'.format(
+        'stage', 'baseline [s]', 'current [s]', 'change'
+    ))
+    for name in STAGES:
+        before = baseline['stages'].get(name, {})
+        after = current['stages'].get(name, {})
+        if 'median' in before and 'median' in after:
+            change = '{0:+9.1f}%'.format(
+                100.0 * (after['median'] / before['median'] - 1.0)
+            )
+        else:
+            change = '{0:>10}'.format('-')
+        print('{0:<16} {1:>14} {2:>14} {3}'.format(
+            name,
+            '%.3f' % before['median'] if 'median' in before else '-',
+            '%.3f' % after['median'] if 'median' in after else '-',
+            change
+        ))
+    if baseline.get('parameters') != current.get('parameters'):
+        print('note: the runs have different parameters')
+
+
+def main(args):
+
+    if args.compare is not None and len(args.compare) == 2:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            compare(baseline, json.load(f))
+        return
+
+    experiment = SyntheticExperiment(
+        sites_per_well=args.sites_per_well,
+        spots_per_cell=args.spots_per_cell,
+        seed=args.seed,
+        shape=tuple(args.shape),
+        zplanes=args.zplanes,
+        n_cells=args.cells,
+        psf_sigma=tuple(args.psf_sigma),
+        spot_intensity=args.spot_intensity,
+        background=args.background
+    )
+    # generate all sites before anything is timed
+    for _, row in experiment.sites().iterrows():
+        experiment.site(row['well'], row['site_y'], row['site_x'])
+
+    state = {
+        'thresholds': np.arange(*args.thresholds),
+        'batches': args.batches
+    }
+    stages = dict()
+    print('{0:<16} {1:>10} {2:>10}'.format('stage', 'best [s]', 'median [s]'))
+    for name in STAGES:
+        if name not in args.stages:
+            continue
+        stages[name] = run_stage(name, experiment, state, args.repeat)
+        if 'skipped' in stages[name]:
+            print('{0:<16} skipped, {1}'.format(name, stages[name]['skipped']))
+        else:
+            print('{0:<16} {1:10.3f} {2:10.3f}'.format(
+                name, stages[name]['best'], stages[name]['median']
+            ))
+
+    parameters = dict(vars(args))
+    for name in ['output', 'compare', 'stages']:
+        parameters.pop(name)
+    results = {
+        'commit': commit(),
+        'created': datetime.datetime.now().isoformat(),
+        'versions': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'pandas': pd.__version__
+        },
+        'parameters': parameters,
+        'stages': stages,
+        'ground_truth': ground_truth(experiment, state)
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            compare(json.load(f), results)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
@@ -0,0 +1,212 @@
+'''
+Synthetic smFISH sites with known ground truth.
+
+A site has round nuclei in cells that are grown from them up to a maximum
+radius, with the DAPI and SE images the segmentation of the 3D spot count
+scripts expects (see segmentation.py). Spots are placed uniformly in the
+cells, a number per cell drawn from a Poisson distribution, and rendered
+with a Gaussian PSF on a flat background with Poisson noise. The FISH image
+is 2D or, with ``zplanes``, a (height, width, z) stack.
+
+:class:`SyntheticExperiment` serves such sites through
+``download_channel_image`` in place of a ``TmClient``, so the stages of the
+pipelines can run on them without a TissueMAPS server.
+'''
+from __future__ import print_function, absolute_import
+import collections
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+
+Site = collections.namedtuple(
+    'Site', ['fish', 'dapi', 'se', 'nuclei', 'cells', 'spots']
+)
+
+
+def cell_layout(shape, n_cells, nucleus_radius, cell_radius, random_state):
+    '''
+    Label images of ``n_cells`` nuclei and cells: every pixel belongs to the
+    nearest nucleus centre within ``nucleus_radius`` and ``cell_radius``
+    respectively
+    '''
+    centres = []
+    for _ in range(100 * n_cells):
+        if len(centres) == n_cells:
+            break
+        centre = random_state.randint(
+            nucleus_radius, np.array(shape) - nucleus_radius
+        )
+        if all(np.hypot(*(centre - c)) > 2 * nucleus_radius
+               for c in centres):
+            centres.append(centre)
+
+    background = np.ones(shape, dtype=bool)
+    seeds = np.zeros(shape, dtype=np.int32)
+    for label, (y, x) in enumerate(centres, 1):
+        background[y, x] = False
+        seeds[y, x] = label
+    if not centres:
+        empty = np.zeros(shape, dtype=np.int32)
+        return empty, empty
+    distance, (y, x) = ndimage.distance_transform_edt(
+        background, return_indices=True
+    )
+    nearest = seeds[y, x]
+    nuclei = np.where(distance <= nucleus_radius, nearest, 0)
+    cells = np.where(distance <= cell_radius, nearest, 0)
+    return nuclei.astype(np.int32), cells.astype(np.int32)
+
+
+def render_spots(image, spots, intensity, sigma):
+    '''
+    Add a Gaussian of peak ``intensity`` and width ``sigma`` per axis at
+    each row of ``spots`` to the float image ``image``
+    '''
+    radius = [int(np.ceil(4 * s)) for s in sigma]
+    for spot in spots:
+        window = tuple(
+            slice(max(int(c) - r, 0), min(int(c) + r + 1, n))
+            for c, r, n in zip(spot, radius, image.shape)
+        )
+        grids = np.ogrid[window]
+        profile = intensity
+        for grid, c, s in zip(grids, spot, sigma):
+            profile = profile * np.exp(-(grid - c) ** 2 / (2.0 * s ** 2))
+        image[window] += profile
+
+
+def synthetic_site(shape=(512, 512), zplanes=None, n_cells=12,
+                   spots_per_cell=20.0, psf_sigma=(1.5, 1.5, 1.0),
+                   spot_intensity=300.0, background=100.0,
+                   nucleus_radius=30, cell_radius=60, seed=0):
+    '''
+    Generate a :class:`Site`. ``spots`` holds the (y, x) or (y, x, z)
+    coordinates of the spots; ``psf_sigma`` is the PSF width along y, x
+    and z in pixels.
+    '''
+    random_state = np.random.RandomState(seed)
+    nuclei, cells = cell_layout(
+        shape, n_cells, nucleus_radius, cell_radius, random_state
+    )
+
+    spots = []
+    for label in range(1, cells.max() + 1):
+        y, x = np.nonzero(cells == label)
+        n_spots = random_state.poisson(spots_per_cell)
+        chosen = random_state.randint(0, len(y), n_spots)
+        coordinates = [
+            y[chosen] + random_state.uniform(-0.5, 0.5, n_spots),
+            x[chosen] + random_state.uniform(-0.5, 0.5, n_spots)
+        ]
+        if zplanes is not None:
+            coordinates.append(
+                random_state.uniform(0, zplanes - 1, n_spots)
+            )
+        spots.append(np.column_stack(coordinates))
+    ndim = 2 if zplanes is None else 3
+    spots = np.concatenate(spots) if spots else np.zeros((0, ndim))
+
+    fish_shape = tuple(shape) + (() if zplanes is None else (zplanes,))
+    fish = np.full(fish_shape, background)
+    render_spots(fish, spots, spot_intensity, psf_sigma[:ndim])
+    fish = random_state.poisson(fish)
+
+    dapi = ndimage.gaussian_filter(
+        background + 200.0 * (nuclei > 0), 2.0
+    )
+    se = ndimage.gaussian_filter(
+        background + 40.0 * (cells > 0) + 20.0 * (nuclei > 0), 2.0
+    )
+    return Site(
+        fish=np.clip(fish, 0, 65535).astype(np.uint16),
+        dapi=random_state.poisson(dapi).astype(np.uint16),
+        se=random_state.poisson(se).astype(np.uint16),
+        nuclei=nuclei,
+        cells=cells,
+        spots=spots
+    )
+
+
+class SyntheticExperiment(object):
+    '''
+    Plate of negative and positive control wells, each with
+    ``sites_per_well`` sites (in a row along x). Positive sites have
+    ``spots_per_cell`` spots per cell on average, negative sites
+    ``negative_fraction`` of that. Other keyword arguments are those of
+    :func:`synthetic_site`.
+
+    Sites are generated when first requested and kept.
+    '''
+
+    def __init__(self, negative_wells=('A01',), positive_wells=('B01',),
+                 sites_per_well=4, plate_name='plate01',
+                 spots_per_cell=20.0, negative_fraction=0.1, seed=0,
+                 **site_options):
+        self.plate_name = plate_name
+        self.controls = pd.concat([
+            pd.DataFrame({'control': 'negative',
+                          'well': list(negative_wells)}),
+            pd.DataFrame({'control': 'positive',
+                          'well': list(positive_wells)})
+        ], ignore_index=True)
+        self.sites_per_well = sites_per_well
+        self.spots_per_cell = spots_per_cell
+        self.negative_fraction = negative_fraction
+        self.seed = seed
+        self.site_options = site_options
+        self._sites = dict()
+
+    def metadata(self):
+        '''Sites table like metadata_index.py writes'''
+        shape = self.site_options.get('shape', (512, 512))
+        wells = np.repeat(self.controls.well.values, self.sites_per_well)
+        return pd.DataFrame({
+            'plate': self.plate_name,
+            'well': wells,
+            'site_x': np.tile(
+                np.arange(self.sites_per_well), len(self.controls)
+            ),
+            'site_y': 0,
+            'height': shape[0],
+            'width': shape[1]
+        }, columns=['plate', 'well', 'site_x', 'site_y', 'height', 'width'])
+
+    def sites(self):
+        '''Sites with their control, like the site plan of the pipelines'''
+        sites = self.metadata().merge(self.controls)
+        return sites.loc[:, ['control', 'well', 'site_x', 'site_y']]
+
+    def site(self, well_name, well_pos_y, well_pos_x):
+        key = (well_name, int(well_pos_y), int(well_pos_x))
+        if key not in self._sites:
+            control = self.controls.control[
+                self.controls.well == well_name
+            ].iloc[0]
+            spots_per_cell = self.spots_per_cell
+            if control == 'negative':
+                spots_per_cell *= self.negative_fraction
+            index = self.metadata().index[
+                (self.metadata().well == well_name) &
+                (self.metadata().site_y == key[1]) &
+                (self.metadata().site_x == key[2])
+            ][0]
+            self._sites[key] = synthetic_site(
+                spots_per_cell=spots_per_cell,
+                seed=self.seed * 100003 + int(index),
+                **self.site_options
+            )
+        return self._sites[key]
+
+    def download_channel_image(self, channel_name, plate_name, well_name,
+                               well_pos_y, well_pos_x, zplane=0,
+                               correct=True, **kwargs):
+        site = self.site(well_name, well_pos_y, well_pos_x)
+        if channel_name == 'DAPI':
+            return site.dapi
+        if channel_name == 'SE':
+            return site.se
+        if site.fish.ndim == 3:
+            return site.fish[:, :, zplane]
+        return site.fish
@@ -1,3 +0,0 @@
-#!/bin/bash
-head -1 $1
-tail -q -n +2 $*
@@ -0,0 +1,28 @@
+'''
+Spot detection settings of the 2D pipeline, shared by the spot count jobs
+(get_spot_count_threshold_series.py) and the threshold search
+(search_thresholds.py).
+'''
+
+
+# arguments of fspecialCP3D and the quantiles of iImgLimes
+FILTER_ARGS = ('2D LoG', 6.0)
+
+IMG_LIMES = [0.01, 0.995]
+
+
+def rescaling_thresholds(aggregated_limits, hard_rescaling):
+    '''
+    iRescaleThr of ObjByFilter: the hard rescaling thresholds, where given,
+    otherwise percentiles of the intensity limits aggregated by control
+    '''
+    defaults = [
+        aggregated_limits.lower_limit.loc['negative']['percentile_10'],
+        aggregated_limits.upper_limit.loc['negative']['percentile_80'],
+        aggregated_limits.upper_limit.loc['positive']['percentile_40'],
+        aggregated_limits.upper_limit.loc['positive']['percentile_80']
+    ]
+    return [
+        limit if limit != 0 else default
+        for limit, default in zip(hard_rescaling, defaults)
+    ]
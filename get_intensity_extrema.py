@@ -1,15 +1,19 @@
 import argparse
 import numpy as np
-import pandas as pd
-import itertools
-from tmclient import TmClient
+import async_tmclient
+import intermediates
+import image_cache
+import instrumentation
+import histogram_percentile
+import site_fetcher
+from result_builder import ResultBuilder
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         prog='get_intensity_extrema',
         description=('Accesses images from TissueMAPS instance and '
-                     'writes a pkl file of channel image intensity extrema.')
+                     'writes a table of channel image intensity extrema.')
     )
     parser.add_argument(
         '-v', '--verbosity', action='count', default=0,
@@ -44,27 +48,42 @@ def parse_arguments():
         help='channel name'
     )
     parser.add_argument(
-        '--negative_wells', type=str, nargs='+', required=True,
-        help='wells of negative control (as list)'
+        '--input_batch_file', type=str, required=True,
+        help='sites of the batch as written by plan_sites.py (.arrow)'
     )
     parser.add_argument(
-        '--positive_wells', type=str, nargs='+', required=True,
-        help='wells of positive control (as list)'
+        '-o', '--output_file', type=str, required=True,
+        help='filename for output file (.arrow)'
     )
     parser.add_argument(
-        '-n', '--number_sites', dest='n_sites', type=int, required=True,
-        help='number of randomly selected sites'
+        '--cache_dir', type=str, default=None,
+        help='directory of an image cache shared between jobs (optional)'
     )
     parser.add_argument(
-        '-o', '--output_file', type=str, required=True,
-        help='filename for output file (.pkl)'
+        '--cache_size', type=float, default=50.0,
+        help='maximum size of the image cache in GB (default: 50)'
+    )
+    parser.add_argument(
+        '--trace', action='store_true',
+        help=('write the time, CPU time, downloaded bytes and peak memory '
+              'of each phase of every site next to the output file (see '
+              'instrumentation.py)')
+    )
+    parser.add_argument(
+        '--max_in_flight', type=int, default=None,
+        help=('download through one pooled asyncio client with this many '
+              'requests in flight (see async_tmclient.py, optional)')
     )
 
     return(parser.parse_args())
 
 def main(args):
 
-    tmaps_api = TmClient(
+    tracer = instrumentation.tracer(
+        args.trace, args.output_file, 'intensity_extrema'
+    )
+    new_client = async_tmclient.ClientFactory(
+        args.max_in_flight,
         host=args.host,
         port=args.port,
         experiment_name=args.experiment,
@@ -72,95 +91,47 @@ def main(args):
         password=args.password
     )
 
-    negative = pd.DataFrame({
-        'control': 'negative',
-        'well': args.negative_wells
-    })
-
-    positive = pd.DataFrame({
-        'control': 'positive',
-        'well': args.positive_wells
-    })
-
-    rescaling_limits = negative.append(positive)
-
-    rescaling_limits = rescaling_limits.merge(
-        get_site_dimensions(
-            df=rescaling_limits,
-            plate_name=args.plate,
-            client=tmaps_api
+    def connect():
+        return image_cache.cached_client(
+            tracer.client(new_client()), args.experiment, args.cache_dir,
+            args.cache_size
         )
-    )
 
-    rescaling_limits = rescaling_limits.merge(
-        select_random_sites(
-            df=rescaling_limits,
-            n_sites=args.n_sites
-        ), how='outer'
-    )
+    tmaps_api = connect()
+    # the download threads share the pooled client
+    fetcher = None
+    if new_client.pooled:
+        fetcher = site_fetcher.SiteFetcher(connect, args.max_in_flight)
+
+    rescaling_limits = intermediates.read_table(args.input_batch_file)
 
     rescaling_limits = rescaling_limits.merge(
         get_extrema_of_sites(
             df=rescaling_limits,
             client=tmaps_api,
             channel_name=args.channel,
-            plate_name=args.plate
+            plate_name=args.plate,
+            tracer=tracer,
+            fetcher=fetcher
         )
     )
+    if fetcher is not None:
+        fetcher.close()
+    new_client.close()
+    tracer.close()
 
-    rescaling_limits.to_pickle(args.output_file)
+    intermediates.write_table(rescaling_limits, args.output_file)
     return
 
 
-def get_site_dimensions(df, client, plate_name):
-    dimensions = pd.DataFrame()
-    for index, row in df.iterrows():
-        well = client.get_sites(plate_name=plate_name, well_name=row['well'])
-        max_x = 0
-        max_y = 0
-        for s in range(len(well)):
-            max_x = well[s]['x'] if well[s]['x'] > max_x else max_x
-            max_y = well[s]['y'] if well[s]['y'] > max_y else max_y
-
-        dimensions = dimensions.append(
-            pd.DataFrame({
-                'well': row['well'],
-                'n_site_x': int(max_x),
-                'n_site_y': int(max_y)
-            }, index=[index])
-        )
-    return dimensions
-
-
-def select_random_sites(df, n_sites):
-    selection = pd.DataFrame()
-    for index, row in df.iterrows():
-        all_sites = list(
-            itertools.product(
-                range(row['n_site_x']),
-                range(row['n_site_y'])
-            )
-        )
-        selected_sites_x = [all_sites[i][0] for i in list(
-            np.random.choice(len(all_sites), n_sites)
-        )]
-        selected_sites_y = [all_sites[i][1] for i in list(
-            np.random.choice(len(all_sites), n_sites)
-        )]
-        selection = selection.append(
-            pd.DataFrame({
-                'well': row['well'],
-                'site_x': selected_sites_x,
-                'site_y': selected_sites_y
-            })
-        )
-    return selection
-
-
-def get_extrema_of_sites(df, client, channel_name, plate_name, lower_percentile=1.0, upper_percentile=99.5):
-    extrema = pd.DataFrame()
-    for index, row in df.iterrows():
-        image = client.download_channel_image(
+def get_extrema_of_sites(df, client, channel_name, plate_name, lower_percentile=1.0, upper_percentile=99.5, tracer=instrumentation.NullTracer(), fetcher=None):
+    '''
+    Intensity limits and histogram of every site of ``df``, downloaded one
+    at a time with ``client`` or, with a ``site_fetcher.SiteFetcher``,
+    concurrently ahead of the site being analysed
+    '''
+    requests = (
+        dict(
             channel_name=channel_name,
             plate_name=plate_name,
             well_name=row['well'],
@@ -168,16 +139,43 @@ def get_extrema_of_sites(df, client, channel_name, plate_name, lower_percentile=
             well_pos_x=row['site_x'],
             correct=True
         )
-        extrema = extrema.append(
-            pd.DataFrame({
-                'well': row['well'],
-                'site_x': row['site_x'],
-                'site_y': row['site_y'],
-                'lower_limit': np.percentile(image, lower_percentile),
-                'upper_limit': np.percentile(image, upper_percentile)
-            }, index=[index])
+        for index, row in df.iterrows()
+    )
+    if fetcher is None:
+        images = (
+            client.download_channel_image(**request) for request in requests
+        )
+    else:
+        images = fetcher.images(requests)
+    extrema = ResultBuilder([
+        ('well', object),
+        ('site_x', np.int64),
+        ('site_y', np.int64),
+        ('lower_limit', np.float64),
+        ('upper_limit', np.float64),
+        ('histogram_offset', np.int64),
+        ('histogram', object)
+    ])
+    for index, row in df.iterrows():
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('download'):
+            image = next(images)
+        with trace.phase('histogram'):
+            offset, counts = histogram_percentile.histogram(image)
+            lower_limit, upper_limit = histogram_percentile.percentiles(
+                offset, counts, [lower_percentile, upper_percentile]
+            )
+        extrema.append(
+            well=row['well'],
+            site_x=row['site_x'],
+            site_y=row['site_y'],
+            lower_limit=lower_limit,
+            upper_limit=upper_limit,
+            histogram_offset=offset,
+            histogram=counts
         )
-    return extrema
+        tracer.write(row['well'], row['site_y'], row['site_x'])
+    return extrema.to_frame()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,19 @@
-import matlab.engine
-import pandas as pd
 import numpy as np
-from tmclient import TmClient
+import async_tmclient
+import image_cache
+import instrumentation
+import site_pipeline
+import site_queue
+import results_log
+import histogram_percentile
+import intermediates
+from result_builder import ResultBuilder
 import argparse
+import os
+import spot_detection
+import matlab_transfer
+import matlab_pool
+from detection_parameters import FILTER_ARGS, IMG_LIMES, rescaling_thresholds
 
 
 def parse_arguments():
@@ -10,9 +21,9 @@ def parse_arguments():
         prog='get_spot_count_threshold_series',
         description=('Uses ObjByFilter.m to detect spots for a series of'
                      'thresholds. Images analysed are taken from the '
-                     'input csv file which is generated by '
+                     'input table which is generated by '
                      'get_intensity_extrema.py. Writes results as a '
-                     'csv file.')
+                     'table.')
     )
     parser.add_argument(
         '-v', '--verbosity', action='count', default=0,
@@ -47,16 +58,31 @@ def parse_arguments():
         help='channel name'
     )
     parser.add_argument(
-        '--input_batch_file', type=str, required=True,
-        help='filename for batch input file (.pkl)'
+        '--input_batch_file', type=str, default=None,
+        help='filename for batch input file (.arrow)'
+    )
+    parser.add_argument(
+        '--site_queue', type=str, default=None,
+        help=('queue written by site_queue.py to claim sites from until it '
+              'is empty, instead of reading them from --input_batch_file')
+    )
+    parser.add_argument(
+        '--worker_id', type=str, default=None,
+        help='name of this job in the site queue (default: host and pid)'
+    )
+    parser.add_argument(
+        '--results_log', type=str, default=None,
+        help=('log the results of each site are appended to, so that a '
+              'restarted job skips the sites done before (default: output '
+              'file with extension .log)')
     )
     parser.add_argument(
         '--input_aggregate_file', type=str, required=True,
-        help='filename for the aggregated input file (.pkl)'
+        help='filename for the aggregated input file (.arrow)'
     )
     parser.add_argument(
         '-o', '--output_file', type=str, required=True,
-        help='filename for output file (.csv)'
+        help='filename for output file (.arrow)'
     )
     parser.add_argument(
         '-t', '--thresholds', default=[0.02, 0.04, 0.02],
@@ -68,8 +94,56 @@ def parse_arguments():
         nargs=4, type=float,
         help='specify hard rescaling thresholds (if required)'
     )
+    parser.add_argument(
+        '--backend', type=str, default='matlab',
+        choices=['matlab', 'matlab_pool', 'python'],
+        help='implementation of spot detection (default: matlab)'
+    )
+    parser.add_argument(
+        '--pool_address', type=str, default=matlab_pool.DEFAULT_ADDRESS,
+        help='socket of the MATLAB pool used by the matlab_pool backend'
+    )
+    parser.add_argument(
+        '--library_path', type=str,
+        default=matlab_pool.library_path('/data/homes/sberry/repositories/JtLibrary/src/matlab/'),
+        help=('JtLibrary directory added to the MATLAB path by the matlab '
+              'backend (default: ${0} or /data/homes/sberry/repositories/JtLibrary/src/matlab/)'
+              .format(matlab_pool.LIBRARY_PATH_VARIABLE))
+    )
+    parser.add_argument(
+        '--check_thresholds', type=int, default=0,
+        help=('number of thresholds per site whose spot count is computed '
+              'again on its own to check the series (default: 0)')
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='directory of an image cache shared between jobs (optional)'
+    )
+    parser.add_argument(
+        '--cache_size', type=float, default=50.0,
+        help='maximum size of the image cache in GB (default: 50)'
+    )
+    parser.add_argument(
+        '--prefetch_depth', type=int, default=2,
+        help=('number of sites downloaded ahead of the one being analysed '
+              '(default: 2)')
+    )
+    parser.add_argument(
+        '--trace', action='store_true',
+        help=('write the time, CPU time, downloaded bytes and peak memory '
+              'of each phase of every site next to the output file (see '
+              'instrumentation.py)')
+    )
+    parser.add_argument(
+        '--max_in_flight', type=int, default=None,
+        help=('download through one pooled asyncio client with this many '
+              'requests in flight (see async_tmclient.py, optional)')
+    )
 
-    return(parser.parse_args())
+    args = parser.parse_args()
+    if (args.input_batch_file is None) == (args.site_queue is None):
+        parser.error('give one of --input_batch_file or --site_queue')
+    return(args)
 
 
 def percentile(n):
@@ -81,97 +155,195 @@ def percentile(n):
 
 def main(args):
 
-    tmaps_api = TmClient(
+    tracer = instrumentation.tracer(
+        args.trace, args.output_file, 'spot_count'
+    )
+    new_client = async_tmclient.ClientFactory(
+        args.max_in_flight,
         host=args.host,
         port=args.port,
         experiment_name=args.experiment,
         username=args.username,
         password=args.password
     )
-
-    eng = matlab.engine.start_matlab()
-    eng.addpath('/data/homes/sberry/repositories/JtLibrary/src/matlab/', nargout=0)
+    tmaps_api = tracer.client(new_client())
+    tmaps_api = image_cache.cached_client(
+        tmaps_api, args.experiment, args.cache_dir, args.cache_size
+    )
 
     # read rescaling_limits and aggregate by control
-    rescaling_limits = pd.read_pickle(args.input_batch_file)
-    aggregated_limits = pd.read_pickle(args.input_aggregate_file)
+    # the intensity histograms of the sites are not part of the results
+    if args.site_queue is None:
+        rescaling_limits = intermediates.read_table(
+            args.input_batch_file,
+            columns=[
+                name for name in
+                intermediates.read_schema(args.input_batch_file).names
+                if name not in histogram_percentile.HISTOGRAM_COLUMNS
+            ]
+        )
+        site_rows = rescaling_limits.iterrows()
+    else:
+        queue = site_queue.SiteQueue(args.site_queue, args.worker_id)
+        site_rows = queue.claims()
+    aggregated_limits = intermediates.read_table(args.input_aggregate_file)
 
     # set options for ObjByFilter.mls
-    op = eng.cpsub.fspecialCP3D('2D LoG', 6.0)
     detection_thresholds = np.arange(
         args.thresholds[0],
         args.thresholds[1],
         args.thresholds[2])
-    iImgLimes = matlab.double([0.01, 0.995])
+    img_limes = IMG_LIMES
 
-    min_of_min = (
-        args.hard_rescaling[0] if args.hard_rescaling[0] != 0
-        else aggregated_limits.lower_limit.loc['negative']['percentile_10']
-    )
-    max_of_min = (
-        args.hard_rescaling[1] if args.hard_rescaling[1] != 0
-        else aggregated_limits.upper_limit.loc['negative']['percentile_80']
-    )
-    min_of_max = (
-        args.hard_rescaling[2] if args.hard_rescaling[2] != 0
-        else aggregated_limits.upper_limit.loc['positive']['percentile_40']
-    )
-    max_of_max = (
-        args.hard_rescaling[3] if args.hard_rescaling[3] != 0
-        else aggregated_limits.upper_limit.loc['positive']['percentile_80']
+    rescale_thr = rescaling_thresholds(aggregated_limits, args.hard_rescaling)
+    min_of_min, max_of_min, min_of_max, max_of_max = rescale_thr
+
+    if args.backend == 'matlab':
+        import matlab.engine
+        eng = matlab.engine.start_matlab()
+        eng.addpath(args.library_path, nargout=0)
+        eng.addpath(os.path.dirname(os.path.abspath(__file__)), nargout=0)
+
+        eng.eval(
+            "op = cpsub.fspecialCP3D('%s', %r);" % FILTER_ARGS, nargout=0
+        )
+        eng.workspace['iImgLimes'] = matlab.double(img_limes)
+        eng.workspace['iRescaleThr'] = matlab.double(rescale_thr)
+    elif args.backend == 'matlab_pool':
+        pool = matlab_pool.MatlabPool(args.pool_address)
+        op = FILTER_ARGS
+    else:
+        op = spot_detection.fspecial_cp3d(*FILTER_ARGS)
+
+    # the sites analysed by an earlier run of this job are in its log,
+    # unless that run detected spots with other parameters
+    log = results_log.ResultsLog(
+        args.results_log or os.path.splitext(args.output_file)[0] + '.log',
+        parameters=dict(
+            experiment=args.experiment,
+            plate=args.plate,
+            channel=args.channel,
+            filter=FILTER_ARGS,
+            img_limes=img_limes,
+            rescale_thr=rescale_thr
+        )
     )
+    done = log.done(['well', 'site_x', 'site_y'], 'threshold')
 
-    iRescaleThr = matlab.double([
-        min_of_min, max_of_min, min_of_max, max_of_max
-    ])
+    def thresholds_left(row):
+        key = (row['well'], int(row['site_x']), int(row['site_y']))
+        return results_log.remaining(done, key, detection_thresholds)
 
-    iObjIntensityThr = matlab.uint16([])
-    DetectionBias = matlab.uint16([])
+    def pending(site_rows):
+        for index, row in site_rows:
+            thresholds = thresholds_left(row)
+            if len(thresholds) > 0:
+                yield index, row, thresholds
+            elif args.site_queue is not None:
+                queue.complete([index])
 
-    spot_count = pd.DataFrame()
-    for index, row in rescaling_limits.iterrows():
+    if args.site_queue is not None:
+        queue.recover(lambda row: len(thresholds_left(row)) == 0)
 
-        image = tmaps_api.download_channel_image(
-            channel_name=args.channel,
-            plate_name=args.plate,
-            well_name=row['well'],
-            well_pos_y=row['site_y'],
-            well_pos_x=row['site_x'],
-            correct=True
-        )
+    def download(site):
+        index, row, thresholds = site
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('download'):
+            return tmaps_api.download_channel_image(
+                channel_name=args.channel,
+                plate_name=args.plate,
+                well_name=row['well'],
+                well_pos_y=row['site_y'],
+                well_pos_x=row['site_x'],
+                correct=True
+            )
+
+    spot_count = ResultBuilder([
+        ('rescaling_limit_1', np.float64),
+        ('rescaling_limit_2', np.float64),
+        ('rescaling_limit_3', np.float64),
+        ('rescaling_limit_4', np.float64),
+        ('threshold', np.float64),
+        ('well', object),
+        ('site_x', np.int64),
+        ('site_y', np.int64),
+        ('spot_count', np.int64)
+    ])
+    sites_downloaded = site_pipeline.prefetch(
+        download, pending(site_rows),
+        site_pipeline.max_in_flight(args.prefetch_depth)
+    )
+    for (index, row, thresholds), image in sites_downloaded:
 
-        image_matlab = matlab.double(image.tolist())
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        if args.backend == 'matlab':
 
-        for threshold in np.nditer(detection_thresholds):
+            with trace.phase('transfer'):
+                matlab_transfer.put_array(eng, 'image', image)
+                # a restarted job only runs the thresholds not yet logged
+                eng.workspace['thresholds'] = matlab.double(
+                    thresholds.tolist()
+                )
 
-            '''Note: second returned argument from ObjByFilter.m
-            is matlab CC object (as a python dict) which stores the
-            NumObjects attribute. This is the calculated spot count
+            '''Note: ObjByFilterSeries.m rescales and filters the image
+            once and returns the spot count (NumObjects of the CC object
+            from ObjByFilter.m) for every threshold.
             '''
 
-            t = eng.cpsub.ObjByFilter(
-                image_matlab, op, float(threshold), iImgLimes, iRescaleThr,
-                iObjIntensityThr, True, [], DetectionBias, nargout=3
-            )
+            with trace.phase('detection'):
+                eng.eval(
+                    "ObjCounts = ObjByFilterSeries(" +
+                    "double(image), op, thresholds, iImgLimes, " +
+                    "iRescaleThr, [], true, [], [], %d);" %
+                    args.check_thresholds,
+                    nargout=0
+                )
+                counts = np.asarray(eng.workspace['ObjCounts']).ravel()
+        elif args.backend == 'matlab_pool':
+            with trace.phase('detection'):
+                counts = pool.count_spots(
+                    image, op, thresholds, img_limes, rescale_thr,
+                    close_holes=True, check_thresholds=args.check_thresholds
+                )
+        else:
+            with trace.phase('detection'):
+                counts = spot_detection.count_spots(
+                    image, op, thresholds, img_limes, rescale_thr,
+                    close_holes=True, check_thresholds=args.check_thresholds
+                )
 
-            spot_count = spot_count.append(
-                pd.DataFrame({
-                    'rescaling_limit_1': min_of_min,
-                    'rescaling_limit_2': max_of_min,
-                    'rescaling_limit_3': min_of_max,
-                    'rescaling_limit_4': max_of_max,
-                    'threshold': threshold,
-                    'well': row['well'],
-                    'site_x': row['site_x'],
-                    'site_y': row['site_y'],
-                    'spot_count': int(t[1]['NumObjects'])
-                }, index=[index])
-            )
+        log.append(
+            rescaling_limit_1=min_of_min,
+            rescaling_limit_2=max_of_min,
+            rescaling_limit_3=min_of_max,
+            rescaling_limit_4=max_of_max,
+            threshold=thresholds,
+            well=row['well'],
+            site_x=row['site_x'],
+            site_y=row['site_y'],
+            spot_count=counts
+        )
+        if args.site_queue is not None:
+            queue.complete([index])
+        tracer.write(row['well'], row['site_y'], row['site_x'])
+
+    new_client.close()
+    tracer.close()
+
+    for values in results_log.select(
+            log.records(), 'threshold', detection_thresholds):
+        spot_count.extend(**values)
+    log.close()
 
-    spot_count = rescaling_limits.merge(spot_count)
-    spot_count.to_csv(args.output_file, encoding='utf-8', index=False)
+    if args.site_queue is not None:
+        rescaling_limits = queue.sites(queue.completed())
+    spot_count = rescaling_limits.merge(spot_count.to_frame())
+    intermediates.write_table(spot_count, args.output_file)
 
-    eng.quit()
+    if args.backend == 'matlab':
+        eng.quit()
+    elif args.backend == 'matlab_pool':
+        pool.close()
 
     return
 
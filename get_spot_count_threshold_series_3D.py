@@ -1,8 +1,21 @@
-import matlab.engine
-import pandas as pd
 import numpy as np
-from tmclient import TmClient
+import async_tmclient
+import image_cache
+import instrumentation
+import intermediates
+import metadata_index
+import site_fetcher
+import site_pipeline
+import site_queue
+import results_log
+import segmentation
+import zstack_store
+from result_builder import ResultBuilder
 import argparse
+import os
+import spot_detection
+import matlab_transfer
+import matlab_pool
 
 
 def parse_arguments():
@@ -10,9 +23,9 @@ def parse_arguments():
         prog='get_spot_count_threshold_series',
         description=('Uses ObjByFilter.m to detect spots for a series of'
                      'thresholds. Images analysed are taken from the '
-                     'input csv file which is generated by '
+                     'input table which is generated by '
                      'get_intensity_extrema.py. Writes results as a '
-                     'csv file.')
+                     'table.')
     )
     parser.add_argument(
         '-v', '--verbosity', action='count', default=0,
@@ -43,12 +56,32 @@ def parse_arguments():
         help='plate name'
     )
     parser.add_argument(
-        '--input_batch_file', type=str, required=True,
-        help='filename for batch input file (.pkl)'
+        '--input_batch_file', type=str, default=None,
+        help='filename for batch input file (.arrow)'
+    )
+    parser.add_argument(
+        '--site_queue', type=str, default=None,
+        help=('queue written by site_queue.py to claim sites from until it '
+              'is empty, instead of reading them from --input_batch_file')
+    )
+    parser.add_argument(
+        '--worker_id', type=str, default=None,
+        help='name of this job in the site queue (default: host and pid)'
+    )
+    parser.add_argument(
+        '--results_log', type=str, default=None,
+        help=('log the results of each site are appended to, so that a '
+              'restarted job skips the sites done before (default: output '
+              'file with extension .log)')
     )
     parser.add_argument(
         '-o', '--output_file', type=str, required=True,
-        help='filename for output file (.csv)'
+        help='filename for output file (.arrow)'
+    )
+    parser.add_argument(
+        '--metadata_index', type=str, default=None,
+        help=('directory written by metadata_index.py (default: fetch the '
+              'metadata from TissueMAPS)')
     )
     parser.add_argument(
         '-t', '--thresholds', default=[0.02, 0.04, 0.02],
@@ -60,8 +93,89 @@ def parse_arguments():
         nargs=4, type=float,
         help='specify hard rescaling thresholds'
     )
+    parser.add_argument(
+        '--backend', type=str, default='matlab',
+        choices=['matlab', 'matlab_pool', 'python'],
+        help='implementation of spot detection (default: matlab)'
+    )
+    parser.add_argument(
+        '--pool_address', type=str, default=matlab_pool.DEFAULT_ADDRESS,
+        help='socket of the MATLAB pool used by the matlab_pool backend'
+    )
+    parser.add_argument(
+        '--library_path', type=str,
+        default=matlab_pool.library_path('~/repositories/JtLibrary/matlab/jtlibrary/'),
+        help=('JtLibrary directory added to the MATLAB path by the matlab '
+              'backend (default: ${0} or ~/repositories/JtLibrary/matlab/jtlibrary/)'
+              .format(matlab_pool.LIBRARY_PATH_VARIABLE))
+    )
+    parser.add_argument(
+        '--check_thresholds', type=int, default=0,
+        help=('number of thresholds per site whose spot count is computed '
+              'again on its own to check the series (default: 0)')
+    )
+    parser.add_argument(
+        '--max_memory', type=float, default=None,
+        help=('maximum memory in GB for the spot detection on the stack of '
+              'a site besides the stack itself, which is then filtered in '
+              'XY tiles (python backend, optional)')
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='directory of an image cache shared between jobs (optional)'
+    )
+    parser.add_argument(
+        '--cache_size', type=float, default=50.0,
+        help='maximum size of the image cache in GB (default: 50)'
+    )
+    parser.add_argument(
+        '--label_cache_dir', type=str, default=None,
+        help=('directory of a cache of the cell label images of the sites, '
+              'which reruns read instead of segmenting again (optional)')
+    )
+    parser.add_argument(
+        '--zstack_store', type=str, default=None,
+        help=('directory of a local store of the FISH stacks of the sites, '
+              'which reruns map from disk instead of downloading (optional)')
+    )
+    parser.add_argument(
+        '--zstack_compress', action='store_true',
+        help='store the stacks compressed, read into memory in full'
+    )
+    parser.add_argument(
+        '--download_threads', type=int, default=8,
+        help='number of images of a site downloaded in parallel (default: 8)'
+    )
+    parser.add_argument(
+        '--prefetch_depth', type=int, default=2,
+        help=('number of sites downloaded ahead of the one being analysed '
+              '(default: 2)')
+    )
+    parser.add_argument(
+        '--prefetch_memory', type=float, default=None,
+        help=('maximum memory in GB for the images of sites held at a time, '
+              'limits the prefetch depth (optional)')
+    )
+    parser.add_argument(
+        '--trace', action='store_true',
+        help=('write the time, CPU time, downloaded bytes and peak memory '
+              'of each phase of every site next to the output file (see '
+              'instrumentation.py)')
+    )
+    parser.add_argument(
+        '--max_in_flight', type=int, default=None,
+        help=('download through one pooled asyncio client with this many '
+              'requests in flight (see async_tmclient.py, optional)')
+    )
 
-    return(parser.parse_args())
+    args = parser.parse_args()
+    if (args.input_batch_file is None) == (args.site_queue is None):
+        parser.error('give one of --input_batch_file or --site_queue')
+    if args.max_memory is not None and args.backend != 'python':
+        parser.error('--max_memory needs the python backend')
+    if args.max_memory is not None and args.check_thresholds > 0:
+        parser.error('--check_thresholds does not apply to tiled detection')
+    return(args)
 
 
 def percentile(n):
@@ -71,41 +185,14 @@ def percentile(n):
     return percentile_
 
 
-def segment_cells(dapi,se):
-    from jtmodules import smooth, fill, filter, threshold_manual, label, register_objects, segment_secondary
+def main(args):
 
-    dapi_smooth = smooth.main(dapi, 'gaussian', 3,plot=False)
-    nuclei = threshold_manual.main(
-        image=dapi_smooth.smoothed_image,
-        threshold=115
-    )
-    nuclei = fill.main(nuclei.mask, plot=False)
-    nuclei = filter.main(
-        mask=nuclei.filled_mask,
-        feature='area',
-        lower_threshold=2000,
-        upper_threshold=None,
-        plot=False
-    )
-    nuclei = label.main(
-        mask=nuclei.filtered_mask
+    tracer = instrumentation.tracer(
+        args.trace, args.output_file, 'spot_count_3D'
     )
-    nuclei = register_objects.main(
-        nuclei.label_image
-    )
-    se_smooth = smooth.main(se, 'bilateral', 7)
-    cells = segment_secondary.main(
-        nuclei.objects,se_smooth.smoothed_image,
-        contrast_threshold=3,
-        min_threshold=116,
-        max_threshold=120)
-
-    return cells.secondary_label_image
 
-
-def main(args):
-
-    tmaps_api = TmClient(
+    new_client = async_tmclient.ClientFactory(
+        args.max_in_flight,
         host=args.host,
         port=args.port,
         experiment_name=args.experiment,
@@ -113,115 +200,242 @@ def main(args):
         password=args.password
     )
 
-    eng = matlab.engine.start_matlab()
-    eng.addpath('~/repositories/JtLibrary/matlab/jtlibrary/', nargout=0)
+    def connect():
+        return image_cache.cached_client(
+            tracer.client(new_client()), args.experiment, args.cache_dir,
+            args.cache_size
+        )
+
+    tmaps_api = connect()
+    # every download thread keeps its own client and connection, or they
+    # all share the pooled client
+    fetcher = zstack_store.stored_fetcher(
+        site_fetcher.SiteFetcher(connect, args.download_threads),
+        args.experiment, args.zstack_store, args.zstack_compress
+    )
+    label_cache = None
+    if args.label_cache_dir is not None:
+        label_cache = segmentation.LabelCache(
+            args.label_cache_dir, args.experiment
+        )
 
     # read rescaling_limits and aggregate by control
-    selected_sites = pd.read_pickle(args.input_batch_file)
+    if args.site_queue is None:
+        selected_sites = intermediates.read_table(args.input_batch_file)
+        site_rows = selected_sites.iterrows()
+    else:
+        queue = site_queue.SiteQueue(args.site_queue, args.worker_id)
+        site_rows = queue.claims()
 
     # set options for ObjByFilter
-    op = eng.cpsub.fspecialCP3D('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
     detection_thresholds = np.arange(
         args.thresholds[0],
         args.thresholds[1],
         args.thresholds[2])
-    iImgLimes = matlab.double([0.01, 0.995])
+    img_limes = [0.01, 0.995]
 
     min_of_min = args.hard_rescaling[0]
     max_of_min = args.hard_rescaling[1]
     min_of_max = args.hard_rescaling[2]
     max_of_max = args.hard_rescaling[3]
 
-    iRescaleThr = matlab.double([
-        min_of_min, max_of_min, min_of_max, max_of_max
-    ])
-
-    iObjIntensityThr = matlab.uint16([])
-    DetectionBias = matlab.uint16([])
-
-    channels = tmaps_api.get_channels()
-    sites = tmaps_api.get_sites()
-    z_depth = len(channels[0]['layers'])
-
-    spot_count = pd.DataFrame()
-    for index, row in selected_sites.iterrows():
-
-        dapi = tmaps_api.download_channel_image(
-            channel_name='DAPI',
-            plate_name=args.plate,
-            well_name=row['well'],
-            well_pos_y=row['site_y'],
-            well_pos_x=row['site_x'],
-            correct=False
-        )
-
-        se = tmaps_api.download_channel_image(
-            channel_name='SE',
-            plate_name=args.plate,
-            well_name=row['well'],
-            well_pos_y=row['site_y'],
-            well_pos_x=row['site_x'],
-            correct=False
+    rescale_thr = [min_of_min, max_of_min, min_of_max, max_of_max]
+
+    if args.backend == 'matlab':
+        import matlab.engine
+        eng = matlab.engine.start_matlab()
+        eng.addpath(args.library_path, nargout=0)
+        eng.addpath(os.path.dirname(os.path.abspath(__file__)), nargout=0)
+
+        eng.eval("op = cpsub.fspecialCP3D('3D LoG, Raj', 5.0, 4.0 / 3, 5.0);", nargout=0)
+        eng.workspace['iImgLimes'] = matlab.double(img_limes)
+        eng.workspace['iRescaleThr'] = matlab.double(rescale_thr)
+    elif args.backend == 'matlab_pool':
+        pool = matlab_pool.MatlabPool(args.pool_address)
+        op = ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+    else:
+        op = spot_detection.fspecial_cp3d('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+
+    sites, channels = metadata_index.load(args.metadata_index, tmaps_api)
+    z_depth = metadata_index.n_zplanes(channels, 'FISH')
+
+    stack_shape = metadata_index.image_shape(sites) + (z_depth,)
+
+    # the sites analysed by an earlier run of this job are in its log,
+    # unless that run detected spots with other parameters
+    log = results_log.ResultsLog(
+        args.results_log or os.path.splitext(args.output_file)[0] + '.log',
+        parameters=dict(
+            experiment=args.experiment,
+            plate=args.plate,
+            filter=('3D LoG, Raj', 5.0, 4.0 / 3, 5.0),
+            img_limes=img_limes,
+            rescale_thr=rescale_thr
         )
-
-        cells = segment_cells(dapi, se)
-        n_cells = np.max(cells)
-
-        fish3D = np.zeros(
-            (sites[0]['height'],sites[0]['width'],z_depth),
-            dtype=np.uint16
-        )
-
-        for z in range(0,z_depth):
-            fish = tmaps_api.download_channel_image(
-                channel_name='FISH',
+    )
+    done = log.done(['well', 'site_x', 'site_y'], 'threshold')
+
+    def thresholds_left(row):
+        key = (row['well'], int(row['site_x']), int(row['site_y']))
+        return results_log.remaining(done, key, detection_thresholds)
+
+    def pending(site_rows):
+        for index, row in site_rows:
+            thresholds = thresholds_left(row)
+            if len(thresholds) > 0:
+                yield index, row, thresholds
+            elif args.site_queue is not None:
+                queue.complete([index])
+
+    if args.site_queue is not None:
+        queue.recover(lambda row: len(thresholds_left(row)) == 0)
+
+    def download(site):
+        index, row, thresholds = site
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('download'):
+            # DAPI and SE are only needed if the cells are not in the cache
+            cells = None
+            if label_cache is not None:
+                cells = label_cache.get(
+                    args.plate, row['well'], row['site_y'], row['site_x']
+                )
+            images, fish3D = fetcher.fetch_site(
                 plate_name=args.plate,
                 well_name=row['well'],
                 well_pos_y=row['site_y'],
                 well_pos_x=row['site_x'],
-                correct=False,
-                zplane=z
+                channels=['DAPI', 'SE'] if cells is None else [],
+                stack_channel='FISH',
+                stack_shape=stack_shape
             )
-            fish[cells == 0] = 0
-            fish3D[:,:,z] = fish
-
-        fish_matlab = matlab.double(fish3D.tolist())
-
-        for threshold in np.nditer(detection_thresholds):
+        return cells, images, fish3D
+
+    # FISH stack plus the DAPI and SE images, all uint16
+    site_bytes = 2 * stack_shape[0] * stack_shape[1] * (stack_shape[2] + 2)
+    in_flight = site_pipeline.max_in_flight(
+        args.prefetch_depth, site_bytes,
+        None if args.prefetch_memory is None
+        else args.prefetch_memory * image_cache.GB
+    )
 
-            '''Note: second returned argument from ObjByFilter.m
-            is matlab CC object (as a python dict) which stores the
-            NumObjects attribute. This is the calculated spot count
+    spot_count = ResultBuilder([
+        ('rescaling_limit_1', np.float64),
+        ('rescaling_limit_2', np.float64),
+        ('rescaling_limit_3', np.float64),
+        ('rescaling_limit_4', np.float64),
+        ('threshold', np.float64),
+        ('well', object),
+        ('site_x', np.int64),
+        ('site_y', np.int64),
+        ('mean_spot_count_per_cell', np.float64)
+    ])
+    sites_downloaded = site_pipeline.prefetch(
+        download, pending(site_rows), in_flight
+    )
+    for (index, row, thresholds), (cells, images, fish3D) in sites_downloaded:
+
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('segmentation'):
+            if cells is None:
+                cells = segmentation.segment_cells(
+                    images['DAPI'], images['SE']
+                )
+                if label_cache is not None:
+                    label_cache.put(
+                        args.plate, row['well'], row['site_y'],
+                        row['site_x'], cells
+                    )
+            n_cells = np.max(cells)
+            # tiled detection masks each tile rather than the whole stack,
+            # which may be mapped from the store
+            mask = None
+            if args.max_memory is None:
+                fish3D[cells == 0] = 0
+            else:
+                mask = cells != 0
+
+        if args.backend == 'matlab':
+
+            with trace.phase('transfer'):
+                matlab_transfer.put_array(eng, 'fish3D', fish3D)
+                # a restarted job only runs the thresholds not yet logged
+                eng.workspace['thresholds'] = matlab.double(
+                    thresholds.tolist()
+                )
+
+            '''Note: ObjByFilterSeries.m rescales and filters the image
+            once and returns the spot count (NumObjects of the CC object
+            from ObjByFilter.m) for every threshold.
             '''
 
-            t = eng.cpsub.ObjByFilter(
-                fish_matlab, op, float(threshold), iImgLimes, iRescaleThr,
-                iObjIntensityThr, False, [], DetectionBias, nargout=3
-            )
-
-            spots_per_cell = (
-                t[1]['NumObjects'] / float(n_cells) if n_cells > 0
-                else 0.0
-            )
-
-            spot_count = spot_count.append(
-                pd.DataFrame({
-                    'rescaling_limit_1': min_of_min,
-                    'rescaling_limit_2': max_of_min,
-                    'rescaling_limit_3': min_of_max,
-                    'rescaling_limit_4': max_of_max,
-                    'threshold': threshold,
-                    'well': row['well'],
-                    'site_x': row['site_x'],
-                    'site_y': row['site_y'],
-                    'mean_spot_count_per_cell': spots_per_cell
-                }, index=[index])
-            )
-
-    spot_count = selected_sites.merge(spot_count)
-    spot_count.to_csv(args.output_file, encoding='utf-8', index=False)
+            with trace.phase('detection'):
+                eng.eval(
+                    "ObjCounts = ObjByFilterSeries(" +
+                    "double(fish3D), op, thresholds, iImgLimes, " +
+                    "iRescaleThr, [], false, [], [], %d);" %
+                    args.check_thresholds,
+                    nargout=0
+                )
+                counts = np.asarray(eng.workspace['ObjCounts']).ravel()
+        elif args.backend == 'matlab_pool':
+            with trace.phase('detection'):
+                counts = pool.count_spots(
+                    fish3D, op, thresholds, img_limes, rescale_thr,
+                    check_thresholds=args.check_thresholds
+                )
+        elif args.max_memory is None:
+            with trace.phase('detection'):
+                counts = spot_detection.count_spots(
+                    fish3D, op, thresholds, img_limes, rescale_thr,
+                    check_thresholds=args.check_thresholds
+                )
+        else:
+            with trace.phase('detection'):
+                counts = spot_detection.count_spots_tiled(
+                    fish3D, op, thresholds, img_limes, rescale_thr,
+                    args.max_memory * image_cache.GB, mask=mask,
+                    background=0
+                )
+
+        spots_per_cell = (
+            np.asarray(counts) / float(n_cells) if n_cells > 0
+            else 0.0
+        )
 
-    eng.quit()
+        log.append(
+            rescaling_limit_1=min_of_min,
+            rescaling_limit_2=max_of_min,
+            rescaling_limit_3=min_of_max,
+            rescaling_limit_4=max_of_max,
+            threshold=thresholds,
+            well=row['well'],
+            site_x=row['site_x'],
+            site_y=row['site_y'],
+            mean_spot_count_per_cell=spots_per_cell
+        )
+        if args.site_queue is not None:
+            queue.complete([index])
+        tracer.write(row['well'], row['site_y'], row['site_x'])
+
+    fetcher.close()
+    new_client.close()
+    tracer.close()
+
+    for values in results_log.select(
+            log.records(), 'threshold', detection_thresholds):
+        spot_count.extend(**values)
+    log.close()
+
+    if args.site_queue is not None:
+        selected_sites = queue.sites(queue.completed())
+    spot_count = selected_sites.merge(spot_count.to_frame())
+    intermediates.write_table(spot_count, args.output_file)
+
+    if args.backend == 'matlab':
+        eng.quit()
+    elif args.backend == 'matlab_pool':
+        pool.close()
 
     return
 
@@ -1,9 +1,22 @@
 from __future__ import print_function, absolute_import
-import matlab_wrapper
-import pandas as pd
 import numpy as np
-from tmclient import TmClient
+import async_tmclient
+import image_cache
+import instrumentation
+import intermediates
+import metadata_index
+import site_fetcher
+import site_pipeline
+import site_queue
+import results_log
+import segmentation
+import zstack_store
+from result_builder import ResultBuilder
 import argparse
+import os
+import spot_detection
+import matlab_pool
+from threshold_sweep import count_objects_series, count_objects_sparse
 
 
 def parse_arguments():
@@ -11,9 +24,9 @@ def parse_arguments():
         prog='get_spot_count_threshold_series',
         description=('Uses ObjByFilter.m to detect spots for a series of'
                      'thresholds. Images analysed are taken from the '
-                     'input csv file which is generated by '
+                     'input table which is generated by '
                      'get_intensity_extrema.py. Writes results as a '
-                     'csv file.')
+                     'table.')
     )
     parser.add_argument(
         '-v', '--verbosity', action='count', default=0,
@@ -44,12 +57,32 @@ def parse_arguments():
         help='plate name'
     )
     parser.add_argument(
-        '--input_batch_file', type=str, required=True,
-        help='filename for batch input file (.pkl)'
+        '--input_batch_file', type=str, default=None,
+        help='filename for batch input file (.arrow)'
+    )
+    parser.add_argument(
+        '--site_queue', type=str, default=None,
+        help=('queue written by site_queue.py to claim sites from until it '
+              'is empty, instead of reading them from --input_batch_file')
+    )
+    parser.add_argument(
+        '--worker_id', type=str, default=None,
+        help='name of this job in the site queue (default: host and pid)'
+    )
+    parser.add_argument(
+        '--results_log', type=str, default=None,
+        help=('log the results of each site are appended to, so that a '
+              'restarted job skips the sites done before (default: output '
+              'file with extension .log)')
     )
     parser.add_argument(
         '-o', '--output_file', type=str, required=True,
-        help='filename for output file (.csv)'
+        help='filename for output file (.arrow)'
+    )
+    parser.add_argument(
+        '--metadata_index', type=str, default=None,
+        help=('directory written by metadata_index.py (default: fetch the '
+              'metadata from TissueMAPS)')
     )
     parser.add_argument(
         '-t', '--thresholds', default=[0.02, 0.04, 0.02],
@@ -58,15 +91,99 @@ def parse_arguments():
     )
     parser.add_argument(
         '--hard_rescaling', default=[120.0, 120.0, 500.0, 500.0],
-        nargs=4, type=float,
-        help='specify hard rescaling thresholds'
+        nargs='+', type=float,
+        help=('specify hard rescaling thresholds, several sets of four to '
+              'sweep them')
+    )
+    parser.add_argument(
+        '--filter_size', default=[5.0], nargs='+', type=float,
+        help='specify size for LoG filter, several to sweep them'
+    )
+    parser.add_argument(
+        '--backend', type=str, default='matlab',
+        choices=['matlab', 'matlab_pool', 'python'],
+        help='implementation of spot detection (default: matlab)'
+    )
+    parser.add_argument(
+        '--pool_address', type=str, default=matlab_pool.DEFAULT_ADDRESS,
+        help='socket of the MATLAB pool used by the matlab_pool backend'
+    )
+    parser.add_argument(
+        '--library_path', type=str,
+        default=matlab_pool.library_path('~/repositories/JtLibrary/matlab/jtlibrary/'),
+        help=('JtLibrary directory added to the MATLAB path by the matlab '
+              'backend (default: ${0} or ~/repositories/JtLibrary/matlab/jtlibrary/)'
+              .format(matlab_pool.LIBRARY_PATH_VARIABLE))
+    )
+    parser.add_argument(
+        '--check_thresholds', type=int, default=0,
+        help=('number of thresholds per site whose spot count is computed '
+              'again on its own to check the series (default: 0)')
+    )
+    parser.add_argument(
+        '--max_memory', type=float, default=None,
+        help=('maximum memory in GB for the spot detection on the stack of '
+              'a site besides the stack itself, which is then filtered in '
+              'XY tiles (python backend, optional)')
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='directory of an image cache shared between jobs (optional)'
+    )
+    parser.add_argument(
+        '--cache_size', type=float, default=50.0,
+        help='maximum size of the image cache in GB (default: 50)'
+    )
+    parser.add_argument(
+        '--label_cache_dir', type=str, default=None,
+        help=('directory of a cache of the cell label images of the sites, '
+              'which reruns read instead of segmenting again (optional)')
+    )
+    parser.add_argument(
+        '--zstack_store', type=str, default=None,
+        help=('directory of a local store of the FISH stacks of the sites, '
+              'which reruns map from disk instead of downloading (optional)')
+    )
+    parser.add_argument(
+        '--zstack_compress', action='store_true',
+        help='store the stacks compressed, read into memory in full'
+    )
+    parser.add_argument(
+        '--download_threads', type=int, default=8,
+        help='number of images of a site downloaded in parallel (default: 8)'
+    )
+    parser.add_argument(
+        '--prefetch_depth', type=int, default=2,
+        help=('number of sites downloaded ahead of the one being analysed '
+              '(default: 2)')
+    )
+    parser.add_argument(
+        '--prefetch_memory', type=float, default=None,
+        help=('maximum memory in GB for the images of sites held at a time, '
+              'limits the prefetch depth (optional)')
     )
     parser.add_argument(
-        '--filter_size', default=5.0, type=float,
-        help='specify size for LoG filter'
+        '--trace', action='store_true',
+        help=('write the time, CPU time, downloaded bytes and peak memory '
+              'of each phase of every site next to the output file (see '
+              'instrumentation.py)')
+    )
+    parser.add_argument(
+        '--max_in_flight', type=int, default=None,
+        help=('download through one pooled asyncio client with this many '
+              'requests in flight (see async_tmclient.py, optional)')
     )
 
-    return(parser.parse_args())
+    args = parser.parse_args()
+    if (args.input_batch_file is None) == (args.site_queue is None):
+        parser.error('give one of --input_batch_file or --site_queue')
+    if args.max_memory is not None and args.backend != 'python':
+        parser.error('--max_memory needs the python backend')
+    if args.max_memory is not None and args.check_thresholds > 0:
+        parser.error('--check_thresholds does not apply to tiled detection')
+    if len(args.hard_rescaling) % 4 != 0:
+        parser.error('--hard_rescaling takes sets of four thresholds')
+    return(args)
 
 
 def percentile(n):
@@ -76,41 +193,14 @@ def percentile(n):
     return percentile_
 
 
-def segment_cells(dapi,se):
-    from jtmodules import smooth, fill, filter, threshold_manual, label, register_objects, segment_secondary
+def main(args):
 
-    dapi_smooth = smooth.main(dapi, 'gaussian', 3,plot=False)
-    nuclei = threshold_manual.main(
-        image=dapi_smooth.smoothed_image,
-        threshold=115
-    )
-    nuclei = fill.main(nuclei.mask, plot=False)
-    nuclei = filter.main(
-        mask=nuclei.filled_mask,
-        feature='area',
-        lower_threshold=2000,
-        upper_threshold=None,
-        plot=False
-    )
-    nuclei = label.main(
-        mask=nuclei.filtered_mask
+    tracer = instrumentation.tracer(
+        args.trace, args.output_file, 'spot_count_3D_mw'
     )
-    nuclei = register_objects.main(
-        nuclei.label_image
-    )
-    se_smooth = smooth.main(se, 'bilateral', 7)
-    cells = segment_secondary.main(
-        nuclei.objects,se_smooth.smoothed_image,
-        contrast_threshold=3,
-        min_threshold=116,
-        max_threshold=120)
-
-    return cells.secondary_label_image
-
 
-def main(args):
-
-    tmaps_api = TmClient(
+    new_client = async_tmclient.ClientFactory(
+        args.max_in_flight,
         host=args.host,
         port=args.port,
         experiment_name=args.experiment,
@@ -118,111 +208,317 @@ def main(args):
         password=args.password
     )
 
-    matlab = matlab_wrapper.MatlabSession(
-        options='-nosplash -singleCompThread -nojvm -nosoftwareopengl'
+    def connect():
+        return image_cache.cached_client(
+            tracer.client(new_client()), args.experiment, args.cache_dir,
+            args.cache_size
+        )
+
+    tmaps_api = connect()
+    # every download thread keeps its own client and connection, or they
+    # all share the pooled client
+    fetcher = zstack_store.stored_fetcher(
+        site_fetcher.SiteFetcher(connect, args.download_threads),
+        args.experiment, args.zstack_store, args.zstack_compress
     )
-    matlab.eval("addpath('~/repositories/JtLibrary/matlab/jtlibrary/')")
+    label_cache = None
+    if args.label_cache_dir is not None:
+        label_cache = segmentation.LabelCache(
+            args.label_cache_dir, args.experiment
+        )
 
     # read rescaling_limits and aggregate by control
-    selected_sites = pd.read_pickle(args.input_batch_file)
+    if args.site_queue is None:
+        selected_sites = intermediates.read_table(args.input_batch_file)
+        site_rows = selected_sites.iterrows()
+    else:
+        queue = site_queue.SiteQueue(args.site_queue, args.worker_id)
+        site_rows = queue.claims()
 
     # set options for ObjByFilter
-    matlab.workspace.filter_size = float(args.filter_size)
-    matlab.eval("op = cpsub.fspecialCP3D('3D LoG, Raj', double(filter_size), double(filter_size - 1.0)/3.0, 3.0);")
     detection_thresholds = np.arange(
         args.thresholds[0],
         args.thresholds[1],
         args.thresholds[2])
-    matlab.workspace.iImgLimes = [0.01, 0.995]
-
-    matlab.workspace.min_of_min = float(args.hard_rescaling[0])
-    matlab.workspace.max_of_min = float(args.hard_rescaling[1])
-    matlab.workspace.min_of_max = float(args.hard_rescaling[2])
-    matlab.workspace.max_of_max = float(args.hard_rescaling[3])
-
-    sites = tmaps_api.get_sites()
-    channels = tmaps_api.get_channels()
-    for channel in channels:
-        if channel['name'] == 'FISH':
-            z_depth = len(channel['layers'])
-
-    spot_count = pd.DataFrame()
-    for index, row in selected_sites.iterrows():
-
-        dapi = tmaps_api.download_channel_image(
-            channel_name='DAPI',
-            plate_name=args.plate,
-            well_name=row['well'],
-            well_pos_y=row['site_y'],
-            well_pos_x=row['site_x'],
-            correct=False
+    img_limes = [0.01, 0.995]
+    # every site is downloaded and segmented once for all combinations
+    rescalings = []
+    for i in range(0, len(args.hard_rescaling), 4):
+        rescaling = tuple(float(l) for l in args.hard_rescaling[i:i + 4])
+        if rescaling not in rescalings:
+            rescalings.append(rescaling)
+    filter_sizes = sorted(set(float(size) for size in args.filter_size))
+
+    def filter_args(filter_size):
+        return ('3D LoG, Raj', filter_size, (filter_size - 1.0) / 3.0, 3.0)
+
+    if args.backend == 'matlab':
+        import matlab_wrapper
+        matlab = matlab_wrapper.MatlabSession(
+            options='-nosplash -singleCompThread -nojvm -nosoftwareopengl'
         )
-
-        se = tmaps_api.download_channel_image(
-            channel_name='SE',
-            plate_name=args.plate,
-            well_name=row['well'],
-            well_pos_y=row['site_y'],
-            well_pos_x=row['site_x'],
-            correct=False
+        matlab.eval("addpath('{0}')".format(args.library_path))
+        matlab.eval("addpath('{0}')".format(
+            os.path.dirname(os.path.abspath(__file__))
+        ))
+
+        # op1, op2, ... in the workspace
+        ops = dict()
+        for filter_size in filter_sizes:
+            ops[filter_size] = 'op%d' % (len(ops) + 1)
+            matlab.workspace.filter_size = filter_size
+            matlab.eval("%s = cpsub.fspecialCP3D('3D LoG, Raj', double(filter_size), double(filter_size - 1.0)/3.0, 3.0);" % ops[filter_size])
+        matlab.workspace.iImgLimes = img_limes
+    elif args.backend == 'matlab_pool':
+        pool = matlab_pool.MatlabPool(args.pool_address)
+        ops = dict((size, filter_args(size)) for size in filter_sizes)
+    else:
+        ops = dict(
+            (size, spot_detection.fspecial_cp3d(*filter_args(size)))
+            for size in filter_sizes
         )
 
-        cells = segment_cells(dapi, se)
-        n_cells = np.max(cells)
-
-        fish3D = np.zeros(
-            (sites[0]['height'],sites[0]['width'],z_depth),
-            dtype=np.uint16
+    sites, channels = metadata_index.load(args.metadata_index, tmaps_api)
+    z_depth = metadata_index.n_zplanes(channels, 'FISH')
+
+    stack_shape = metadata_index.image_shape(sites) + (z_depth,)
+
+    # the sites analysed by an earlier run of this job are in its log,
+    # unless that run detected spots with other parameters; the filter size
+    # and rescaling are logged with every result
+    log = results_log.ResultsLog(
+        args.results_log or os.path.splitext(args.output_file)[0] + '.log',
+        parameters=dict(
+            experiment=args.experiment,
+            plate=args.plate,
+            filter='3D LoG, Raj',
+            img_limes=img_limes
         )
+    )
+    done = log.done(
+        ['well', 'site_x', 'site_y', 'filter_size', 'rescaling_limit_1',
+         'rescaling_limit_2', 'rescaling_limit_3', 'rescaling_limit_4'],
+        'threshold'
+    )
 
-        for z in range(0,z_depth):
-            fish = tmaps_api.download_channel_image(
-                channel_name='FISH',
+    def combinations_left(row):
+        '''(filter size, rescaling, thresholds) not yet logged for a site'''
+        site = (row['well'], int(row['site_x']), int(row['site_y']))
+        left = []
+        for filter_size in filter_sizes:
+            for rescaling in rescalings:
+                thresholds = results_log.remaining(
+                    done, site + (filter_size,) + rescaling,
+                    detection_thresholds
+                )
+                if len(thresholds) > 0:
+                    left.append((filter_size, rescaling, thresholds))
+        return left
+
+    def pending(site_rows):
+        for index, row in site_rows:
+            combinations = combinations_left(row)
+            if combinations:
+                yield index, row, combinations
+            elif args.site_queue is not None:
+                queue.complete([index])
+
+    if args.site_queue is not None:
+        queue.recover(lambda row: not combinations_left(row))
+
+    def download(site):
+        index, row, combinations = site
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('download'):
+            # DAPI and SE are only needed if the cells are not in the cache
+            cells = None
+            if label_cache is not None:
+                cells = label_cache.get(
+                    args.plate, row['well'], row['site_y'], row['site_x']
+                )
+            images, fish3D = fetcher.fetch_site(
                 plate_name=args.plate,
                 well_name=row['well'],
                 well_pos_y=row['site_y'],
                 well_pos_x=row['site_x'],
-                correct=False,
-                zplane=z
+                channels=['DAPI', 'SE'] if cells is None else [],
+                stack_channel='FISH',
+                stack_shape=stack_shape
             )
-            fish[cells == 0] = 115
-            fish3D[:,:,z] = fish
-
-        matlab.workspace.fish3D = fish3D
-
-        for threshold in np.nditer(detection_thresholds):
-
-            matlab.workspace.threshold = float(threshold)
+        return cells, images, fish3D
+
+    # FISH stack plus the DAPI and SE images, all uint16
+    site_bytes = 2 * stack_shape[0] * stack_shape[1] * (stack_shape[2] + 2)
+    in_flight = site_pipeline.max_in_flight(
+        args.prefetch_depth, site_bytes,
+        None if args.prefetch_memory is None
+        else args.prefetch_memory * image_cache.GB
+    )
 
-            matlab.eval(
-                "[ObjCount SegmentationCC] = cpsub.ObjByFilter(" +
-                "double(fish3D), op," +
-                " threshold, iImgLimes," +
-                "[min_of_min, max_of_min, min_of_max, max_of_max]," +
-                " [], false, [], []);"
+    spot_count = ResultBuilder([
+        ('filter_size', np.float64),
+        ('rescaling_limit_1', np.float64),
+        ('rescaling_limit_2', np.float64),
+        ('rescaling_limit_3', np.float64),
+        ('rescaling_limit_4', np.float64),
+        ('threshold', np.float64),
+        ('well', object),
+        ('site_x', np.int64),
+        ('site_y', np.int64),
+        ('mean_spot_count_per_cell', np.float64)
+    ])
+    sites_downloaded = site_pipeline.prefetch(
+        download, pending(site_rows), in_flight
+    )
+    for (index, row, combinations), (cells, images, fish3D) in sites_downloaded:
+
+        trace = tracer.site(row['well'], row['site_y'], row['site_x'])
+        with trace.phase('segmentation'):
+            if cells is None:
+                cells = segmentation.segment_cells(
+                    images['DAPI'], images['SE']
+                )
+                if label_cache is not None:
+                    label_cache.put(
+                        args.plate, row['well'], row['site_y'],
+                        row['site_x'], cells
+                    )
+            n_cells = np.max(cells)
+            # tiled detection masks each tile rather than the whole stack,
+            # which may be mapped from the store
+            mask = None
+            if args.max_memory is None:
+                fish3D[cells == 0] = 115
+            else:
+                mask = cells != 0
+
+        if args.backend == 'matlab':
+            # the stack may be a non-contiguous view of the z-stack store
+            with trace.phase('transfer'):
+                matlab.workspace.fish3D = np.ascontiguousarray(fish3D)
+        elif args.backend == 'python':
+            # rescalings that clamp the quantiles of the stack to the same
+            # limits share the filtered stack
+            with trace.phase('detection'):
+                if args.max_memory is None:
+                    quantiles = spot_detection.image_quantiles(
+                        fish3D, img_limes
+                    )
+                else:
+                    # tile by tile, without a masked copy of the stack
+                    quantiles = spot_detection.masked_quantiles(
+                        fish3D, img_limes, args.max_memory * image_cache.GB,
+                        mask, 115
+                    )
+            combinations = sorted(
+                combinations,
+                key=lambda c: (c[0], spot_detection.rescaling_limits(
+                    quantiles, c[1]
+                ))
             )
+            filtered_key = None
+
+        for filter_size, rescaling, thresholds in combinations:
+
+            with trace.phase('detection'):
+                if args.backend == 'matlab':
+
+                    # a restarted job only runs the thresholds not yet logged
+                    matlab.workspace.thresholds = thresholds
+                    matlab.workspace.iRescaleThr = list(rescaling)
+
+                    # ObjByFilterSeries.m rescales and filters the image once
+                    # and returns the spot count for every threshold
+                    matlab.eval(
+                        "ObjCounts = ObjByFilterSeries(" +
+                        "double(fish3D), %s," % ops[filter_size] +
+                        " thresholds, iImgLimes, iRescaleThr," +
+                        " [], false, [], [], %d);" % args.check_thresholds
+                    )
+                    counts = np.ravel(matlab.get('ObjCounts'))
+                elif args.backend == 'matlab_pool':
+                    counts = pool.count_spots(
+                        fish3D, ops[filter_size], thresholds, img_limes,
+                        rescaling, check_thresholds=args.check_thresholds
+                    )
+                else:
+                    limits = spot_detection.rescaling_limits(
+                        quantiles, rescaling
+                    )
+                    if filtered_key != (filter_size, limits):
+                        filtered_key = (filter_size, limits)
+                        if args.max_memory is None:
+                            filtered = spot_detection.filter_image(
+                                fish3D, ops[filter_size], img_limes,
+                                rescaling, limits
+                            )
+                        else:
+                            # only the voxels above the lowest threshold,
+                            # filtered tile by tile
+                            filtered = spot_detection.filtered_foreground(
+                                fish3D, ops[filter_size], img_limes,
+                                rescaling, detection_thresholds.min(),
+                                args.max_memory * image_cache.GB, limits,
+                                mask, 115
+                            )
+                    if args.max_memory is None:
+                        counts = count_objects_series(
+                            filtered, thresholds,
+                            check_thresholds=args.check_thresholds
+                        )
+                    else:
+                        indices, values = filtered
+                        counts = count_objects_sparse(
+                            fish3D.shape, indices, values, thresholds
+                        )
 
-            n_spots = matlab.get('ObjCount')
             spots_per_cell = (
-                n_spots / float(n_cells) if n_cells > 0 else None
+                np.asarray(counts) / float(n_cells) if n_cells > 0
+                else np.nan
             )
 
-            spot_count = spot_count.append(
-                pd.DataFrame({
-                    'rescaling_limit_1': args.hard_rescaling[0],
-                    'rescaling_limit_2': args.hard_rescaling[1],
-                    'rescaling_limit_3': args.hard_rescaling[2],
-                    'rescaling_limit_4': args.hard_rescaling[3],
-                    'threshold': threshold,
-                    'well': row['well'],
-                    'site_x': row['site_x'],
-                    'site_y': row['site_y'],
-                    'mean_spot_count_per_cell': spots_per_cell
-                }, index=[index])
+            log.append(
+                filter_size=filter_size,
+                rescaling_limit_1=rescaling[0],
+                rescaling_limit_2=rescaling[1],
+                rescaling_limit_3=rescaling[2],
+                rescaling_limit_4=rescaling[3],
+                threshold=thresholds,
+                well=row['well'],
+                site_x=row['site_x'],
+                site_y=row['site_y'],
+                mean_spot_count_per_cell=spots_per_cell
             )
 
-    spot_count = selected_sites.merge(spot_count)
-    spot_count.to_csv(args.output_file, encoding='utf-8', index=False)
+        # release the filtered stack before the next site is analysed
+        filtered = None
+        if args.site_queue is not None:
+            queue.complete([index])
+        tracer.write(row['well'], row['site_y'], row['site_x'])
+
+    fetcher.close()
+    new_client.close()
+    tracer.close()
+
+    # only the combinations and thresholds of this run
+    records = [
+        values for values in log.records()
+        if values['filter_size'] in filter_sizes and tuple(
+            values['rescaling_limit_%d' % i] for i in range(1, 5)
+        ) in rescalings
+    ]
+    for values in results_log.select(
+            records, 'threshold', detection_thresholds):
+        spot_count.extend(**values)
+    log.close()
+
+    if args.site_queue is not None:
+        selected_sites = queue.sites(queue.completed())
+    spot_count = selected_sites.merge(spot_count.to_frame())
+    intermediates.write_table(spot_count, args.output_file)
+
+    if args.backend == 'matlab_pool':
+        pool.close()
 
     return
 
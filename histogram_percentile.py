@@ -0,0 +1,93 @@
+'''
+Exact percentiles of integer images from their intensity histogram.
+
+A uint16 image has at most 65536 distinct values, so its histogram is built
+in one pass with ``np.bincount`` and any number of percentiles is read off
+the cumulative counts, instead of sorting or partitioning all pixels for
+every percentile. Histograms are stored compactly as the value of the first
+non-empty bin (the offset) and the counts from there to the last non-empty
+bin. Histograms of several images are pooled by adding them, which gives
+the exact percentiles of all their pixels together.
+'''
+import numpy as np
+
+
+HISTOGRAM_COLUMNS = ['histogram_offset', 'histogram']
+
+
+def histogram(image):
+    '''
+    Return ``(offset, counts)``, where ``counts[i]`` is the number of pixels
+    of ``image`` with value ``offset + i``.
+    '''
+    values = np.asarray(image).ravel()
+    if values.dtype.kind not in 'ui':
+        raise TypeError(
+            'histogram percentiles need an integer image, got %s'
+            % values.dtype
+        )
+    if values.size == 0:
+        raise ValueError('cannot build the histogram of an empty image')
+
+    if values.dtype.kind == 'u' and values.dtype.itemsize <= 2:
+        counts = np.bincount(values)
+        offset = int(np.flatnonzero(counts)[0])
+        counts = counts[offset:]
+    else:
+        offset = int(values.min())
+        # subtract in intp so that the range of signed images cannot overflow
+        counts = np.bincount(values.astype(np.intp) - offset)
+    return offset, counts
+
+
+def pool(histograms):
+    '''
+    Sum of ``(offset, counts)`` histograms as returned by :func:`histogram`
+    '''
+    histograms = [(int(o), np.asarray(c)) for o, c in histograms]
+    if not histograms:
+        raise ValueError('no histograms to pool')
+    offset = min(o for o, _ in histograms)
+    end = max(o + len(c) for o, c in histograms)
+    counts = np.zeros(end - offset, dtype=np.int64)
+    for o, c in histograms:
+        counts[o - offset:o - offset + len(c)] += c
+    return offset, counts
+
+
+def percentiles(offset, counts, q, method='linear'):
+    '''
+    Percentiles ``q`` (in %, scalar or sequence) of the pixels counted in a
+    histogram. The result equals ``np.percentile`` of the pixels with
+    ``method`` 'linear' (numpy's default) or 'hazen' (MATLAB's quantile).
+    '''
+    q = np.asarray(q, dtype=np.float64)
+    if np.any((q < 0) | (q > 100)):
+        raise ValueError('percentiles must be in the range [0, 100]')
+    cumulative = np.cumsum(counts)
+    n = cumulative[-1]
+
+    if method == 'linear':
+        rank = q / 100.0 * (n - 1)
+    elif method == 'hazen':
+        rank = np.clip(q / 100.0 * n - 0.5, 0, n - 1)
+    else:
+        raise ValueError('unknown percentile method "%s"' % method)
+    lower = np.floor(rank)
+    fraction = rank - lower
+    lower = lower.astype(np.int64)
+    upper = np.minimum(lower + 1, n - 1)
+    # value of the k-th smallest pixel: first bin whose cumulative count
+    # exceeds k
+    lower_value = np.searchsorted(cumulative, lower, side='right') + offset
+    upper_value = np.searchsorted(cumulative, upper, side='right') + offset
+
+    # interpolate from the nearer end like np.percentile, so that results
+    # agree to the last bit
+    difference = (upper_value - lower_value).astype(np.float64)
+    result = np.where(
+        fraction >= 0.5,
+        upper_value - difference * (1 - fraction),
+        lower_value + difference * fraction
+    )
+    return result if result.ndim else float(result)
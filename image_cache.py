@@ -0,0 +1,235 @@
+'''
+Local on-disk cache of images downloaded from TissueMAPS.
+
+Arrays are stored compressed (``np.savez_compressed``), one file per key,
+under a path derived from a hash of the key. The cache directory can be
+shared by parallel batch jobs on one filesystem: files are written to a
+temporary name and renamed into place, so readers never see partial
+files, and a reader that loses a file to eviction simply gets a miss.
+The total size of the files is kept in a small counter file that every
+``put`` updates under a lock. Only when it exceeds the cap is the directory
+scanned, and least recently used files (by modification time, which is
+refreshed on every hit) are removed until the cache is a tenth below the
+cap.
+'''
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+GB = 1024 ** 3
+
+# fraction of ``max_bytes`` that eviction shrinks the cache to, so that a
+# full cache is not scanned again on the next put
+EVICTION_TARGET = 0.9
+
+
+class _Locked(object):
+    '''Exclusive flock on ``path``, held as a context manager'''
+
+    def __init__(self, path):
+        self._file = open(path, 'a+')
+
+    def __enter__(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self._file
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class ArrayCache(object):
+    '''
+    Directory of compressed numpy arrays addressed by hashable keys
+    '''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.npz')
+
+    def get(self, key):
+        '''Return the array stored for ``key`` or ``None``'''
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                array = data['array']
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            return None
+        return array
+
+    def put(self, key, array):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, array=array)
+            if self.max_bytes is None:
+                os.rename(tmp_path, path)
+                return
+            size = os.path.getsize(tmp_path)
+            with _Locked(self._size_path) as counter:
+                # the counter is updated together with the rename, so that
+                # concurrent puts of one key count its file once
+                replaced = _file_size(path)
+                os.rename(tmp_path, path)
+                total = self._add_size(counter, size - replaced)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if total > self.max_bytes:
+            self.evict()
+
+    @property
+    def _size_path(self):
+        return os.path.join(self.directory, '.size')
+
+    def _scan(self):
+        # (mtime, size, path) of every file in the cache
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.npz'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _add_size(self, counter, change):
+        # total size in the locked ``counter`` file plus ``change``; a
+        # missing or unreadable counter is recounted from the files
+        counter.seek(0)
+        try:
+            total = int(counter.read())
+        except ValueError:
+            total = sum(size for _, size, _ in self._scan()) - change
+        total = max(total + change, 0)
+        counter.seek(0)
+        counter.truncate()
+        counter.write('%d' % total)
+        counter.flush()
+        return total
+
+    def size(self):
+        '''Total size of the cached files in bytes, as counted by puts'''
+        with _Locked(self._size_path) as counter:
+            return self._add_size(counter, 0)
+
+    def evict(self):
+        '''
+        Remove least recently used files until the cache fits into
+        ``EVICTION_TARGET`` of ``max_bytes``, if it exceeds ``max_bytes``.
+        Only one process evicts at a time; the others wait for it and find
+        the cache shrunk.
+        '''
+        if self.max_bytes is None:
+            return
+        with _Locked(os.path.join(self.directory, '.lock')):
+            counted = self.size()
+            if counted <= self.max_bytes:
+                return
+
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            target = EVICTION_TARGET * self.max_bytes
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+            # keep what other processes put while the files were scanned
+            with _Locked(self._size_path) as counter:
+                self._add_size(counter, total - counted)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class CachedTmClient(object):
+    '''
+    Wraps a ``TmClient`` so that ``download_channel_image`` is served
+    from an :class:`ArrayCache` when possible. All other attributes are
+    those of the wrapped client.
+    '''
+
+    def __init__(self, client, cache, experiment_name):
+        self._client = client
+        self._cache = cache
+        self._experiment_name = experiment_name
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def download_channel_image(self, channel_name, plate_name, well_name,
+                               well_pos_y, well_pos_x, zplane=0,
+                               correct=True, **kwargs):
+        key = (
+            self._experiment_name, plate_name, well_name,
+            int(well_pos_y), int(well_pos_x), channel_name,
+            int(zplane), bool(correct), tuple(sorted(kwargs.items()))
+        )
+        image = self._cache.get(key)
+        if image is None:
+            image = self._client.download_channel_image(
+                channel_name=channel_name,
+                plate_name=plate_name,
+                well_name=well_name,
+                well_pos_y=well_pos_y,
+                well_pos_x=well_pos_x,
+                zplane=zplane,
+                correct=correct,
+                **kwargs
+            )
+            self._cache.put(key, image)
+        return image
+
+
+def cached_client(client, experiment_name, cache_dir, cache_size=None):
+    '''
+    Return ``client`` wrapped in an image cache in ``cache_dir`` limited to
+    ``cache_size`` GB, or ``client`` itself if ``cache_dir`` is ``None``.
+    '''
+    if cache_dir is None:
+        return client
+    max_bytes = None if cache_size is None else int(cache_size * GB)
+    return CachedTmClient(
+        client, ArrayCache(cache_dir, max_bytes), experiment_name
+    )
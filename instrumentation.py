@@ -0,0 +1,345 @@
+'''
+Per-site timing and memory traces of the stage scripts.
+
+With ``--trace``, a stage script writes one JSON line per site next to its
+output file (see :func:`trace_path`), e.g.::
+
+    {"stage": "spot_count_3D", "batch": "spot_count_000", "well": "A01",
+     "site_y": 0, "site_x": 1,
+     "phases": {"download": {"wall": 4.2, "cpu": 0.9,
+                             "decoded_bytes": 125829120},
+                "segmentation": {"wall": 1.3, "cpu": 1.3,
+                                 "peak_rss": 2147483648}, ...}}
+
+For every phase of the site this records
+
+* ``wall``: elapsed time in seconds,
+* ``cpu``: CPU time in seconds of the thread running the phase, plus that
+  of the download threads for the images of the site,
+* ``decoded_bytes``: size of the images downloaded from TissueMAPS once
+  decoded, i.e. of the arrays rather than of the (compressed) files
+  transferred; cache hits are not counted, and
+* ``peak_rss``: peak resident set size of the process during the phase in
+  bytes. Only phases run on the main thread have it, because the peak is
+  reset at the start of each (Linux only; elsewhere it is the peak since
+  the process started).
+
+Downloads of prefetched sites run in other threads while the main thread
+analyses an earlier site, so their wall time overlaps that of the other
+phases. The bookkeeping is a few clock reads per phase and per downloaded
+image and one line written per site, far below the time of the phases.
+
+Run as a script, this rolls the traces of all batches up into a breakdown
+per stage and phase::
+
+    python instrumentation.py experiment/spot_count_*/*.trace.jsonl
+'''
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import pandas as pd
+
+
+MB = 1024 ** 2
+
+_local = threading.local()
+
+
+def trace_path(output_file):
+    '''Path of the trace written next to ``output_file``'''
+    return os.path.splitext(output_file)[0] + '.trace.jsonl'
+
+
+def reset_peak_rss():
+    '''Reset the peak RSS of the process to its current RSS, if possible'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    '''Peak RSS of the process in bytes'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class SiteTrace(object):
+    '''
+    Phases of one site, filled by :meth:`phase` and :meth:`add` from any
+    thread
+    '''
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, **values):
+        '''
+        Add ``values`` to those of phase ``name``; ``peak_rss`` keeps the
+        maximum
+        '''
+        with self._lock:
+            phase = self.phases.setdefault(name, collections.OrderedDict())
+            for key, value in values.items():
+                if key == 'peak_rss':
+                    phase[key] = max(phase.get(key, 0), value)
+                else:
+                    phase[key] = phase.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Measure the block as phase ``name``'''
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            reset_peak_rss()
+        outer = getattr(_local, 'site', None)
+        _local.site = self
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            values = dict(
+                wall=time.perf_counter() - wall,
+                cpu=time.thread_time() - cpu
+            )
+            _local.site = outer
+            if main:
+                values['peak_rss'] = peak_rss()
+            self.add(name, **values)
+
+
+class _NullSiteTrace(object):
+
+    def add(self, name, **values):
+        pass
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+
+class Tracer(object):
+    '''
+    Traces of the sites of batch ``output_file`` of ``stage``, appended to
+    :func:`trace_path` of ``output_file``
+    '''
+
+    def __init__(self, output_file, stage):
+        self.stage = stage
+        self.batch = os.path.splitext(os.path.basename(output_file))[0]
+        self._file = open(trace_path(output_file), 'a')
+        self._sites = dict()
+        self._lock = threading.Lock()
+
+    def site(self, well, site_y, site_x):
+        '''The :class:`SiteTrace` of a site, created on first use'''
+        key = (well, int(site_y), int(site_x))
+        with self._lock:
+            if key not in self._sites:
+                self._sites[key] = SiteTrace()
+            return self._sites[key]
+
+    def client(self, client):
+        '''``client`` with its downloads added to the traces of the sites'''
+        return TracedClient(client, self)
+
+    def write(self, well, site_y, site_x):
+        '''Write the trace of a site and forget it'''
+        key = (well, int(site_y), int(site_x))
+        with self._lock:
+            trace = self._sites.pop(key, None)
+        if trace is None:
+            return
+        record = collections.OrderedDict([
+            ('stage', self.stage),
+            ('batch', self.batch),
+            ('well', key[0]),
+            ('site_y', key[1]),
+            ('site_x', key[2]),
+            ('phases', trace.phases)
+        ])
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class NullTracer(object):
+    '''Tracer of a script run without ``--trace``, which records nothing'''
+
+    _site = _NullSiteTrace()
+
+    def site(self, well, site_y, site_x):
+        return self._site
+
+    def client(self, client):
+        return client
+
+    def write(self, well, site_y, site_x):
+        pass
+
+    def close(self):
+        pass
+
+
+def tracer(trace, output_file, stage):
+    '''
+    Return a :class:`Tracer` for ``output_file`` if ``trace`` is set and a
+    :class:`NullTracer` otherwise
+    '''
+    if not trace:
+        return NullTracer()
+    return Tracer(output_file, stage)
+
+
+class TracedClient(object):
+    '''
+    Wraps a ``TmClient`` so that ``download_channel_image`` adds the
+    decoded size of each image to the ``download`` phase of its site, and its CPU time
+    if called outside of a phase (i.e. in a download thread). All other
+    attributes are those of the wrapped client.
+    '''
+
+    def __init__(self, client, tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def download_channel_image(self, **kwargs):
+        in_phase = getattr(_local, 'site', None) is not None
+        cpu = time.thread_time()
+        image = self._client.download_channel_image(**kwargs)
+        values = dict(decoded_bytes=image.nbytes)
+        if not in_phase:
+            values['cpu'] = time.thread_time() - cpu
+        self._tracer.site(
+            kwargs['well_name'], kwargs['well_pos_y'], kwargs['well_pos_x']
+        ).add('download', **values)
+        return image
+
+
+def read_traces(paths):
+    '''
+    Table of the phases of all sites in the trace files ``paths``, one row
+    per site and phase
+    '''
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for phase, values in record['phases'].items():
+                    row = dict(
+                        (key, record[key]) for key in
+                        ['stage', 'batch', 'well', 'site_y', 'site_x']
+                    )
+                    row['phase'] = phase
+                    row.update(values)
+                    rows.append(row)
+    columns = [
+        'stage', 'batch', 'well', 'site_y', 'site_x', 'phase',
+        'wall', 'cpu', 'decoded_bytes', 'peak_rss'
+    ]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def breakdown(traces):
+    '''
+    Per stage and phase: the number of sites, the total and mean wall time,
+    the share of the stage's total wall time, the CPU time relative to the
+    wall time, the decoded size of the images downloaded and its rate, and
+    the largest peak RSS
+    '''
+    grouped = traces.groupby(['stage', 'phase'], sort=False)
+    table = pd.DataFrame({
+        'sites': grouped.size(),
+        'wall_s': grouped.wall.sum(),
+        'wall_per_site_s': grouped.wall.mean(),
+        'cpu_s': grouped.cpu.sum(),
+        'decoded_mb': grouped.decoded_bytes.sum(min_count=1) / MB,
+        'peak_rss_mb': grouped.peak_rss.max() / MB
+    })
+    stage_wall = table.wall_s.groupby(level='stage').transform('sum')
+    table.insert(2, 'wall_share', table.wall_s / stage_wall)
+    table.insert(5, 'cpu_per_wall', table.cpu_s / table.wall_s)
+    table.insert(
+        7, 'decoded_mb_per_s',
+        table.decoded_mb / table.wall_s
+    )
+    return table
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='instrumentation',
+        description=('Rolls the per-site traces written by the stage '
+                     'scripts with --trace up into a breakdown per stage '
+                     'and phase across all batches.')
+    )
+    parser.add_argument(
+        'traces', nargs='+',
+        help=('trace files (.trace.jsonl) or directories searched for them '
+              'recursively')
+    )
+    parser.add_argument(
+        '-o', '--output_file', type=str, default=None,
+        help='also write the breakdown to this file (.csv, optional)'
+    )
+    return(parser.parse_args())
+
+
+def main(args):
+    paths = []
+    for path in args.traces:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(
+                os.path.join(path, '**', '*.trace.jsonl'), recursive=True
+            )))
+        else:
+            paths.append(path)
+    traces = read_traces(paths)
+    if traces.empty:
+        sys.exit('no traces in %s' % ' '.join(args.traces))
+    table = breakdown(traces)
+    print(
+        '%d sites in %d batches' % (
+            len(traces.groupby(['stage', 'batch', 'well', 'site_y',
+                                'site_x'])),
+            len(traces.groupby(['stage', 'batch']))
+        )
+    )
+    with pd.option_context('display.width', 200,
+                           'display.max_columns', None):
+        print(table.round(3).to_string())
+    if args.output_file is not None:
+        table.to_csv(args.output_file)
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
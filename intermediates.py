@@ -0,0 +1,55 @@
+'''
+Read and write the tables passed between pipeline stages.
+
+Tables are stored uncompressed in the Arrow IPC file format (Feather v2).
+The format is typed and columnar, so a reader can memory-map a file and
+take only the columns it needs without parsing or copying the rest. The
+pandas index and MultiIndex columns are restored from the metadata that
+pyarrow stores along with the table.
+'''
+import pyarrow as pa
+
+
+EXTENSION = '.arrow'
+
+
+def write_table(frame, path):
+    '''Write the DataFrame ``frame`` to ``path``'''
+    table = pa.Table.from_pandas(frame)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_arrow(path, columns=None):
+    '''
+    Memory-map ``path`` and return it as a ``pyarrow.Table``, restricted to
+    ``columns`` if given
+    '''
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+def read_table(path, columns=None):
+    '''
+    Read the DataFrame stored in ``path``, optionally only ``columns``
+    (and its index)
+    '''
+    if columns is not None:
+        # a stored index is a column of the table, which has to be read
+        # along to be restored
+        metadata = read_schema(path).pandas_metadata or {}
+        columns = list(columns) + [
+            name for name in metadata.get('index_columns', [])
+            if not isinstance(name, dict) and name not in columns
+        ]
+    return read_arrow(path, columns).to_pandas()
+
+
+def read_schema(path):
+    '''Schema of the table stored in ``path``, without reading its data'''
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).schema
@@ -0,0 +1,291 @@
+'''
+Pool of warm MATLAB sessions serving spot counts to the threshold series
+scripts on the same node.
+
+Start one pool per node before the batch jobs, e.g.::
+
+    python matlab_pool.py --workers 4 --address /tmp/matlab_pool.sock
+
+and run the scripts with ``--backend matlab_pool``. Every session keeps
+JtLibrary on its path and the LoG kernels it has built, so jobs only pay
+for the detection itself. Images are handed over as raw files on /dev/shm
+(see matlab_transfer.py); only the job description and the counts go over
+the socket.
+'''
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import matlab_transfer
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = '/tmp/matlab_pool.sock'
+
+# environment variable that overrides the default JtLibrary directory of
+# the pool and of the scripts' matlab backend
+LIBRARY_PATH_VARIABLE = 'JTLIBRARY_PATH'
+
+LIBRARY_PATH = '~/repositories/JtLibrary/matlab/jtlibrary/'
+
+# seconds a client waits for the counts of a site before giving up on the
+# pool, e.g. because the MATLAB session running the job died
+DEFAULT_TIMEOUT = 3600.0
+
+
+def library_path(default):
+    '''JtLibrary directory given by $JTLIBRARY_PATH, or ``default``'''
+    return os.environ.get(LIBRARY_PATH_VARIABLE) or default
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='matlab_pool',
+        description=('Keeps a pool of MATLAB sessions running and serves '
+                     'spot counts for ObjByFilterSeries.m over a local '
+                     'socket.')
+    )
+    parser.add_argument(
+        '-v', '--verbosity', action='count', default=0,
+        help='increase logging verbosity'
+    )
+    parser.add_argument(
+        '-a', '--address', type=str, default=DEFAULT_ADDRESS,
+        help='path of the unix socket to listen on (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of MATLAB sessions (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--library_path', type=str, nargs='+',
+        default=[library_path(LIBRARY_PATH)],
+        help=('directories added to the MATLAB path of every session '
+              '(default: $%s or %s)' % (LIBRARY_PATH_VARIABLE, LIBRARY_PATH))
+    )
+
+    return(parser.parse_args())
+
+
+class MatlabPool(object):
+    '''
+    Client side of a pool started with ``python matlab_pool.py``. A job
+    that gets no answer within ``timeout`` seconds raises a RuntimeError and
+    closes the connection.
+    '''
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._connection = Client(address, family='AF_UNIX')
+
+    def count_spots(self, image, filter_args, thresholds, img_limes,
+                    rescale_thr, close_holes=False, check_thresholds=0):
+        '''
+        Spot count for each of ``thresholds``, as returned by
+        ObjByFilterSeries.m. ``filter_args`` are the arguments of
+        cpsub.fspecialCP3D, e.g. ``('2D LoG', 6.0)``. With
+        ``check_thresholds`` > 0, ObjByFilterSeries.m checks that many counts
+        against full calls of cpsub.ObjByFilter.
+        '''
+        if self._connection is None:
+            raise RuntimeError('MATLAB pool connection is closed')
+        image = np.asarray(image)
+        path = matlab_transfer.save_buffer(image)
+        try:
+            self._connection.send({
+                'image': path,
+                'dtype': image.dtype.str,
+                'shape': image.shape,
+                'filter': tuple(filter_args),
+                'thresholds': [float(t) for t in thresholds],
+                'img_limes': [float(l) for l in img_limes],
+                'rescale_thr': [float(l) for l in rescale_thr],
+                'close_holes': bool(close_holes),
+                'check_thresholds': int(check_thresholds)
+            })
+            if not self._connection.poll(self.timeout):
+                # a late answer would be taken for that of the next job
+                self.close()
+                raise RuntimeError(
+                    'MATLAB pool did not answer within %g s' % self.timeout
+                )
+            try:
+                counts, error = self._connection.recv()
+            except EOFError:
+                self.close()
+                raise RuntimeError('MATLAB pool closed the connection')
+        finally:
+            os.remove(path)
+        if error is not None:
+            raise RuntimeError('MATLAB pool job failed: %s' % error)
+        return np.asarray(counts, dtype=np.int64)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _fspecial_expression(filter_args):
+    return 'cpsub.fspecialCP3D({0})'.format(', '.join(
+        "'%s'" % a if isinstance(a, str) else repr(float(a))
+        for a in filter_args
+    ))
+
+
+def _run_job(eng, ops, job):
+    import matlab
+
+    if job['filter'] not in ops:
+        ops[job['filter']] = 'op%d' % len(ops)
+        eng.eval('{0} = {1};'.format(
+            ops[job['filter']], _fspecial_expression(job['filter'])
+        ), nargout=0)
+
+    matlab_transfer.load_buffer(
+        eng, 'image', job['image'], job['dtype'], job['shape']
+    )
+    eng.workspace['thresholds'] = matlab.double(job['thresholds'])
+    eng.workspace['iImgLimes'] = matlab.double(job['img_limes'])
+    eng.workspace['iRescaleThr'] = matlab.double(job['rescale_thr'])
+    eng.eval(
+        "ObjCounts = ObjByFilterSeries(double(image), {op}, thresholds, "
+        "iImgLimes, iRescaleThr, [], {close}, [], [], {check}); "
+        "clear image;".format(
+            op=ops[job['filter']],
+            close='true' if job['close_holes'] else 'false',
+            check=job.get('check_thresholds', 0)
+        ),
+        nargout=0
+    )
+    return [int(n) for n in np.asarray(eng.workspace['ObjCounts']).ravel()]
+
+
+def _worker(jobs, results, library_paths):
+    import matlab.engine
+
+    eng = matlab.engine.start_matlab()
+    for path in library_paths:
+        eng.addpath(os.path.expanduser(path), nargout=0)
+    eng.addpath(os.path.dirname(os.path.abspath(__file__)), nargout=0)
+
+    # workspace variable names of the LoG kernels built so far
+    ops = dict()
+    for job_id, job in iter(jobs.get, None):
+        try:
+            results.put((job_id, _run_job(eng, ops, job), None))
+        except Exception as error:
+            results.put((job_id, None, repr(error)))
+
+    eng.quit()
+
+
+def _route_results(results, connections):
+    for job_id, counts, error in iter(results.get, None):
+        connection = connections.pop(job_id, None)
+        if connection is None:
+            continue
+        try:
+            connection.send((counts, error))
+        except (OSError, EOFError) as exc:
+            # the client has gone away, e.g. after timing out
+            logger.warning('cannot answer job %d: %r', job_id, exc)
+
+
+def _start_worker(jobs, results, library_paths):
+    worker = multiprocessing.Process(
+        target=_worker, args=(jobs, results, library_paths)
+    )
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def _restart_workers(workers, jobs, results, library_paths, interval=10.0):
+    # the job a dead worker was running is lost; its client times out
+    while True:
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                logger.error(
+                    'MATLAB worker %d exited with code %s, restarting it',
+                    worker.pid, worker.exitcode
+                )
+                workers[i] = _start_worker(jobs, results, library_paths)
+        time.sleep(interval)
+
+
+def _serve_connection(connection, jobs, connections, job_ids):
+    try:
+        while True:
+            job = connection.recv()
+            job_id = next(job_ids)
+            connections[job_id] = connection
+            jobs.put((job_id, job))
+    except EOFError:
+        pass
+
+
+def main(args):
+
+    jobs = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [
+        _start_worker(jobs, results, args.library_path)
+        for _ in range(args.workers)
+    ]
+    watchdog = threading.Thread(
+        target=_restart_workers,
+        args=(workers, jobs, results, args.library_path)
+    )
+    watchdog.daemon = True
+    watchdog.start()
+
+    # connection each pending job has to be answered on; every client has
+    # at most one job in flight
+    connections = dict()
+    router = threading.Thread(
+        target=_route_results, args=(results, connections)
+    )
+    router.daemon = True
+    router.start()
+
+    if os.path.exists(args.address):
+        os.remove(args.address)
+    listener = Listener(args.address, family='AF_UNIX')
+    os.chmod(args.address, 0o600)
+    logger.info(
+        'serving %d MATLAB sessions on %s', args.workers, args.address
+    )
+
+    job_ids = itertools.count()
+    try:
+        while True:
+            connection = listener.accept()
+            handler = threading.Thread(
+                target=_serve_connection,
+                args=(connection, jobs, connections, job_ids)
+            )
+            handler.daemon = True
+            handler.start()
+    finally:
+        listener.close()
+        for _ in workers:
+            jobs.put(None)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logging.basicConfig(
+        level=max(logging.WARNING - 10 * arguments.verbosity, logging.DEBUG)
+    )
+    main(arguments)
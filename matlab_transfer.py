@@ -0,0 +1,104 @@
+'''
+Hand arrays to and from a MATLAB engine session through raw binary files
+instead of converting them element by element (``matlab.double(x.tolist())``
+builds one Python float per pixel). Files are created on a tmpfs when one
+is available, so the data never touches the disk.
+'''
+import os
+import tempfile
+
+import numpy as np
+
+
+SHARED_MEMORY_DIR = '/dev/shm'
+
+MATLAB_TYPES = {
+    np.dtype(np.uint8): 'uint8',
+    np.dtype(np.uint16): 'uint16',
+    np.dtype(np.int32): 'int32',
+    np.dtype(np.float32): 'single',
+    np.dtype(np.float64): 'double',
+}
+
+
+def _transfer_file(directory):
+    if directory is None and os.path.isdir(SHARED_MEMORY_DIR):
+        directory = SHARED_MEMORY_DIR
+    fd, path = tempfile.mkstemp(suffix='.bin', dir=directory)
+    return fd, path
+
+
+def _dimension_order(ndim):
+    # numpy arrays are row-major and MATLAB arrays column-major: the raw
+    # buffer is a MATLAB array with reversed dimensions
+    return ' '.join(str(d) for d in range(max(ndim, 2), 0, -1))
+
+
+def save_buffer(array, directory=None):
+    '''
+    Write the raw buffer of ``array`` to a new transfer file and return its
+    path. The caller removes the file once MATLAB has read it.
+    '''
+    fd, path = _transfer_file(directory)
+    with os.fdopen(fd, 'wb') as f:
+        np.ascontiguousarray(array).tofile(f)
+    return path
+
+
+def load_buffer(eng, name, path, dtype, shape):
+    '''
+    Read a transfer file written by :func:`save_buffer` for an array of
+    type ``dtype`` and shape ``shape`` into the variable ``name`` in the
+    workspace of the MATLAB engine ``eng``.
+    '''
+    matlab_shape = tuple(shape)[::-1]
+    if len(matlab_shape) < 2:
+        matlab_shape = matlab_shape + (1,) * (2 - len(matlab_shape))
+    eng.eval(
+        "fid = fopen('{path}', 'r'); "
+        "{name} = fread(fid, Inf, '*{type}'); fclose(fid); "
+        "{name} = permute(reshape({name}, [{shape}]), [{order}]);".format(
+            path=path, name=name, type=MATLAB_TYPES[np.dtype(dtype)],
+            shape=' '.join(str(n) for n in matlab_shape),
+            order=_dimension_order(len(shape))
+        ),
+        nargout=0
+    )
+
+
+def put_array(eng, name, array, directory=None):
+    '''
+    Assign ``array`` to the variable ``name`` in the workspace of the
+    MATLAB engine ``eng``, keeping its data type (e.g. uint16).
+    '''
+    path = save_buffer(array, directory)
+    try:
+        load_buffer(eng, name, path, array.dtype, array.shape)
+    finally:
+        os.remove(path)
+
+
+def get_array(eng, name, dtype=np.float64, directory=None):
+    '''
+    Return the variable ``name`` from the workspace of the MATLAB engine
+    ``eng`` as a numpy array of type ``dtype``.
+    '''
+    dtype = np.dtype(dtype)
+    shape = [int(n) for n in eng.eval('size({0})'.format(name))[0]]
+
+    fd, path = _transfer_file(directory)
+    os.close(fd)
+    try:
+        eng.eval(
+            "fid = fopen('{path}', 'w'); "
+            "fwrite(fid, permute({name}, [{order}]), '{type}'); "
+            "fclose(fid);".format(
+                path=path, name=name, type=MATLAB_TYPES[dtype],
+                order=_dimension_order(len(shape))
+            ),
+            nargout=0
+        )
+        array = np.fromfile(path, dtype=dtype)
+    finally:
+        os.remove(path)
+    return array.reshape(shape)
@@ -0,0 +1,158 @@
+'''
+Site and channel metadata of an experiment, fetched from TissueMAPS once
+per pipeline run and shared by all batch jobs.
+
+The index is a directory with two tables (see intermediates.py): one row
+per acquisition site with its plate, well, position and image size, and one
+row per channel with its number of z-planes. Scripts given ``--metadata_index``
+look metadata up there instead of querying the server; without it they
+fetch the same tables themselves.
+'''
+import argparse
+import errno
+import os
+
+import numpy as np
+
+import intermediates
+from result_builder import ResultBuilder
+
+
+SITES_FILENAME = 'sites' + intermediates.EXTENSION
+
+CHANNELS_FILENAME = 'channels' + intermediates.EXTENSION
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='metadata_index',
+        description=('Fetches the site and channel metadata of an '
+                     'experiment from TissueMAPS and writes them as tables '
+                     'for the other stages.')
+    )
+    parser.add_argument(
+        '-v', '--verbosity', action='count', default=0,
+        help='increase logging verbosity'
+    )
+    parser.add_argument(
+        '-H', '--host', default='app.tissuemaps.org',
+        help='name of TissueMAPS server host'
+    )
+    parser.add_argument(
+        '-P', '--port', type=int, default=80,
+        help='number of the port to which the server listens (default: 80)'
+    )
+    parser.add_argument(
+        '-u', '--user', dest='username', required=True,
+        help='name of TissueMAPS user'
+    )
+    parser.add_argument(
+        '--password', required=True,
+        help='password of TissueMAPS user'
+    )
+    parser.add_argument(
+        '-e', '--experiment', required=True,
+        help='experiment name'
+    )
+    parser.add_argument(
+        '-o', '--output_dir', type=str, default='metadata_index',
+        help='directory the tables are written to (default: %(default)s)'
+    )
+
+    return(parser.parse_args())
+
+
+def fetch(client):
+    '''
+    Return the sites and channels tables of the experiment of ``client``
+    '''
+    sites = ResultBuilder([
+        ('plate', object),
+        ('well', object),
+        ('site_x', np.int64),
+        ('site_y', np.int64),
+        ('height', np.int64),
+        ('width', np.int64)
+    ])
+    for site in client.get_sites():
+        sites.append(
+            plate=site['plate_name'],
+            well=site['well_name'],
+            site_x=site['x'],
+            site_y=site['y'],
+            height=site['height'],
+            width=site['width']
+        )
+
+    channels = ResultBuilder([
+        ('channel', object),
+        ('n_zplanes', np.int64)
+    ])
+    for channel in client.get_channels():
+        channels.append(
+            channel=channel['name'],
+            n_zplanes=len(channel['layers'])
+        )
+
+    return sites.to_frame(), channels.to_frame()
+
+
+def write(directory, sites, channels):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+    intermediates.write_table(sites, os.path.join(directory, SITES_FILENAME))
+    intermediates.write_table(
+        channels, os.path.join(directory, CHANNELS_FILENAME)
+    )
+
+
+def load(directory, client):
+    '''
+    Return the sites and channels tables from the index in ``directory``,
+    or fetch them with ``client`` if ``directory`` is ``None``.
+    '''
+    if directory is None:
+        return fetch(client)
+    return (
+        intermediates.read_table(os.path.join(directory, SITES_FILENAME)),
+        intermediates.read_table(os.path.join(directory, CHANNELS_FILENAME))
+    )
+
+
+def image_shape(sites):
+    '''(height, width) of the images of the first site'''
+    return int(sites.height.iloc[0]), int(sites.width.iloc[0])
+
+
+def n_zplanes(channels, channel_name):
+    '''Number of z-planes of the channel ``channel_name``'''
+    matching = channels.n_zplanes[channels.channel == channel_name]
+    if matching.empty:
+        raise ValueError('no channel named "%s"' % channel_name)
+    return int(matching.iloc[0])
+
+
+def main(args):
+    from tmclient import TmClient
+
+    tmaps_api = TmClient(
+        host=args.host,
+        port=args.port,
+        experiment_name=args.experiment,
+        username=args.username,
+        password=args.password
+    )
+
+    sites, channels = fetch(tmaps_api)
+    write(args.output_dir, sites, channels)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
@@ -1,5 +1,6 @@
 import sys
 
+import json
 import os
 from os.path import basename
 
@@ -14,6 +15,105 @@ if __name__ == '__main__':
     OptimiseSpotDetectionScript().run()
 
 
+def cache_arguments(cache_dir, cache_size):
+    '''
+    Command line arguments enabling the shared image cache, if any
+    '''
+    if cache_dir is None:
+        return []
+    return [
+        '--cache_dir', os.path.abspath(cache_dir),
+        '--cache_size', cache_size
+    ]
+
+
+def trace_arguments(trace):
+    '''
+    Command line arguments enabling the per-site traces of a stage, which
+    it writes next to its output file (see instrumentation.py)
+    '''
+    return ['--trace'] if trace else []
+
+
+def trace_outputs(trace, out):
+    '''
+    Trace file of the stage writing ``out``.arrow, if traced
+    '''
+    return [out + '.trace.jsonl'] if trace else []
+
+
+def client_arguments(max_in_flight):
+    '''
+    Command line arguments making a stage download through one pooled
+    asyncio client (see async_tmclient.py), if any
+    '''
+    if max_in_flight is None:
+        return []
+    return ['--max_in_flight', max_in_flight]
+
+
+def metadata_index_files(experiment):
+    '''
+    Paths of the tables written by MetadataIndexApp
+    '''
+    return [
+        os.path.join(os.getcwd(), experiment, 'metadata_index', filename)
+        for filename in ['sites.arrow', 'channels.arrow']
+    ]
+
+
+def site_queue_file(experiment):
+    '''
+    Path of the site queue shared by the spot count jobs, which claim sites
+    from it directly on the shared filesystem
+    '''
+    return os.path.join(os.getcwd(), experiment, 'site_queue', 'sites.db')
+
+
+def results_log_file(experiment, batch_id):
+    '''
+    Path of the results log of spot count job ``batch_id``, kept outside
+    the job's output directory so that a resubmitted job finds it. A later
+    run with other detection parameters refuses the log (see
+    results_log.py) until it is removed.
+    '''
+    return os.path.join(
+        os.getcwd(), experiment, 'results_log',
+        'spot_count_{num:03d}.log'.format(num=batch_id)
+    )
+
+
+def intensity_extrema_file(experiment, batch_id):
+    '''
+    Path of the intensity extrema of batch ``batch_id``
+    '''
+    return os.path.join(
+        os.getcwd(), experiment,
+        'intensity_extrema_{num:03d}'.format(num=batch_id),
+        'intensity_extrema_{num:03d}.arrow'.format(num=batch_id)
+    )
+
+
+def aggregate_limits_file(experiment):
+    '''
+    Path of the rescaling limits written by AggregateRescalingLimitsApp
+    '''
+    return os.path.join(
+        os.getcwd(), experiment, 'aggregated_extrema',
+        'aggregated_rescaling_limits.arrow'
+    )
+
+
+def batch_sites_file(experiment, batch_id):
+    '''
+    Path of the sites of batch ``batch_id`` written by PlanSitesApp
+    '''
+    return os.path.join(
+        os.getcwd(), experiment, 'site_plan',
+        'selected_sites_{num:03d}.arrow'.format(num=batch_id)
+    )
+
+
 class OptimiseSpotDetectionScript(SessionBasedScript):
     '''
     Script to scan a range of spot detection thresholds and calculate
@@ -41,6 +141,43 @@ class OptimiseSpotDetectionScript(SessionBasedScript):
         self.add_param('--n_sites', type=int,
                        help=('Batch size: number of images per well'))
         self.add_param('--n_batches', type=int, help=('Number of batches'))
+        self.add_param('--seed', type=int, default=0,
+                       help=('Seed of the random selection of sites'))
+        self.add_param('--backend', type=str, default='matlab',
+                       choices=['matlab', 'matlab_pool', 'python'],
+                       help=('Implementation of spot detection'))
+        self.add_param('--pool_address', type=str,
+                       default='/tmp/matlab_pool.sock',
+                       help=('Socket of the per-node MATLAB pool '
+                             '(matlab_pool backend)'))
+        self.add_param('--cache_dir', type=str, default=None,
+                       help=('Image cache directory shared by all jobs'))
+        self.add_param('--cache_size', type=float, default=50.0,
+                       help=('Maximum size of the image cache in GB'))
+        self.add_param('--trace', action='store_true',
+                       help=('Stage jobs write the time and memory of each '
+                             'phase of every site next to their output '
+                             '(see instrumentation.py)'))
+        self.add_param('--max_in_flight', type=int, default=None,
+                       help=('Stage jobs download through one pooled '
+                             'asyncio client with this many requests in '
+                             'flight (needs aiohttp)'))
+        self.add_param('--scheduling', type=str, default='static',
+                       choices=['static', 'queue'],
+                       help=('Spot count jobs analyse fixed batches '
+                             '(static) or claim sites from a shared queue '
+                             'until it is empty (queue)'))
+        self.add_param('--threshold_search', type=str, default='grid',
+                       choices=['grid', 'adaptive'],
+                       help=('Sweep the --thresholds grid on all sites '
+                             '(grid), or refine it on pilot sites first and '
+                             'sweep only the interval found (adaptive)'))
+        self.add_param('--pilot_sites', type=int, default=5,
+                       help=('Pilot sites per control of the adaptive '
+                             'threshold search'))
+        self.add_param('--search_tolerance', type=float, default=None,
+                       help=('Threshold tolerance of the adaptive search '
+                             '(default: a quarter of the --thresholds step)'))
 
     def new_tasks(self, extra):
         apps = [OptimiseSpotDetectionPipeline(self.params)]
@@ -56,72 +193,211 @@ class OptimiseSpotDetectionPipeline(StagedTaskCollection):
         self.params = params
         StagedTaskCollection.__init__(self, output_dir='')
 
-    # Get intensity extrema
+    # Fetch site and channel metadata
     def stage0(self):
-        return GetIntensityExtremaParallel(
+        return MetadataIndexApp(
             self.params.host,
             self.params.username,
             self.params.password,
+            self.params.experiment
+        )
+
+    # Select sites and split them into batches
+    def stage1(self):
+        return PlanSitesApp(
             self.params.experiment,
             self.params.negative_wells,
             self.params.positive_wells,
             self.params.plate,
-            self.params.channel,
             self.params.n_sites,
-            self.params.n_batches
-        )
-
-    # Collect results and aggregate
-    def stage1(self):
-        return AggregateRescalingLimitsApp(
             self.params.n_batches,
-            self.params.experiment
+            self.params.seed
         )
 
-    # Perform spot detection
+    # Get intensity extrema
     def stage2(self):
-        return GetSpotCountThresholdSeriesParallel(
+        return GetIntensityExtremaParallel(
             self.params.host,
             self.params.username,
             self.params.password,
             self.params.experiment,
             self.params.plate,
             self.params.channel,
-            self.params.thresholds,
             self.params.n_batches,
-            self.params.hard_rescaling
+            self.params.cache_dir,
+            self.params.cache_size,
+            self.params.trace,
+            self.params.max_in_flight
         )
 
-    # Aggregate spot detection
+    # Collect results and aggregate
     def stage3(self):
+        return AggregateRescalingLimitsApp(
+            self.params.n_batches,
+            self.params.experiment,
+            self.params.scheduling
+        )
+
+    # Perform spot detection
+    def stage4(self):
+        if self.params.threshold_search == 'adaptive':
+            return AdaptiveSpotCountStages(self.params)
+        return spot_count_parallel(self.params, self.params.thresholds)
+
+    # Aggregate spot detection
+    def stage5(self):
         return AggregateSpotCountThresholdSeriesApp(
             self.params.n_batches,
             self.params.experiment
         )
 
     # Plot results
-    def stage4(self):
+    def stage6(self):
         return PlotSpotCountThresholdSeriesApp(
-            self.tasks[3].output_dir,
+            self.tasks[5].output_dir,
             self.params.experiment
         )
 
 
+def spot_count_parallel(params, thresholds):
+    return GetSpotCountThresholdSeriesParallel(
+        params.host,
+        params.username,
+        params.password,
+        params.experiment,
+        params.plate,
+        params.channel,
+        thresholds,
+        params.n_batches,
+        params.hard_rescaling,
+        params.backend,
+        params.pool_address,
+        params.cache_dir,
+        params.cache_size,
+        params.scheduling,
+        params.trace,
+        params.max_in_flight
+    )
+
+
+class AdaptiveSpotCountStages(StagedTaskCollection):
+    '''
+    Search the threshold range on pilot sites, then sweep only that range
+    on all sites
+    '''
+
+    def __init__(self, params):
+        self.params = params
+        StagedTaskCollection.__init__(self, output_dir='')
+
+    # Refine the thresholds on pilot sites
+    def stage0(self):
+        return SearchThresholdsApp(
+            self.params.host,
+            self.params.username,
+            self.params.password,
+            self.params.experiment,
+            self.params.plate,
+            self.params.channel,
+            self.params.thresholds,
+            self.params.n_batches,
+            self.params.hard_rescaling,
+            self.params.pilot_sites,
+            self.params.search_tolerance,
+            # the search runs without MATLAB unless a pool is available
+            'matlab_pool' if self.params.backend == 'matlab_pool'
+            else 'python',
+            self.params.pool_address,
+            self.params.cache_dir,
+            self.params.cache_size
+        )
+
+    # Perform spot detection for the thresholds found
+    def stage1(self):
+        search_file = os.path.join(
+            os.getcwd(), self.tasks[0].output_dir, 'threshold_search.json'
+        )
+        with open(search_file) as f:
+            search = json.load(f)
+        return spot_count_parallel(self.params, search['thresholds'])
+
+
+class MetadataIndexApp(Application):
+    '''
+    Fetch the site and channel metadata of the experiment once for all
+    batches
+    '''
+
+    def __init__(self, host, username, password, experiment):
+        Application.__init__(
+            self,
+            arguments=[
+                'python',
+                'metadata_index.py',
+                '--host', host,
+                '--user', username,
+                '--password', password,
+                '--experiment', experiment,
+                '--output_dir', '.'],
+            inputs=['metadata_index.py', 'intermediates.py',
+                    'result_builder.py'],
+            outputs=['sites.arrow', 'channels.arrow'],
+            output_dir=os.path.join(experiment, 'metadata_index'),
+            stdout='stdout.txt',
+            stderr='stderr.txt',
+            requested_memory=1 * GB)
+
+
+class PlanSitesApp(Application):
+    '''
+    Select unique sites of the control wells and split them into batches
+    '''
+
+    def __init__(self, experiment, negative_wells, positive_wells, plate,
+                 n_sites, n_batches, seed):
+        outputs = ['site_plan.arrow'] + [
+            'selected_sites_{num:03d}.arrow'.format(num=batch_id)
+            for batch_id in range(n_batches)
+        ]
+        Application.__init__(
+            self,
+            arguments=[
+                'python',
+                'plan_sites.py',
+                '--metadata_index', '.',
+                '--plate', plate,
+                '--negative_wells'] + negative_wells + [
+                '--positive_wells'] + positive_wells + [
+                '--number_sites', n_sites,
+                '--number_batches', n_batches,
+                '--seed', seed,
+                '--output_dir', '.'],
+            inputs=['plan_sites.py', 'metadata_index.py',
+                    'intermediates.py', 'result_builder.py',
+                    'site_queue.py'] +
+                metadata_index_files(experiment),
+            outputs=outputs,
+            output_dir=os.path.join(experiment, 'site_plan'),
+            stdout='stdout.txt',
+            stderr='stderr.txt',
+            requested_memory=1 * GB)
+
+
 class GetIntensityExtremaParallel(ParallelTaskCollection):
     '''
     Run n_batches instances of GetIntensityExtremaApp in parallel
     '''
 
     def __init__(self, host, username, password, experiment,
-                 negative_wells, positive_wells, plate, channel,
-                 n_sites, n_batches):
+                 plate, channel, n_batches, cache_dir, cache_size,
+                 trace=False, max_in_flight=None):
         task_list = []
         for batch_id in range(n_batches):
             task_list.append(
                 GetIntensityExtremaApp(
                     host, username, password, experiment,
-                    negative_wells, positive_wells, plate, channel,
-                    n_sites, batch_id
+                    plate, channel, batch_sites_file(experiment, batch_id),
+                    batch_id, cache_dir, cache_size, trace, max_in_flight
                 )
             )
         ParallelTaskCollection.__init__(self, task_list, output_dir='')
@@ -129,12 +405,12 @@ class GetIntensityExtremaParallel(ParallelTaskCollection):
 
 class GetIntensityExtremaApp(Application):
     '''
-    Get intensity extrema for a batch of images and write as python pickle
+    Get intensity extrema for a batch of images and write as Arrow table
     '''
 
     def __init__(self, host, username, password, experiment,
-                 negative_wells, positive_wells, plate, channel,
-                 n_sites, batch_id):
+                 plate, channel, input_batch_file, batch_id,
+                 cache_dir, cache_size, trace=False, max_in_flight=None):
         out = 'intensity_extrema_{num:03d}'.format(num=batch_id)
         out_dir = os.path.join(experiment, out)
         Application.__init__(
@@ -148,12 +424,17 @@ class GetIntensityExtremaApp(Application):
                 '--experiment', experiment,
                 '--plate', plate,
                 '--channel', channel,
-                '--negative_wells', ' '.join(negative_wells),
-                '--positive_wells', ' '.join(positive_wells),
-                '--number_sites', n_sites,
-                '--output_file', out + '.pkl'],
-            inputs=['get_intensity_extrema.py'],
-            outputs=[out + '.pkl'],
+                '--input_batch_file', input_batch_file,
+                '--output_file', out + '.arrow'] +
+                trace_arguments(trace) +
+                client_arguments(max_in_flight) +
+                cache_arguments(cache_dir, cache_size),
+            inputs=[input_batch_file,
+                    'get_intensity_extrema.py', 'image_cache.py',
+                    'instrumentation.py', 'async_tmclient.py',
+                    'site_fetcher.py', 'histogram_percentile.py',
+                    'result_builder.py', 'intermediates.py'],
+            outputs=[out + '.arrow'] + trace_outputs(trace, out),
             output_dir=out_dir,
             stdout='stdout.txt',
             stderr='stderr.txt',
@@ -165,7 +446,7 @@ class AggregateRescalingLimitsApp(Application):
     Aggregate batches of results from GetIntensityExtremaApp
     '''
 
-    def __init__(self, n_batches, experiment):
+    def __init__(self, n_batches, experiment, scheduling='static'):
         input_list_filepath = []
         for batch_id in range(n_batches):
             input_list_filepath.append(
@@ -173,11 +454,14 @@ class AggregateRescalingLimitsApp(Application):
                     os.getcwd(),
                     experiment,
                     'intensity_extrema_{num:03d}'.format(num=batch_id),
-                    'intensity_extrema_{num:03d}.pkl'.format(num=batch_id)
+                    'intensity_extrema_{num:03d}.arrow'.format(num=batch_id)
                 )
             )
         input_list_filepath_exec = input_list_filepath[:]
         input_list_filepath_exec.append('aggregate_rescaling_limits.py')
+        input_list_filepath_exec.append('histogram_percentile.py')
+        input_list_filepath_exec.append('intermediates.py')
+        input_list_filepath_exec.append('site_queue.py')
 
         output_dir = os.path.join(experiment, 'aggregated_extrema')
 
@@ -187,9 +471,11 @@ class AggregateRescalingLimitsApp(Application):
                 'python',
                 'aggregate_rescaling_limits.py',
                 '--input_files'] + input_list_filepath + [
-                '--output_file', 'aggregated_rescaling_limits.pkl'],
+                '--output_file', 'aggregated_rescaling_limits.arrow'] + (
+                ['--site_queue', site_queue_file(experiment)]
+                if scheduling == 'queue' else []),
             inputs=input_list_filepath_exec,
-            outputs=['aggregated_rescaling_limits.pkl',
+            outputs=['aggregated_rescaling_limits.arrow',
                      'aggregated_rescaling_limits_lower_limit.csv',
                      'aggregated_rescaling_limits_upper_limit.csv'],
             output_dir=output_dir,
@@ -198,33 +484,87 @@ class AggregateRescalingLimitsApp(Application):
             requested_memory=1 * GB)
 
 
+class SearchThresholdsApp(Application):
+    '''
+    Refine the threshold range on pilot sites of each control
+    '''
+
+    def __init__(self, host, username, password, experiment,
+                 plate, channel, thresholds, n_batches, hard_rescaling,
+                 pilot_sites, tolerance, backend, pool_address,
+                 cache_dir, cache_size):
+        input_batch_files = [
+            intensity_extrema_file(experiment, batch_id)
+            for batch_id in range(n_batches)
+        ]
+        input_aggregate_file = aggregate_limits_file(experiment)
+        Application.__init__(
+            self,
+            arguments=[
+                'python',
+                'search_thresholds.py',
+                '--host', host,
+                '--user', username,
+                '--password', password,
+                '--experiment', experiment,
+                '--plate', plate,
+                '--channel', channel,
+                '--input_batch_files'] + input_batch_files + [
+                '--input_aggregate_file', input_aggregate_file,
+                '--pilot_sites', pilot_sites,
+                '--thresholds'] + thresholds + [
+                '--hard_rescaling'] + hard_rescaling + (
+                [] if tolerance is None else ['--tolerance', tolerance]) + [
+                '--backend', backend,
+                '--pool_address', pool_address,
+                '--output_file', 'threshold_search.json'] +
+                cache_arguments(cache_dir, cache_size),
+            inputs=input_batch_files + [
+                    input_aggregate_file,
+                    'search_thresholds.py',
+                    'detection_parameters.py',
+                    'threshold_sweep.py',
+                    'spot_detection.py',
+                    'matlab_transfer.py',
+                    'matlab_pool.py',
+                    'image_cache.py',
+                    'histogram_percentile.py',
+                    'result_builder.py',
+                    'intermediates.py'],
+            outputs=['threshold_search.json', 'threshold_search.arrow'],
+            output_dir=os.path.join(experiment, 'threshold_search'),
+            stdout='stdout.txt',
+            stderr='stderr.txt',
+            requested_memory=2 * GB
+        )
+
+
 class GetSpotCountThresholdSeriesParallel(ParallelTaskCollection):
     '''
     Run n_batches instances of GetSpotCountThresholdSeriesApp in parallel
     '''
 
     def __init__(self, host, username, password, experiment,
-                 plate, channel, thresholds, n_batches, hard_rescaling):
+                 plate, channel, thresholds, n_batches, hard_rescaling,
+                 backend, pool_address, cache_dir, cache_size,
+                 scheduling='static', trace=False, max_in_flight=None):
         task_list = []
-        input_aggregate_file = os.path.join(
-            os.getcwd(),
-            experiment,
-            'aggregated_extrema',
-            'aggregated_rescaling_limits.pkl'
-        )
+        input_aggregate_file = aggregate_limits_file(experiment)
         for batch_id in range(n_batches):
-            input_batch_file = os.path.join(
-                os.getcwd(),
-                experiment,
-                'intensity_extrema_{num:03d}'.format(num=batch_id),
-                'intensity_extrema_{num:03d}.pkl'.format(num=batch_id)
-            )
+            if scheduling == 'queue':
+                sites_arguments = ['--site_queue', site_queue_file(experiment)]
+                sites_inputs = []
+            else:
+                input_batch_file = intensity_extrema_file(experiment, batch_id)
+                sites_arguments = ['--input_batch_file', input_batch_file]
+                sites_inputs = [input_batch_file]
             task_list.append(
                 GetSpotCountThresholdSeriesApp(
                     host, username, password, experiment,
-                    plate, channel, input_batch_file,
+                    plate, channel, sites_arguments, sites_inputs,
                     input_aggregate_file, thresholds,
-                    batch_id, hard_rescaling
+                    batch_id, hard_rescaling, backend, pool_address,
+                    cache_dir, cache_size, trace, max_in_flight
                 )
             )
         ParallelTaskCollection.__init__(self, task_list, output_dir='')
@@ -236,8 +576,10 @@ class GetSpotCountThresholdSeriesApp(Application):
     '''
 
     def __init__(self, host, username, password, experiment,
-                 plate, channel, input_batch_file, input_aggregate_file,
-                 thresholds, batch_id, hard_rescaling):
+                 plate, channel, sites_arguments, sites_inputs,
+                 input_aggregate_file, thresholds, batch_id, hard_rescaling,
+                 backend, pool_address, cache_dir, cache_size,
+                 trace=False, max_in_flight=None):
 
         out = 'spot_count_{num:03d}'.format(num=batch_id)
         output_dir = os.path.join(experiment, out)
@@ -253,14 +595,35 @@ class GetSpotCountThresholdSeriesApp(Application):
                 '--thresholds'] + thresholds + [
                 '--hard_rescaling'] + hard_rescaling + [
                 '--plate', plate,
-                '--channel', channel,
-                '--input_batch_file', input_batch_file,
+                '--channel', channel] + sites_arguments + [
+                '--worker_id', out,
+                '--results_log', results_log_file(experiment, batch_id),
                 '--input_aggregate_file', input_aggregate_file,
-                '--output_file', out + '.csv'],
-            inputs=[input_aggregate_file,
-                    input_batch_file,
-                    'get_spot_count_threshold_series.py'],
-            outputs=[out + '.csv'],
+                '--backend', backend,
+                '--pool_address', pool_address,
+                '--output_file', out + '.arrow'] +
+                trace_arguments(trace) +
+                client_arguments(max_in_flight) +
+                cache_arguments(cache_dir, cache_size),
+            inputs=sites_inputs + [
+                    input_aggregate_file,
+                    'get_spot_count_threshold_series.py',
+                    'detection_parameters.py',
+                    'threshold_sweep.py',
+                    'spot_detection.py',
+                    'matlab_transfer.py',
+                    'ObjByFilterSeries.m',
+                    'matlab_pool.py',
+                    'image_cache.py',
+                    'instrumentation.py',
+                    'async_tmclient.py',
+                    'site_pipeline.py',
+                    'site_queue.py',
+                    'results_log.py',
+                    'histogram_percentile.py',
+                    'result_builder.py',
+                    'intermediates.py'],
+            outputs=[out + '.arrow'] + trace_outputs(trace, out),
             output_dir=output_dir,
             stdout='stdout.txt',
             stderr='stderr.txt',
@@ -285,17 +648,25 @@ class AggregateSpotCountThresholdSeriesApp(Application):
                     os.getcwd(),
                     experiment,
                     'spot_count_{num:03d}'.format(num=batch_id),
-                    'spot_count_{num:03d}.csv'.format(num=batch_id)
+                    'spot_count_{num:03d}.arrow'.format(num=batch_id)
                 )
             )
 
         Application.__init__(
             self,
-            arguments=['./concatenate_csv.sh'] + input_filepath_list,
-            inputs=['concatenate_csv.sh'] + input_filepath_list,
+            arguments=[
+                'python',
+                'aggregate_spot_count.py',
+                '--input_files'] + input_filepath_list + [
+                '--output_file', out,
+                # columns read by PlotSpotDetectionThresholdSeries.R
+                '--columns', 'control', 'well', 'site_x', 'site_y',
+                'threshold', 'spot_count'],
+            inputs=['aggregate_spot_count.py',
+                    'intermediates.py'] + input_filepath_list,
             outputs=[out],
             output_dir=output_dir,
-            stdout=out,
+            stdout='stdout.txt',
             stderr='stderr.txt',
             requested_memory=1 * GB
         )
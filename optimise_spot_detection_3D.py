@@ -1,5 +1,6 @@
 import sys
 
+import math
 import os
 from os.path import basename
 
@@ -14,6 +15,92 @@ if __name__ == '__main__':
     OptimiseSpotDetection3DScript().run()
 
 
+def cache_arguments(cache_dir, cache_size):
+    '''
+    Command line arguments enabling the shared image cache, if any
+    '''
+    if cache_dir is None:
+        return []
+    return [
+        '--cache_dir', os.path.abspath(cache_dir),
+        '--cache_size', cache_size
+    ]
+
+
+def trace_arguments(trace):
+    '''
+    Command line arguments enabling the per-site traces of a stage, which
+    it writes next to its output file (see instrumentation.py)
+    '''
+    return ['--trace'] if trace else []
+
+
+def trace_outputs(trace, out):
+    '''
+    Trace file of the stage writing ``out``.arrow, if traced
+    '''
+    return [out + '.trace.jsonl'] if trace else []
+
+
+def client_arguments(max_in_flight):
+    '''
+    Command line arguments making a stage download through one pooled
+    asyncio client (see async_tmclient.py), if any
+    '''
+    if max_in_flight is None:
+        return []
+    return ['--max_in_flight', max_in_flight]
+
+
+def metadata_index_files(experiment):
+    '''
+    Paths of the tables written by MetadataIndexApp
+    '''
+    return [
+        os.path.join(os.getcwd(), experiment, 'metadata_index', filename)
+        for filename in ['sites.arrow', 'channels.arrow']
+    ]
+
+
+def site_queue_file(experiment):
+    '''
+    Path of the site queue shared by the spot count jobs, which claim sites
+    from it directly on the shared filesystem
+    '''
+    return os.path.join(os.getcwd(), experiment, 'site_queue', 'sites.db')
+
+
+def results_log_file(experiment, batch_id):
+    '''
+    Path of the results log of spot count job ``batch_id``, kept outside
+    the job's output directory so that a resubmitted job finds it. A later
+    run with other detection parameters refuses the log (see
+    results_log.py) until it is removed.
+    '''
+    return os.path.join(
+        os.getcwd(), experiment, 'results_log',
+        'spot_count_{num:03d}.log'.format(num=batch_id)
+    )
+
+
+def label_cache_dir(experiment):
+    '''
+    Directory of the cell label images segmented by the spot count jobs,
+    which later runs in the same session read instead of segmenting again
+    '''
+    return os.path.join(os.getcwd(), experiment, 'label_cache')
+
+
+def batch_sites_file(experiment, batch_id):
+    '''
+    Path of the sites of batch ``batch_id`` written by PlanSitesApp
+    '''
+    return os.path.join(
+        os.getcwd(), experiment, 'site_plan',
+        'selected_sites_{num:03d}.arrow'.format(num=batch_id)
+    )
+
+
 class OptimiseSpotDetection3DScript(SessionBasedScript):
     '''
     Script to scan a range of spot detection thresholds and calculate
@@ -34,14 +121,50 @@ class OptimiseSpotDetection3DScript(SessionBasedScript):
         self.add_param('--negative_wells', nargs='+', help=('Negative wells'))
         self.add_param('--thresholds', nargs=3, default=[0.02, 0.04, 0.02],
                        type=float, help=('Thresholds to test'))
-        self.add_param('--hard_rescaling', nargs=4,
+        self.add_param('--hard_rescaling', nargs='+',
                        default=[120.0, 120.0, 1000.0, 1000.0],
-                       type=float, help=('Hard rescaling thresholds'))
-        self.add_param('--filter_size', default=5.0, type=float,
-                       help=('specify size for LoG filter'))
+                       type=float,
+                       help=('Hard rescaling thresholds, several sets of '
+                             'four to sweep them jointly'))
+        self.add_param('--filter_size', nargs='+', default=[5.0], type=float,
+                       help=('specify size for LoG filter, several to sweep '
+                             'them jointly'))
         self.add_param('--n_sites', type=int,
                        help=('Batch size: number of images per well'))
         self.add_param('--n_batches', type=int, help=('Number of batches'))
+        self.add_param('--seed', type=int, default=0,
+                       help=('Seed of the random selection of sites'))
+        self.add_param('--backend', type=str, default='matlab',
+                       choices=['matlab', 'matlab_pool', 'python'],
+                       help=('Implementation of spot detection'))
+        self.add_param('--pool_address', type=str,
+                       default='/tmp/matlab_pool.sock',
+                       help=('Socket of the per-node MATLAB pool '
+                             '(matlab_pool backend)'))
+        self.add_param('--max_memory', type=float, default=None,
+                       help=('Memory in GB for the spot detection on a '
+                             'stack, which is then filtered in XY tiles '
+                             '(python backend)'))
+        self.add_param('--zstack_store', type=str, default=None,
+                       help=('Node-local directory in which the jobs store '
+                             'the FISH stacks for later runs'))
+        self.add_param('--cache_dir', type=str, default=None,
+                       help=('Image cache directory shared by all jobs'))
+        self.add_param('--cache_size', type=float, default=50.0,
+                       help=('Maximum size of the image cache in GB'))
+        self.add_param('--trace', action='store_true',
+                       help=('Stage jobs write the time and memory of each '
+                             'phase of every site next to their output '
+                             '(see instrumentation.py)'))
+        self.add_param('--max_in_flight', type=int, default=None,
+                       help=('Stage jobs download through one pooled '
+                             'asyncio client with this many requests in '
+                             'flight (needs aiohttp)'))
+        self.add_param('--scheduling', type=str, default='static',
+                       choices=['static', 'queue'],
+                       help=('Spot count jobs analyse fixed batches '
+                             '(static) or claim sites from a shared queue '
+                             'until it is empty (queue)'))
 
     def new_tasks(self, extra):
         apps = [OptimiseSpotDetectionPipeline(self.params)]
@@ -57,22 +180,30 @@ class OptimiseSpotDetectionPipeline(StagedTaskCollection):
         self.params = params
         StagedTaskCollection.__init__(self, output_dir='')
 
-    # Get intensity extrema
+    # Fetch site and channel metadata
     def stage0(self):
-        return SelectSitesParallel(
+        return MetadataIndexApp(
             self.params.host,
             self.params.username,
             self.params.password,
+            self.params.experiment
+        )
+
+    # Select sites and split them into batches
+    def stage1(self):
+        return PlanSitesApp(
             self.params.experiment,
             self.params.negative_wells,
             self.params.positive_wells,
             self.params.plate,
             self.params.n_sites,
-            self.params.n_batches
+            self.params.n_batches,
+            self.params.seed,
+            self.params.scheduling
         )
 
     # Perform spot detection
-    def stage1(self):
+    def stage2(self):
         return GetSpotCountThresholdSeries3DParallel(
             self.params.host,
             self.params.username,
@@ -82,67 +213,88 @@ class OptimiseSpotDetectionPipeline(StagedTaskCollection):
             self.params.thresholds,
             self.params.n_batches,
             self.params.hard_rescaling,
-            self.params.filter_size
+            self.params.filter_size,
+            self.params.backend,
+            self.params.pool_address,
+            self.params.cache_dir,
+            self.params.cache_size,
+            self.params.scheduling,
+            self.params.max_memory,
+            self.params.zstack_store,
+            self.params.trace,
+            self.params.max_in_flight
         )
 
     # Aggregate spot detection
-    def stage2(self):
+    def stage3(self):
         return AggregateSpotCountThresholdSeriesApp(
             self.params.n_batches,
             self.params.experiment
         )
 
 
-class SelectSitesParallel(ParallelTaskCollection):
+class MetadataIndexApp(Application):
     '''
-    Run n_batches instances of GetIntensityExtremaApp in parallel
+    Fetch the site and channel metadata of the experiment once for all
+    batches
     '''
 
-    def __init__(self, host, username, password, experiment,
-                 negative_wells, positive_wells, plate,
-                 n_sites, n_batches):
-        task_list = []
-        for batch_id in range(n_batches):
-            task_list.append(
-                GetSites3DApp(
-                    host, username, password, experiment,
-                    negative_wells, positive_wells, plate,
-                    n_sites, batch_id
-                )
-            )
-        ParallelTaskCollection.__init__(self, task_list, output_dir='')
+    def __init__(self, host, username, password, experiment):
+        Application.__init__(
+            self,
+            arguments=[
+                'python',
+                'metadata_index.py',
+                '--host', host,
+                '--user', username,
+                '--password', password,
+                '--experiment', experiment,
+                '--output_dir', '.'],
+            inputs=['metadata_index.py', 'intermediates.py',
+                    'result_builder.py'],
+            outputs=['sites.arrow', 'channels.arrow'],
+            output_dir=os.path.join(experiment, 'metadata_index'),
+            stdout='stdout.txt',
+            stderr='stderr.txt',
+            requested_memory=1 * GB,
+            requested_walltime=20 * minutes)
 
 
-class GetSites3DApp(Application):
+class PlanSitesApp(Application):
     '''
-    Get sites for a batch of images and write as python pickle
+    Select unique sites of the control wells and split them into batches
     '''
 
-    def __init__(self, host, username, password, experiment,
-                 negative_wells, positive_wells, plate,
-                 n_sites, batch_id):
-        out = 'selected_sites_{num:03d}'.format(num=batch_id)
-        out_dir = os.path.join(experiment, out)
+    def __init__(self, experiment, negative_wells, positive_wells, plate,
+                 n_sites, n_batches, seed, scheduling='static'):
+        outputs = ['site_plan.arrow'] + [
+            'selected_sites_{num:03d}.arrow'.format(num=batch_id)
+            for batch_id in range(n_batches)
+        ]
         Application.__init__(
             self,
             arguments=[
                 'python',
-                'select_sites_3D.py',
-                '--host', host,
-                '--user', username,
-                '--password', password,
-                '--experiment', experiment,
+                'plan_sites.py',
+                '--metadata_index', '.',
                 '--plate', plate,
-                '--negative_wells', ' '.join(negative_wells),
-                '--positive_wells', ' '.join(positive_wells),
+                '--negative_wells'] + negative_wells + [
+                '--positive_wells'] + positive_wells + [
                 '--number_sites', n_sites,
-                '--output_file', out + '.pkl'],
-            inputs=['select_sites_3D.py'],
-            outputs=[out + '.pkl'],
-            output_dir=out_dir,
+                '--number_batches', n_batches,
+                '--seed', seed,
+                '--output_dir', '.'] + (
+                ['--site_queue', site_queue_file(experiment)]
+                if scheduling == 'queue' else []),
+            inputs=['plan_sites.py', 'metadata_index.py',
+                    'intermediates.py', 'result_builder.py',
+                    'site_queue.py'] +
+                metadata_index_files(experiment),
+            outputs=outputs,
+            output_dir=os.path.join(experiment, 'site_plan'),
             stdout='stdout.txt',
             stderr='stderr.txt',
-            requested_memory=3 * GB,
+            requested_memory=1 * GB,
             requested_walltime=20 * minutes)
 
 
@@ -152,21 +304,27 @@ class GetSpotCountThresholdSeries3DParallel(ParallelTaskCollection):
     '''
 
     def __init__(self, host, username, password, experiment,
-                 plate, thresholds, n_batches, hard_rescaling, filter_size):
+                 plate, thresholds, n_batches, hard_rescaling, filter_size,
+                 backend, pool_address, cache_dir, cache_size,
+                 scheduling='static', max_memory=None, zstack_store=None,
+                 trace=False, max_in_flight=None):
         task_list = []
         for batch_id in range(n_batches):
-            input_batch_file = os.path.join(
-                os.getcwd(),
-                experiment,
-                'selected_sites_{num:03d}'.format(num=batch_id),
-                'selected_sites_{num:03d}.pkl'.format(num=batch_id)
-            )
+            if scheduling == 'queue':
+                sites_arguments = ['--site_queue', site_queue_file(experiment)]
+                sites_inputs = []
+            else:
+                input_batch_file = batch_sites_file(experiment, batch_id)
+                sites_arguments = ['--input_batch_file', input_batch_file]
+                sites_inputs = [input_batch_file]
             task_list.append(
                 GetSpotCountThresholdSeries3DApp(
                     host, username, password, experiment,
-                    plate, input_batch_file,
+                    plate, sites_arguments, sites_inputs,
                     thresholds,
-                    batch_id, hard_rescaling, filter_size
+                    batch_id, hard_rescaling, filter_size, backend,
+                    pool_address, cache_dir, cache_size, max_memory,
+                    zstack_store, trace, max_in_flight
                 )
             )
         ParallelTaskCollection.__init__(self, task_list, output_dir='')
@@ -178,8 +336,21 @@ class GetSpotCountThresholdSeries3DApp(Application):
     '''
 
     def __init__(self, host, username, password, experiment,
-                 plate, input_batch_file,
-                 thresholds, batch_id, hard_rescaling, filter_size):
+                 plate, sites_arguments, sites_inputs,
+                 thresholds, batch_id, hard_rescaling, filter_size,
+                 backend, pool_address, cache_dir, cache_size,
+                 max_memory=None, zstack_store=None, trace=False,
+                 max_in_flight=None):
+
+        if max_memory is None:
+            detection_arguments = []
+            requested_memory = 15 * GB
+        else:
+            detection_arguments = ['--max_memory', max_memory]
+            # the detection, the prefetched sites and the interpreter
+            requested_memory = int(math.ceil(max_memory + 4.0 + 1.0)) * GB
+        if zstack_store is not None:
+            detection_arguments += ['--zstack_store', zstack_store]
 
         out = 'spot_count_{num:03d}'.format(num=batch_id)
         output_dir = os.path.join(experiment, out)
@@ -191,20 +362,50 @@ class GetSpotCountThresholdSeries3DApp(Application):
                 '--host', host,
                 '--user', username,
                 '--password', password,
-                '--filter_size', filter_size,
+                '--filter_size'] + filter_size + [
                 '--experiment', experiment,
                 '--thresholds'] + thresholds + [
                 '--hard_rescaling'] + hard_rescaling + [
-                '--plate', plate,
-                '--input_batch_file', input_batch_file,
-                '--output_file', out + '.csv'],
-            inputs=[input_batch_file,
-                    'get_spot_count_threshold_series_3D_mw.py'],
-            outputs=[out + '.csv'],
+                '--plate', plate] + sites_arguments + [
+                '--worker_id', out,
+                '--results_log', results_log_file(experiment, batch_id),
+                '--label_cache_dir', label_cache_dir(experiment),
+                '--backend', backend,
+                '--pool_address', pool_address,
+                # leaves most of requested_memory to the detection
+                '--prefetch_memory', 4.0,
+                '--metadata_index', '.',
+                '--output_file', out + '.arrow'] +
+                detection_arguments +
+                trace_arguments(trace) +
+                client_arguments(max_in_flight) +
+                cache_arguments(cache_dir, cache_size),
+            inputs=sites_inputs + [
+                    'get_spot_count_threshold_series_3D_mw.py',
+                    'threshold_sweep.py',
+                    'spot_detection.py',
+                    'histogram_percentile.py',
+                    'ObjByFilterSeries.m',
+                    'matlab_pool.py',
+                    'matlab_transfer.py',
+                    'image_cache.py',
+                    'site_fetcher.py',
+                    'site_pipeline.py',
+                    'site_queue.py',
+                    'results_log.py',
+                    'segmentation.py',
+                    'zstack_store.py',
+                    'instrumentation.py',
+                    'async_tmclient.py',
+                    'result_builder.py',
+                    'intermediates.py',
+                    'metadata_index.py'] +
+                metadata_index_files(experiment),
+            outputs=[out + '.arrow'] + trace_outputs(trace, out),
             output_dir=output_dir,
             stdout='stdout.txt',
             stderr='stderr.txt',
-            requested_memory=15 * GB,
+            requested_memory=requested_memory,
             requested_walltime=3 * hours
         )
 
@@ -226,17 +427,22 @@ class AggregateSpotCountThresholdSeriesApp(Application):
                     os.getcwd(),
                     experiment,
                     'spot_count_{num:03d}'.format(num=batch_id),
-                    'spot_count_{num:03d}.csv'.format(num=batch_id)
+                    'spot_count_{num:03d}.arrow'.format(num=batch_id)
                 )
             )
 
         Application.__init__(
             self,
-            arguments=['./concatenate_csv.sh'] + input_filepath_list,
-            inputs=['concatenate_csv.sh'] + input_filepath_list,
+            arguments=[
+                'python',
+                'aggregate_spot_count.py',
+                '--input_files'] + input_filepath_list + [
+                '--output_file', out],
+            inputs=['aggregate_spot_count.py',
+                    'intermediates.py'] + input_filepath_list,
             outputs=[out],
             output_dir=output_dir,
-            stdout=out,
+            stdout='stdout.txt',
             stderr='stderr.txt',
             requested_memory=1 * GB,
             requested_walltime=20 * minutes
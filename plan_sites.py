@@ -0,0 +1,209 @@
+'''
+Select the sites analysed by a pipeline run and split them across batches.
+
+Sites are drawn without replacement from the sites of each control well
+listed in the metadata index, so that no site is downloaded or analysed
+twice. The selection is stratified: every well contributes the same number
+of sites (or all of its sites, if it has fewer), and the sites of all wells
+are interleaved before they are split, so that each batch holds a mix of
+wells and controls. Every batch gets the same number of sites of each
+well and of each control (up to one), and within that the batches are
+balanced by the estimated cost of their sites (the number of pixels of a
+site's images), assigning the most expensive remaining site to the least
+loaded batch.
+
+The draw depends only on the seed and the metadata index, so a rerun with
+the same arguments writes the same plan.
+'''
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import intermediates
+import metadata_index
+import site_queue
+
+
+logger = logging.getLogger(__name__)
+
+PLAN_FILENAME = 'site_plan' + intermediates.EXTENSION
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='plan_sites',
+        description=('Selects unique sites of the control wells and splits '
+                     'them into batches. Writes the whole plan and one '
+                     'table of sites per batch.')
+    )
+    parser.add_argument(
+        '-v', '--verbosity', action='count', default=0,
+        help='increase logging verbosity'
+    )
+    parser.add_argument(
+        '--metadata_index', type=str, required=True,
+        help='directory written by metadata_index.py'
+    )
+    parser.add_argument(
+        '-p', '--plate', type=str, default='plate01',
+        help='plate name'
+    )
+    parser.add_argument(
+        '--negative_wells', type=str, nargs='+', required=True,
+        help='wells of negative control (as list)'
+    )
+    parser.add_argument(
+        '--positive_wells', type=str, nargs='+', required=True,
+        help='wells of positive control (as list)'
+    )
+    parser.add_argument(
+        '-n', '--number_sites', dest='n_sites', type=int, required=True,
+        help='number of sites per well and batch'
+    )
+    parser.add_argument(
+        '-b', '--number_batches', dest='n_batches', type=int, required=True,
+        help='number of batches'
+    )
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='seed of the random selection (default: 0)'
+    )
+    parser.add_argument(
+        '-o', '--output_dir', type=str, default='.',
+        help='directory the plan is written to (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--site_queue', type=str, default=None,
+        help=('also write the selected sites to this queue for jobs run '
+              'with --site_queue (optional)')
+    )
+
+    return(parser.parse_args())
+
+
+def batch_filename(batch_id):
+    return 'selected_sites_{num:03d}{ext}'.format(
+        num=batch_id, ext=intermediates.EXTENSION
+    )
+
+
+def select_sites(sites, plate_name, controls, n_per_well, seed):
+    '''
+    Draw up to ``n_per_well`` sites without replacement from each well of
+    ``controls``, a DataFrame with columns ``control`` and ``well``.
+
+    Returns the selected sites with columns control, well, site_x, site_y
+    and cost, ordered so that consecutive sites come from different wells.
+    '''
+    random_state = np.random.RandomState(seed)
+    sites = sites[sites.plate == plate_name]
+    strata = []
+    for stratum, (_, control) in enumerate(controls.iterrows()):
+        well_sites = sites[sites.well == control['well']].sort_values(
+            ['site_y', 'site_x']
+        )
+        if len(well_sites) < n_per_well:
+            logger.warning(
+                'well %s has only %d of %d requested sites',
+                control['well'], len(well_sites), n_per_well
+            )
+        selected = random_state.choice(
+            len(well_sites), min(n_per_well, len(well_sites)), replace=False
+        )
+        well_sites = well_sites.iloc[selected]
+        strata.append(pd.DataFrame({
+            'control': control['control'],
+            'well': control['well'],
+            'site_x': well_sites.site_x.values,
+            'site_y': well_sites.site_y.values,
+            'cost': (well_sites.height * well_sites.width).values,
+            'rank': np.arange(len(well_sites)),
+            'stratum': stratum
+        }, columns=[
+            'control', 'well', 'site_x', 'site_y', 'cost', 'rank', 'stratum'
+        ]))
+
+    selection = pd.concat(strata, ignore_index=True)
+    selection = selection.sort_values(['rank', 'stratum'], kind='mergesort')
+    return selection.drop(['rank', 'stratum'], axis=1).reset_index(drop=True)
+
+
+def assign_batches(costs, strata, n_batches, groups=None):
+    '''
+    Batch of each item, spreading the items of each stratum and then of
+    each group (e.g. the control of a well), if ``groups`` are given,
+    evenly over the batches. Among the batches with the fewest items of
+    its stratum and group, an item goes to the least loaded one, so that
+    the total costs of the batches are balanced (longest processing time
+    first).
+    '''
+    costs = np.asarray(costs)
+    if groups is None:
+        groups = np.zeros(len(costs), dtype=np.int64)
+    batches = np.empty(len(costs), dtype=np.int64)
+    loads = np.zeros(n_batches)
+    counts = dict()
+    group_counts = dict()
+    order = np.arange(n_batches)
+    for item in np.argsort(-costs, kind='mergesort'):
+        stratum_counts = counts.setdefault(
+            strata[item], np.zeros(n_batches, dtype=np.int64)
+        )
+        group_count = group_counts.setdefault(
+            groups[item], np.zeros(n_batches, dtype=np.int64)
+        )
+        batch_id = np.lexsort((order, loads, group_count, stratum_counts))[0]
+        batches[item] = batch_id
+        loads[batch_id] += costs[item]
+        stratum_counts[batch_id] += 1
+        group_count[batch_id] += 1
+    return batches
+
+
+def main(args):
+
+    sites = intermediates.read_table(
+        os.path.join(args.metadata_index, metadata_index.SITES_FILENAME)
+    )
+    controls = pd.concat([
+        pd.DataFrame({'control': 'negative', 'well': args.negative_wells}),
+        pd.DataFrame({'control': 'positive', 'well': args.positive_wells})
+    ], ignore_index=True)
+
+    plan = select_sites(
+        sites, args.plate, controls, args.n_sites * args.n_batches, args.seed
+    )
+    plan.insert(0, 'batch', assign_batches(
+        plan.cost.values, plan.well.values, args.n_batches,
+        plan.control.values
+    ))
+
+    intermediates.write_table(
+        plan, os.path.join(args.output_dir, PLAN_FILENAME)
+    )
+    columns = ['control', 'well', 'site_x', 'site_y']
+    for batch_id in range(args.n_batches):
+        intermediates.write_table(
+            plan.loc[plan.batch == batch_id, columns].reset_index(drop=True),
+            os.path.join(args.output_dir, batch_filename(batch_id))
+        )
+    if args.site_queue is not None:
+        # the most expensive sites are claimed first
+        site_queue.create(
+            args.site_queue,
+            plan.sort_values('cost', ascending=False, kind='mergesort')
+            .loc[:, columns].reset_index(drop=True)
+        )
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logging.basicConfig(
+        level=max(logging.WARNING - 10 * arguments.verbosity, logging.DEBUG)
+    )
+    main(arguments)
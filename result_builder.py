@@ -0,0 +1,87 @@
+'''
+Accumulate result tables row by row without copying them on every row.
+
+Growing a DataFrame with ``DataFrame.append`` copies the whole frame each
+time, so collecting n rows costs O(n^2). :class:`ResultBuilder` instead
+keeps one preallocated numpy array per column, doubles their capacity when
+they are full and builds the DataFrame once at the end.
+'''
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class ResultBuilder(object):
+    '''
+    Table with the given ``columns``, a sequence of ``(name, dtype)`` pairs.
+    Use ``object`` as dtype for strings and other Python objects.
+    '''
+
+    def __init__(self, columns, capacity=1024):
+        self._columns = OrderedDict(
+            (name, np.empty(capacity, dtype=dtype)) for name, dtype in columns
+        )
+        self._capacity = capacity
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, n):
+        needed = self._size + n
+        if needed <= self._capacity:
+            return
+        capacity = max(needed, 2 * self._capacity)
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+        self._capacity = capacity
+
+    def _check_names(self, values):
+        if set(values) != set(self._columns):
+            raise ValueError(
+                'expected values for columns %s, got %s'
+                % (sorted(self._columns), sorted(values))
+            )
+
+    def append(self, **row):
+        '''
+        Add one row. Every value is stored as is, so an object column can
+        hold e.g. an array per row.
+        '''
+        self._check_names(row)
+        self._reserve(1)
+        for name, column in self._columns.items():
+            column[self._size] = row[name]
+        self._size += 1
+
+    def extend(self, **values):
+        '''
+        Add several rows at once. Each value is either a sequence with one
+        element per row or a scalar shared by all rows.
+        '''
+        self._check_names(values)
+        lengths = set(
+            len(value) for value in values.values() if np.ndim(value) > 0
+        )
+        if len(lengths) > 1:
+            raise ValueError(
+                'columns have different lengths: %s' % sorted(lengths)
+            )
+        n = lengths.pop() if lengths else 1
+        self._reserve(n)
+        for name, column in self._columns.items():
+            column[self._size:self._size + n] = values[name]
+        self._size += n
+
+    def to_frame(self):
+        '''Return the rows added so far as a DataFrame'''
+        return pd.DataFrame(
+            OrderedDict(
+                (name, column[:self._size])
+                for name, column in self._columns.items()
+            ),
+            columns=list(self._columns)
+        )
@@ -0,0 +1,157 @@
+'''
+Append-only log of the results of a spot count job.
+
+Every analysed site is appended as one line of JSON and synced to disk
+before the job moves on, so a job that is killed or reaches its walltime
+loses at most the site it was working on. When the job is started again
+with the same log (e.g. resubmitted by GC3Pie), it reads the log back and
+skips the site/threshold pairs already in it; its output table is built
+from the records of the log whose thresholds it was asked for (see
+:func:`select`).
+
+The log starts with a header of the parameters its results depend on
+besides the site and the threshold (rescaling limits, filter, ...). A log
+written with other parameters is refused, so that a rerun with other
+settings never takes over stale counts.
+
+A line cut short by a crash is dropped when the log is opened.
+'''
+import errno
+import json
+import os
+
+import numpy as np
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+_HEADER = '_parameters'
+
+
+def _normalised(parameters):
+    # as read back from the log, e.g. tuples as lists
+    return json.loads(json.dumps(parameters, default=_to_json, sort_keys=True))
+
+
+class ResultsLog(object):
+    '''
+    Log in the file ``path``, created if it does not exist. ``parameters``
+    is a dict of the values besides the site and the threshold that the
+    results depend on; opening a log written with other parameters raises a
+    ValueError.
+    '''
+
+    def __init__(self, path, parameters=None):
+        self.path = path
+        self._records = []
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        if os.path.exists(path):
+            with open(path, 'rb+') as f:
+                content = f.read()
+                end = content.rfind(b'\n') + 1
+                for line in content[:end].splitlines():
+                    self._records.append(json.loads(line.decode('utf-8')))
+                if end < len(content):
+                    f.truncate(end)
+        header = None
+        if self._records and _HEADER in self._records[0]:
+            header = self._records.pop(0)[_HEADER]
+        self._file = open(path, 'ab')
+
+        if parameters is None:
+            return
+        parameters = _normalised(parameters)
+        if header is None and not self._records:
+            self._write({_HEADER: parameters})
+        elif header != parameters:
+            self._file.close()
+            raise ValueError(
+                'results log %s was written with other parameters (%s, now '
+                '%s); remove it or give another log to start over' % (
+                    path, json.dumps(header, sort_keys=True),
+                    json.dumps(parameters, sort_keys=True)
+                )
+            )
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        '''
+        Logged results in the order they were appended, each a dict of
+        column values as passed to :meth:`append`
+        '''
+        return list(self._records)
+
+    def append(self, **values):
+        '''
+        Log the results of one site, the values of a
+        :meth:`ResultBuilder.extend <result_builder.ResultBuilder.extend>`
+        call, and return once they are on disk
+        '''
+        record = dict((name, _to_json(v)) for name, v in values.items())
+        self._write(record)
+        self._records.append(record)
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        self._file.write(line.encode('utf-8'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def done(self, keys, column):
+        '''
+        Values of ``column`` logged for each site, a dict mapping the tuple
+        of the values of ``keys`` to a set
+        '''
+        done = dict()
+        for record in self._records:
+            values = record[column]
+            if np.ndim(values) == 0:
+                values = [values]
+            done.setdefault(
+                tuple(record[key] for key in keys), set()
+            ).update(values)
+        return done
+
+    def close(self):
+        self._file.close()
+
+
+def select(records, column, values):
+    '''
+    Yield the ``records`` restricted to the rows whose ``column`` is one of
+    ``values``, skipping records left without rows. Scalar values of a
+    record are shared by all its rows.
+    '''
+    values = np.asarray(values)
+    for record in records:
+        keep = np.isin(record[column], values)
+        if np.ndim(keep) == 0:
+            if keep:
+                yield record
+        elif keep.any():
+            yield dict(
+                (name, np.asarray(v)[keep] if np.ndim(v) > 0 else v)
+                for name, v in record.items()
+            )
+
+
+def remaining(done, key, values):
+    '''Elements of the array ``values`` not in ``done`` for ``key``'''
+    logged = done.get(key)
+    if not logged:
+        return values
+    return values[~np.isin(values, list(logged))]
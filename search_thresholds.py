@@ -0,0 +1,390 @@
+'''
+Adaptive search for the spot detection threshold.
+
+Instead of counting spots for every threshold of a fixed grid on every
+site, the coarse grid is run on a few pilot sites of each control only.
+Among the thresholds that separate the positive from the negative control
+well, the one where the positive spot count is flattest (its plateau) is
+then refined by sweeping a finer grid over the interval around it, until it
+moves by no more than the tolerance. The spot count jobs of the full run
+only sweep the final interval.
+
+The pilot images are downloaded, rescaled and filtered once (python
+backend); each round only thresholds them again.
+'''
+import argparse
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+import histogram_percentile
+import image_cache
+import intermediates
+import matlab_pool
+import spot_detection
+from detection_parameters import (
+    FILTER_ARGS, IMG_LIMES, rescaling_thresholds
+)
+from result_builder import ResultBuilder
+from threshold_sweep import count_objects_series
+
+
+logger = logging.getLogger(__name__)
+
+CONTROLS = ('negative', 'positive')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='search_thresholds',
+        description=('Searches the spot detection threshold that separates '
+                     'positive and negative controls on pilot sites, from a '
+                     'coarse grid down to the given tolerance. Writes the '
+                     'threshold range for the full run.')
+    )
+    parser.add_argument(
+        '-v', '--verbosity', action='count', default=0,
+        help='increase logging verbosity'
+    )
+    parser.add_argument(
+        '-H', '--host', default='app.tissuemaps.org',
+        help='name of TissueMAPS server host'
+    )
+    parser.add_argument(
+        '-P', '--port', type=int, default=80,
+        help='number of the port to which the server listens (default: 80)'
+    )
+    parser.add_argument(
+        '-u', '--user', dest='username', required=True,
+        help='name of TissueMAPS user'
+    )
+    parser.add_argument(
+        '--password', required=True,
+        help='password of TissueMAPS user'
+    )
+    parser.add_argument(
+        '-e', '--experiment', required=True,
+        help='experiment name'
+    )
+    parser.add_argument(
+        '-p', '--plate', type=str, default='plate01',
+        help='plate name'
+    )
+    parser.add_argument(
+        '-c', '--channel', type=str, default='wavelength-2',
+        help='channel name'
+    )
+    parser.add_argument(
+        '--input_batch_files', type=str, nargs='+', required=True,
+        help='intensity extrema of the sites (.arrow)'
+    )
+    parser.add_argument(
+        '--input_aggregate_file', type=str, required=True,
+        help='filename for the aggregated input file (.arrow)'
+    )
+    parser.add_argument(
+        '-n', '--pilot_sites', type=int, default=5,
+        help='number of pilot sites per control (default: 5)'
+    )
+    parser.add_argument(
+        '-t', '--thresholds', default=[0.02, 0.04, 0.02],
+        nargs=3, metavar=('start', 'end', 'step'),
+        type=float, help='coarse range of thresholds'
+    )
+    parser.add_argument(
+        '--hard_rescaling', default=[0.0, 0.0, 0.0, 0.0],
+        nargs=4, type=float,
+        help='specify hard rescaling thresholds (if required)'
+    )
+    parser.add_argument(
+        '--points', type=int, default=5,
+        help=('number of thresholds swept per refinement and by the full '
+              'run (default: 5)')
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=None,
+        help=('stop once the threshold moves by no more than this '
+              '(default: a quarter of the coarse step)')
+    )
+    parser.add_argument(
+        '--min_separation', type=float, default=0.9,
+        help=('separation of the controls a threshold needs to be chosen '
+              '(see separation(); default: 0.9)')
+    )
+    parser.add_argument(
+        '--max_rounds', type=int, default=10,
+        help='maximum number of refinements (default: 10)'
+    )
+    parser.add_argument(
+        '--backend', type=str, default='python',
+        choices=['matlab_pool', 'python'],
+        help='implementation of spot detection (default: python)'
+    )
+    parser.add_argument(
+        '--pool_address', type=str, default=matlab_pool.DEFAULT_ADDRESS,
+        help='socket of the MATLAB pool used by the matlab_pool backend'
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='directory of an image cache shared between jobs (optional)'
+    )
+    parser.add_argument(
+        '--cache_size', type=float, default=50.0,
+        help='maximum size of the image cache in GB (default: 50)'
+    )
+    parser.add_argument(
+        '-o', '--output_file', type=str, default='threshold_search.json',
+        help=('filename for the chosen threshold and range (.json); the '
+              'counts of all thresholds tried are written next to it '
+              '(.arrow)')
+    )
+
+    return(parser.parse_args())
+
+
+def pilot_sites(sites, n):
+    '''
+    The first ``n`` of ``sites`` of each control, which has to be one of
+    :data:`CONTROLS`; both controls need pilot sites
+    '''
+    unknown = sorted(set(sites['control']) - set(CONTROLS))
+    if unknown:
+        raise ValueError(
+            'sites of unknown controls %s (expected %s)'
+            % (', '.join(map(str, unknown)), ' and '.join(CONTROLS))
+        )
+    if n < 1:
+        raise ValueError('at least one pilot site per control is needed')
+    pilot = sites.groupby('control', sort=True).head(n)
+    missing = [c for c in CONTROLS if not np.any(pilot['control'] == c)]
+    if missing:
+        raise ValueError(
+            'no sites of the %s control' % ' and '.join(missing)
+        )
+    return pilot
+
+
+def separation(negative, positive):
+    '''
+    Contrast of the mean spot counts of the positive and the negative
+    control at each threshold: 1 where only positive sites have spots, 0
+    where both controls have equally many (or none)
+    '''
+    negative = np.asarray(negative, dtype=np.float64)
+    positive = np.asarray(positive, dtype=np.float64)
+    total = negative + positive
+    contrast = np.zeros(len(total))
+    np.divide(positive - negative, total, out=contrast, where=total > 0)
+    return contrast
+
+
+def relative_slope(thresholds, counts):
+    '''
+    Relative change of ``counts`` per unit of the (sorted) ``thresholds``,
+    ``|dcounts / dthreshold| / counts``: small where the counts plateau,
+    infinite where there are none
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    slope = np.full(len(counts), np.inf)
+    if len(counts) < 2:
+        slope[counts > 0] = 0.0
+        return slope
+    gradient = np.abs(np.gradient(counts, thresholds))
+    np.divide(gradient, counts, out=slope, where=counts > 0)
+    return slope
+
+
+def choose(thresholds, negative, positive, min_separation=0.9):
+    '''
+    Index of the threshold on the plateau of the positive control: the
+    smallest :func:`relative_slope` of the positive counts among the
+    thresholds whose :func:`separation` is at least ``min_separation``
+    (or the best separation reached, if lower)
+    '''
+    contrast = separation(negative, positive)
+    good = contrast >= min(min_separation, contrast.max())
+    slope = relative_slope(thresholds, positive)
+    if not np.any(np.isfinite(slope[good])):
+        return int(np.argmax(contrast))
+    return int(np.argmin(np.where(good, slope, np.inf)))
+
+
+def search(count, start, end, step, points=5, tolerance=None, max_rounds=10,
+           min_separation=0.9):
+    '''
+    Refine the threshold on the plateau of the positive control (see
+    :func:`choose`), starting from the grid ``np.arange(start, end, step)``.
+    ``count(thresholds)`` returns the mean spot counts of the negative and
+    of the positive control for each of ``thresholds``.
+
+    Returns the chosen threshold, the interval around it that the full run
+    should sweep and a dict mapping each threshold tried to its counts.
+    '''
+    if tolerance is None:
+        tolerance = step / 4.0
+    tried = dict()
+
+    def evaluate(thresholds):
+        new = [t for t in thresholds if t not in tried]
+        if new:
+            negative, positive = count(np.array(new))
+            for t, n, p in zip(new, negative, positive):
+                tried[t] = (n, p)
+
+    evaluate(np.arange(start, end, step).tolist())
+    chosen = None
+    for round_ in range(max_rounds + 1):
+        thresholds = sorted(tried)
+        counts = np.array([tried[t] for t in thresholds])
+        best = choose(
+            thresholds, counts[:, 0], counts[:, 1], min_separation
+        )
+        previous, chosen = chosen, thresholds[best]
+        lower = thresholds[max(best - 1, 0)]
+        upper = thresholds[min(best + 1, len(thresholds) - 1)]
+        logger.info(
+            'round %d: threshold %g, interval [%g, %g]',
+            round_, chosen, lower, upper
+        )
+        if previous is not None and abs(chosen - previous) <= tolerance:
+            break
+        if upper - lower <= 2 * tolerance or round_ == max_rounds:
+            break
+        evaluate(np.linspace(lower, upper, points).tolist())
+
+    return chosen, (lower, upper), tried
+
+
+def sweep_range(lower, upper, points):
+    '''
+    ``--thresholds start end step`` sweeping ``points`` thresholds from
+    ``lower`` to ``upper``
+    '''
+    if points < 2 or upper <= lower:
+        # ``lower`` alone
+        step = max(abs(lower), 1.0) * 1e-6
+        return [lower, lower + step / 2.0, step]
+    step = (upper - lower) / (points - 1)
+    return [lower, upper + step / 2.0, step]
+
+
+def main(args):
+    from tmclient import TmClient
+
+    sites = pd.concat([
+        intermediates.read_table(
+            filename,
+            columns=[
+                name for name in intermediates.read_schema(filename).names
+                if name not in histogram_percentile.HISTOGRAM_COLUMNS
+            ]
+        )
+        for filename in args.input_batch_files
+    ], ignore_index=True)
+    pilot = pilot_sites(sites, args.pilot_sites)
+
+    aggregated_limits = intermediates.read_table(args.input_aggregate_file)
+    rescale_thr = rescaling_thresholds(aggregated_limits, args.hard_rescaling)
+
+    tmaps_api = TmClient(
+        host=args.host,
+        port=args.port,
+        experiment_name=args.experiment,
+        username=args.username,
+        password=args.password
+    )
+    tmaps_api = image_cache.cached_client(
+        tmaps_api, args.experiment, args.cache_dir, args.cache_size
+    )
+
+    if args.backend == 'matlab_pool':
+        pool = matlab_pool.MatlabPool(args.pool_address)
+    else:
+        op = spot_detection.fspecial_cp3d(*FILTER_ARGS)
+
+    # images of the pilot sites, filtered unless they go to the pool
+    images = {control: [] for control in CONTROLS}
+    for index, row in pilot.iterrows():
+        image = tmaps_api.download_channel_image(
+            channel_name=args.channel,
+            plate_name=args.plate,
+            well_name=row['well'],
+            well_pos_y=row['site_y'],
+            well_pos_x=row['site_x'],
+            correct=True
+        )
+        if args.backend == 'python':
+            image = spot_detection.filter_image(
+                image, op, IMG_LIMES, rescale_thr
+            )
+        images[row['control']].append(image)
+
+    def mean_counts(control, thresholds):
+        if args.backend == 'matlab_pool':
+            counts = [
+                pool.count_spots(
+                    image, FILTER_ARGS, thresholds, IMG_LIMES, rescale_thr,
+                    close_holes=True
+                )
+                for image in images[control]
+            ]
+        else:
+            counts = [
+                count_objects_series(image, thresholds, close_holes=True)
+                for image in images[control]
+            ]
+        return np.mean(counts, axis=0)
+
+    def count(thresholds):
+        return (
+            mean_counts('negative', thresholds),
+            mean_counts('positive', thresholds)
+        )
+
+    chosen, (lower, upper), tried = search(
+        count, args.thresholds[0], args.thresholds[1], args.thresholds[2],
+        args.points, args.tolerance, args.max_rounds, args.min_separation
+    )
+    if args.backend == 'matlab_pool':
+        pool.close()
+
+    thresholds = sorted(tried)
+    table = ResultBuilder([
+        ('threshold', np.float64),
+        ('negative', np.float64),
+        ('positive', np.float64),
+        ('separation', np.float64),
+        ('positive_relative_slope', np.float64)
+    ])
+    negative, positive = np.array([tried[t] for t in thresholds]).T
+    table.extend(
+        threshold=thresholds,
+        negative=negative,
+        positive=positive,
+        separation=separation(negative, positive),
+        positive_relative_slope=relative_slope(thresholds, positive)
+    )
+    intermediates.write_table(
+        table.to_frame(),
+        args.output_file.rsplit('.', 1)[0] + intermediates.EXTENSION
+    )
+
+    with open(args.output_file, 'w') as f:
+        json.dump({
+            'threshold': chosen,
+            'thresholds': sweep_range(lower, upper, args.points),
+            'tried': len(thresholds)
+        }, f, indent=2)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logging.basicConfig(
+        level=max(logging.WARNING - 10 * arguments.verbosity, logging.DEBUG)
+    )
+    main(arguments)
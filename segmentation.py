@@ -0,0 +1,94 @@
+'''
+Cell segmentation of the 3D spot count jobs, with a persistent cache of the
+label images.
+
+The cells of a site depend only on its DAPI and SE images and on the
+segmentation parameters, not on any spot detection parameter. With a
+:class:`LabelCache`, reruns of the spot counts (e.g. with other thresholds,
+filter sizes or rescalings) read the label image of a site back instead of
+downloading DAPI and SE and segmenting again. Label images are stored
+compressed (see image_cache.py) under a key that includes the parameters,
+so changing a parameter never returns stale labels.
+'''
+from collections import OrderedDict
+
+from image_cache import ArrayCache
+
+
+DEFAULT_PARAMETERS = OrderedDict([
+    ('nuclei_smooth_sigma', 3),
+    ('nuclei_threshold', 115),
+    ('min_nucleus_area', 2000),
+    ('se_smooth_size', 7),
+    ('contrast_threshold', 3),
+    ('min_threshold', 116),
+    ('max_threshold', 120)
+])
+
+
+def segment_cells(dapi, se, parameters=DEFAULT_PARAMETERS):
+    '''
+    Label image of the cells: nuclei thresholded in the smoothed DAPI image
+    and grown into the smoothed SE image
+    '''
+    from jtmodules import smooth, fill, filter, threshold_manual, label, register_objects, segment_secondary
+
+    dapi_smooth = smooth.main(
+        dapi, 'gaussian', parameters['nuclei_smooth_sigma'], plot=False
+    )
+    nuclei = threshold_manual.main(
+        image=dapi_smooth.smoothed_image,
+        threshold=parameters['nuclei_threshold']
+    )
+    nuclei = fill.main(nuclei.mask, plot=False)
+    nuclei = filter.main(
+        mask=nuclei.filled_mask,
+        feature='area',
+        lower_threshold=parameters['min_nucleus_area'],
+        upper_threshold=None,
+        plot=False
+    )
+    nuclei = label.main(
+        mask=nuclei.filtered_mask
+    )
+    nuclei = register_objects.main(
+        nuclei.label_image
+    )
+    se_smooth = smooth.main(se, 'bilateral', parameters['se_smooth_size'])
+    cells = segment_secondary.main(
+        nuclei.objects, se_smooth.smoothed_image,
+        contrast_threshold=parameters['contrast_threshold'],
+        min_threshold=parameters['min_threshold'],
+        max_threshold=parameters['max_threshold'])
+
+    return cells.secondary_label_image
+
+
+class LabelCache(object):
+    '''
+    Label images of the sites of ``experiment_name`` segmented with
+    ``parameters``, stored in ``directory``
+    '''
+
+    def __init__(self, directory, experiment_name,
+                 parameters=DEFAULT_PARAMETERS):
+        self._cache = ArrayCache(directory)
+        self._experiment_name = experiment_name
+        self._parameters = tuple(parameters.items())
+
+    def _key(self, plate_name, well_name, well_pos_y, well_pos_x):
+        return (
+            'cells', self._experiment_name, plate_name, well_name,
+            int(well_pos_y), int(well_pos_x), self._parameters
+        )
+
+    def get(self, plate_name, well_name, well_pos_y, well_pos_x):
+        '''Return the cached label image of the site or ``None``'''
+        return self._cache.get(
+            self._key(plate_name, well_name, well_pos_y, well_pos_x)
+        )
+
+    def put(self, plate_name, well_name, well_pos_y, well_pos_x, labels):
+        self._cache.put(
+            self._key(plate_name, well_name, well_pos_y, well_pos_x), labels
+        )
@@ -0,0 +1,108 @@
+'''
+Concurrent download of all images of an acquisition site.
+'''
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+
+class SiteFetcher(object):
+    '''
+    Downloads the channel images and z-planes of a site in parallel with at
+    most ``max_workers`` requests in flight.
+
+    Every worker thread gets its own client from ``client_factory`` (e.g. a
+    ``TmClient``) and keeps it for the lifetime of the fetcher, so each
+    thread reuses its HTTP connection across planes and sites.
+    '''
+
+    def __init__(self, client_factory, max_workers=8):
+        self._client_factory = client_factory
+        self._max_workers = max_workers
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _download(self, **kwargs):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._client_factory()
+        return client.download_channel_image(**kwargs)
+
+    def fetch_site(self, plate_name, well_name, well_pos_y, well_pos_x,
+                   channels, stack_channel, stack_shape, correct=False,
+                   stack=None):
+        '''
+        Download the images of ``channels`` and all z-planes of
+        ``stack_channel`` for one site.
+
+        Returns a dict of the 2D images by channel name and the
+        (height, width, z) stack, which is filled in place as planes
+        arrive. ``stack`` may be passed to reuse an existing array. If
+        ``stack_channel`` is ``None``, no stack is downloaded and ``None``
+        is returned in its place.
+        '''
+        if stack is None and stack_channel is not None:
+            stack = np.zeros(stack_shape, dtype=np.uint16)
+        site = dict(
+            plate_name=plate_name,
+            well_name=well_name,
+            well_pos_y=well_pos_y,
+            well_pos_x=well_pos_x,
+            correct=correct
+        )
+
+        futures = dict()
+        for channel in channels:
+            future = self._executor.submit(
+                self._download, channel_name=channel, **site
+            )
+            futures[future] = (channel, None)
+        for z in range(stack_shape[2] if stack_channel is not None else 0):
+            future = self._executor.submit(
+                self._download, channel_name=stack_channel, zplane=z, **site
+            )
+            futures[future] = (stack_channel, z)
+
+        images = dict()
+        try:
+            for future in as_completed(futures):
+                channel, z = futures[future]
+                if z is None:
+                    images[channel] = future.result()
+                else:
+                    stack[:, :, z] = future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+        return images, stack
+
+    def images(self, requests, max_ahead=None):
+        '''
+        Yield the image of every request of ``requests``, each a dict of
+        the keyword arguments of ``download_channel_image``, in order.
+
+        At most ``max_ahead`` images (by default twice the number of
+        workers) are downloaded or in flight ahead of the one being used.
+        '''
+        if max_ahead is None:
+            max_ahead = 2 * self._max_workers
+        futures = collections.deque()
+        try:
+            for request in requests:
+                futures.append(
+                    self._executor.submit(self._download, **request)
+                )
+                if len(futures) >= max_ahead:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,73 @@
+'''
+Overlap the download of upcoming sites with the analysis of the current one.
+'''
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_DONE = object()
+
+
+def max_in_flight(depth, item_bytes=None, memory=None):
+    '''
+    Number of loaded items :func:`prefetch` may hold at a time when
+    loading up to ``depth`` items ahead, limited to what fits into
+    ``memory`` bytes for items of ``item_bytes`` bytes each.
+    '''
+    limit = depth + 1
+    if memory is not None and item_bytes:
+        # the consumer still references the previous item while the next
+        # one is being loaded
+        limit = min(limit, int(memory // item_bytes) - 1)
+    return max(limit, 1)
+
+
+def prefetch(load, items, max_in_flight=2):
+    '''
+    Yield ``(item, load(item))`` for every item of ``items``, in order.
+
+    ``load`` runs in a background thread ahead of the consumer, holding at
+    most ``max_in_flight`` loaded items at a time, including the one the
+    consumer is working on. Exceptions raised by ``load`` are raised in
+    the consumer.
+    '''
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be at least 1')
+    slots = threading.Semaphore(max_in_flight)
+    loaded = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                loaded.put((item, load(item), None))
+        except Exception as error:
+            loaded.put((None, None, error))
+        else:
+            loaded.put(_DONE)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            entry = loaded.get()
+            if entry is _DONE:
+                return
+            item, data, error = entry
+            if error is not None:
+                raise error
+            yield item, data
+            del data
+            slots.release()
+    finally:
+        # lets the producer run into the stop flag if the consumer quits
+        stop.set()
+        slots.release()
@@ -0,0 +1,321 @@
+'''
+Shared queue of sites for the spot count workers.
+
+Instead of processing a fixed batch, a worker started with ``--site_queue``
+claims one site at a time from an SQLite database on a filesystem shared by
+all workers and keeps going until no site is left. Fast workers and grid
+slots that start late thereby take over work that would otherwise wait for
+the slowest batch.
+
+Claims are made in ``BEGIN IMMEDIATE`` transactions, so two workers never
+claim the same site. A worker refreshes its claims whenever it claims the
+next site; claims not refreshed for longer than the lease of the queue
+(e.g. of a worker that was killed) are handed out again. Sites are marked
+done once their results are in the worker's results log (results_log.py);
+a worker restarted under the same name settles the claims of its earlier
+run first.
+
+Create the queue from a table of sites, e.g.::
+
+    python site_queue.py --input_files site_plan.arrow --queue sites.db
+'''
+import argparse
+import errno
+import os
+import socket
+import sqlite3
+import time
+
+import pandas as pd
+
+import intermediates
+
+
+DEFAULT_LEASE = 2 * 60 * 60
+
+# seconds a worker keeps trying to lock the queue before giving up
+LOCK_TIMEOUT = 10 * 60
+
+_SQL_TYPES = {'i': 'INTEGER', 'u': 'INTEGER', 'f': 'REAL', 'b': 'INTEGER'}
+
+_STATE_COLUMNS = ['state', 'worker', 'claimed_at', 'attempts']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='site_queue',
+        description=('Creates the queue of sites worked off by spot count '
+                     'jobs started with --site_queue.')
+    )
+    parser.add_argument(
+        '-v', '--verbosity', action='count', default=0,
+        help='increase logging verbosity'
+    )
+    parser.add_argument(
+        '-i', '--input_files', type=str, nargs='+', required=True,
+        help='tables of the sites to be queued (.arrow)'
+    )
+    parser.add_argument(
+        '-q', '--queue', type=str, required=True,
+        help='filename of the queue database (.db)'
+    )
+    parser.add_argument(
+        '-e', '--exclude_columns', type=str, nargs='+', default=[],
+        help='columns of the input tables not stored in the queue'
+    )
+    parser.add_argument(
+        '--lease', type=float, default=DEFAULT_LEASE,
+        help=('seconds after which sites claimed by a worker that has '
+              'stopped claiming are handed out again (default: %(default)s)')
+    )
+
+    return(parser.parse_args())
+
+
+def _connect(path, timeout=60):
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _begin_immediate(connection, timeout):
+    '''
+    Begin a write transaction, retrying for up to ``timeout`` seconds while
+    the database is locked (SQLite's own busy timeout does not always hold
+    on shared filesystems)
+    '''
+    deadline = time.time() + timeout
+    delay = 0.1
+    while True:
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as error:
+            if 'locked' not in str(error) or time.time() + delay > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(2 * delay, 10.0)
+
+
+def create(path, sites, lease=DEFAULT_LEASE):
+    '''
+    Create the queue ``path`` holding the rows of the DataFrame ``sites``
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+    if os.path.exists(path):
+        os.remove(path)
+
+    columns = ', '.join(
+        '"{0}" {1}'.format(name, _SQL_TYPES.get(dtype.kind, 'TEXT'))
+        for name, dtype in sites.dtypes.items()
+    )
+    connection = _connect(path)
+    try:
+        connection.execute('CREATE TABLE settings (lease REAL)')
+        connection.execute('INSERT INTO settings VALUES (?)', (lease,))
+        connection.execute(
+            'CREATE TABLE sites (id INTEGER PRIMARY KEY, {0}, '
+            "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, "
+            'claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0)'
+            .format(columns)
+        )
+        connection.execute('CREATE INDEX sites_state ON sites (state)')
+        connection.execute('BEGIN')
+        connection.executemany(
+            'INSERT INTO sites ({0}) VALUES ({1})'.format(
+                ', '.join('"%s"' % name for name in sites.columns),
+                ', '.join('?' for _ in sites.columns)
+            ),
+            (
+                tuple(v.item() if hasattr(v, 'item') else v for v in row)
+                for row in sites.itertuples(index=False)
+            )
+        )
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+
+def _site(row):
+    '''Columns of the queued site ``row`` as a Series'''
+    return pd.Series(
+        dict((key, row[key]) for key in row.keys()
+             if key not in _STATE_COLUMNS + ['id'])
+    )
+
+
+def default_worker():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class SiteQueue(object):
+    '''
+    Worker side of a queue created with :func:`create`. Claims and state
+    changes wait up to ``lock_timeout`` seconds for the queue to be unlocked.
+    '''
+
+    def __init__(self, path, worker=None, lock_timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.worker = worker or default_worker()
+        self.lock_timeout = lock_timeout
+        connection = _connect(path)
+        try:
+            self.lease = connection.execute(
+                'SELECT lease FROM settings'
+            ).fetchone()[0]
+        finally:
+            connection.close()
+
+    def claim(self):
+        '''
+        Claim the next site. Returns its id and its columns as a Series, or
+        ``None`` if no site is left to claim.
+        '''
+        connection = self._connect()
+        try:
+            _begin_immediate(connection, self.lock_timeout)
+            now = time.time()
+            try:
+                # keep the sites this worker is still working on
+                connection.execute(
+                    "UPDATE sites SET claimed_at = ? "
+                    "WHERE state = 'claimed' AND worker = ?",
+                    (now, self.worker)
+                )
+                row = connection.execute(
+                    "SELECT * FROM sites WHERE state = 'pending' "
+                    "OR (state = 'claimed' AND claimed_at < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (now - self.lease,)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE sites SET state = 'claimed', worker = ?, "
+                        "claimed_at = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (self.worker, now, row['id'])
+                    )
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+
+        if row is None:
+            return None
+        return row['id'], _site(row)
+
+    def claims(self):
+        '''
+        Claim sites until the queue is empty, yielding ``(id, site)`` like
+        ``DataFrame.iterrows``
+        '''
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                return
+            yield claimed
+
+    def _connect(self):
+        return _connect(self.path, min(self.lock_timeout, 60))
+
+    def _set_state(self, site_ids, state):
+        connection = self._connect()
+        try:
+            _begin_immediate(connection, self.lock_timeout)
+            try:
+                connection.executemany(
+                    'UPDATE sites SET state = ?, claimed_at = ? '
+                    "WHERE id = ? AND state = 'claimed' AND worker = ?",
+                    [(state, time.time(), int(i), self.worker)
+                     for i in site_ids]
+                )
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+
+    def complete(self, site_ids):
+        '''Mark the sites ``site_ids`` claimed by this worker as done'''
+        self._set_state(site_ids, 'done')
+
+    def release(self, site_ids):
+        '''Return the sites ``site_ids`` claimed by this worker to the queue'''
+        self._set_state(site_ids, 'pending')
+
+    def recover(self, is_done):
+        '''
+        Settle the sites left claimed by an earlier run of this worker: mark
+        those for which ``is_done(site)`` holds as done and return the
+        others to the queue
+        '''
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT * FROM sites WHERE state = 'claimed' AND worker = ?",
+                (self.worker,)
+            ).fetchall()
+        finally:
+            connection.close()
+        done = []
+        for row in rows:
+            if is_done(_site(row)):
+                done.append(row['id'])
+        self.complete(done)
+        self.release([row['id'] for row in rows if row['id'] not in done])
+
+    def completed(self):
+        '''Ids of the sites completed by this worker'''
+        connection = self._connect()
+        try:
+            return [
+                row['id'] for row in connection.execute(
+                    "SELECT id FROM sites WHERE state = 'done' "
+                    "AND worker = ? ORDER BY id",
+                    (self.worker,)
+                )
+            ]
+        finally:
+            connection.close()
+
+    def sites(self, site_ids):
+        '''DataFrame of the columns of the sites ``site_ids``'''
+        connection = self._connect()
+        try:
+            frame = pd.read_sql_query(
+                'SELECT * FROM sites WHERE id IN ({0}) ORDER BY id'.format(
+                    ', '.join(str(int(i)) for i in site_ids)
+                ),
+                connection
+            )
+        finally:
+            connection.close()
+        return frame.drop(_STATE_COLUMNS + ['id'], axis=1)
+
+
+def main(args):
+
+    sites = pd.concat(
+        [intermediates.read_table(f) for f in args.input_files],
+        ignore_index=True
+    )
+    sites = sites.drop(
+        [c for c in args.exclude_columns if c in sites.columns], axis=1
+    )
+    create(args.queue, sites, args.lease)
+
+    return
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments)
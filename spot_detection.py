@@ -0,0 +1,326 @@
+'''
+Native implementation of the JtLibrary spot detection used by
+IdentifySpots2D: cpsub.fspecialCP3D builds the Laplacian of Gaussian
+kernel and cpsub.ObjByFilter rescales, filters and thresholds the image.
+'''
+import collections
+
+import numpy as np
+from scipy import ndimage
+
+import histogram_percentile
+from threshold_sweep import count_objects_series, count_objects_sparse
+
+
+# imfilter(..., 'replicate') in ObjByFilter.m
+BOUNDARY_MODE = 'nearest'
+
+
+# filter kernel written as a sum of separable terms: each term is a pair
+# of a weight and a list with one 1D kernel per image axis
+SeparableFilter = collections.namedtuple(
+    'SeparableFilter', ['shape', 'terms']
+)
+
+
+def fspecial_cp3d(filter_type, *args):
+    '''
+    Python equivalent of cpsub.fspecialCP3D for the filter types used by
+    the spot count scripts. The returned kernel is sign-inverted so that
+    spots give a positive response.
+
+    '2D LoG', hsize:
+        fspecial('log', hsize, (hsize - 1) / 3)
+    '3D LoG, Raj', hsize, sigma, zsize:
+        LoG of width sigma on a hsize x hsize x zsize grid
+    '''
+    if filter_type == '2D LoG':
+        hsize = float(args[0])
+        return _log_filter((hsize, hsize), (hsize - 1.0) / 3.0)
+    elif filter_type == '3D LoG, Raj':
+        hsize, sigma, zsize = [float(a) for a in args[:3]]
+        return _log_filter((hsize, hsize, zsize), sigma)
+    raise ValueError('Unsupported filter type "%s"' % filter_type)
+
+
+def _log_filter(shape, sigma):
+    # same normalisation as fspecial('log'): the Gaussian sums to one and
+    # the kernel to zero. Both the Gaussian and the x^2 + y^2 (+ z^2)
+    # factor are separable, so the kernel is a sum of ndim + 1 terms.
+    std2 = sigma ** 2
+    axes = [
+        np.arange(int(round(n)), dtype=np.float64) - (round(n) - 1.0) / 2.0
+        for n in shape
+    ]
+    gaussians = [np.exp(-x ** 2 / (2 * std2)) for x in axes]
+    gaussians = [g / g.sum() for g in gaussians]
+    curvatures = [
+        g * (x ** 2 - std2) / std2 ** 2 for g, x in zip(gaussians, axes)
+    ]
+
+    terms = []
+    total = 0.0
+    for axis in range(len(shape)):
+        kernels = list(gaussians)
+        kernels[axis] = curvatures[axis]
+        terms.append((-1.0, kernels))
+        total += np.prod([k.sum() for k in kernels])
+    # subtract the mean to make the kernel sum to zero
+    terms.append((
+        total / np.prod([len(x) for x in axes]),
+        [np.ones(len(x)) for x in axes]
+    ))
+
+    return SeparableFilter(
+        shape=tuple(len(x) for x in axes),
+        terms=[
+            (weight, [k.astype(np.float32) for k in kernels])
+            for weight, kernels in terms
+        ]
+    )
+
+
+def dense_kernel(op):
+    '''Expand a SeparableFilter into its full kernel array'''
+    kernel = np.zeros(op.shape, dtype=np.float64)
+    for weight, kernels in op.terms:
+        term = np.array(weight)
+        for k in kernels:
+            term = np.multiply.outer(term, k)
+        kernel += term
+    return kernel
+
+
+def image_quantiles(image, img_limes):
+    '''The ``img_limes`` quantiles of ``image``, as MATLAB computes them'''
+    # MATLAB's quantile corresponds to the 'hazen' definition
+    lower, upper = np.percentile(
+        image, [100.0 * img_limes[0], 100.0 * img_limes[1]],
+        method='hazen'
+    )
+    return lower, upper
+
+
+def rescaling_limits(quantiles, rescale_thr):
+    '''
+    Lower and upper rescaling limits: the image ``quantiles`` clamped to
+    [rescale_thr[0], rescale_thr[1]] and [rescale_thr[2], rescale_thr[3]]
+    respectively
+    '''
+    lower = min(max(quantiles[0], rescale_thr[0]), rescale_thr[1])
+    upper = min(max(quantiles[1], rescale_thr[2]), rescale_thr[3])
+    return lower, upper
+
+
+def rescale_image(image, img_limes, rescale_thr, limits=None):
+    '''
+    Rescale intensities to [0, 1] like ObjByFilter.m, between the
+    :func:`rescaling_limits` of the ``img_limes`` quantiles of the image.
+    Pass ``limits`` to reuse limits computed before.
+    '''
+    if limits is None:
+        limits = rescaling_limits(
+            image_quantiles(image, img_limes), rescale_thr
+        )
+    lower, upper = limits
+
+    # float32 limits: numpy 2 would promote the image to float64 for limits
+    # that are numpy floats (e.g. quantiles), doubling its memory
+    rescaled = np.clip(
+        image.astype(np.float32), np.float32(lower), np.float32(upper)
+    )
+    rescaled -= np.float32(lower)
+    rescaled /= np.float32(upper - lower)
+    return rescaled
+
+
+def filter_image(image, op, img_limes, rescale_thr, limits=None):
+    '''
+    Rescale ``image`` and correlate it with ``op`` in float32, returning
+    the image that ObjByFilter.m thresholds.
+    '''
+    rescaled = rescale_image(image, img_limes, rescale_thr, limits)
+    filtered = np.zeros(rescaled.shape, dtype=np.float32)
+    for weight, kernels in op.terms:
+        term = rescaled
+        for axis, kernel in enumerate(kernels):
+            # imfilter centres even-sized kernels at (n - 1) / 2, scipy
+            # at n / 2
+            term = ndimage.correlate1d(
+                term, kernel, axis=axis, mode=BOUNDARY_MODE,
+                origin=(len(kernel) - 1) // 2 - len(kernel) // 2
+            )
+        filtered += np.float32(weight) * term
+    return filtered
+
+
+def count_spots(image, op, thresholds, img_limes, rescale_thr,
+                close_holes=False, check_thresholds=0):
+    '''
+    Number of objects ObjByFilter.m detects in ``image`` for each of
+    ``thresholds`` (see :func:`threshold_sweep.count_objects_series` for
+    ``check_thresholds``).
+    '''
+    filtered = filter_image(image, op, img_limes, rescale_thr)
+    return count_objects_series(
+        filtered, thresholds, close_holes, check_thresholds
+    )
+
+
+# float32 arrays that filter_image holds per voxel at its peak: the
+# rescaled image, the filtered image and the two terms being correlated,
+# plus a masked uint16 copy of the input
+FILTER_BYTES_PER_VOXEL = 4 * 4 + 2
+
+
+def masked(image, mask, background):
+    '''
+    Copy of ``image`` with the pixels outside the 2D ``mask`` set to
+    ``background`` in every z-plane (``image`` itself if ``mask`` is
+    ``None``)
+    '''
+    if mask is None:
+        return image
+    mask = mask.reshape(mask.shape + (1,) * (image.ndim - mask.ndim))
+    return np.where(mask, image, image.dtype.type(background))
+
+
+def tile_shape(image_shape, op, max_bytes):
+    '''
+    Largest square XY tile of an image of ``image_shape`` that
+    :func:`filter_image` can filter, with a halo of the size of ``op`` on
+    every side, in ``max_bytes``
+    '''
+    halo = max(op.shape[:2])
+    voxels = max_bytes // FILTER_BYTES_PER_VOXEL
+    side = int(np.sqrt(voxels // int(np.prod(image_shape[2:])))) - 2 * halo
+    if side < 1:
+        raise ValueError(
+            '%d bytes are too few to filter tiles of an image of shape %s'
+            % (max_bytes, image_shape)
+        )
+    return min(side, image_shape[0]), min(side, image_shape[1])
+
+
+def tiles(image_shape, tile, halo):
+    '''
+    Tiles of the first two axes of an image of ``image_shape``, each a pair
+    of the slices of its core and of the core extended by ``halo`` (clipped
+    to the image). The cores cover the image without overlap.
+    '''
+    for y in range(0, image_shape[0], tile[0]):
+        for x in range(0, image_shape[1], tile[1]):
+            core = (
+                slice(y, min(y + tile[0], image_shape[0])),
+                slice(x, min(x + tile[1], image_shape[1]))
+            )
+            outer = tuple(
+                slice(max(c.start - h, 0), min(c.stop + h, n))
+                for c, h, n in zip(core, halo, image_shape)
+            )
+            rest = tuple(slice(0, n) for n in image_shape[2:])
+            yield core + rest, outer + rest
+
+
+def masked_quantiles(image, img_limes, max_bytes, mask=None, background=0):
+    '''
+    :func:`image_quantiles` of ``masked(image, mask, background)`` for an
+    integer ``image``, from the pooled histograms of XY tiles so that no
+    more than ``max_bytes`` are allocated for the tiles (plus a few
+    histograms, 8 bytes per grey value)
+    '''
+    # a masked (or contiguous) copy of the tile, its flattened copy and the
+    # intp values that np.bincount counts, plus their offset copy for
+    # other than small unsigned integers
+    bytes_per_voxel = 2 * image.dtype.itemsize + 16
+    voxels = max_bytes // bytes_per_voxel // int(np.prod(image.shape[2:]))
+    side = int(np.sqrt(voxels))
+    if side < 1:
+        raise ValueError(
+            '%d bytes are too few for tiles of an image of shape %s'
+            % (max_bytes, image.shape)
+        )
+    tile = min(side, image.shape[0]), min(side, image.shape[1])
+
+    pooled = None
+    for core, _ in tiles(image.shape, tile, (0, 0)):
+        values = histogram_percentile.histogram(masked(
+            image[core], None if mask is None else mask[core[:2]],
+            background
+        ))
+        pooled = values if pooled is None else histogram_percentile.pool(
+            [pooled, values]
+        )
+    lower, upper = histogram_percentile.percentiles(
+        pooled[0], pooled[1], [100.0 * img_limes[0], 100.0 * img_limes[1]],
+        method='hazen'
+    )
+    return lower, upper
+
+
+def filtered_foreground(image, op, img_limes, rescale_thr, threshold,
+                        max_bytes, limits=None, mask=None, background=0):
+    '''
+    Voxels of ``filter_image(masked(image, mask, background), ...)`` above
+    ``threshold``, as their flat indices in ``image`` and their filter
+    responses, filtering the image in XY tiles so that no more than
+    ``max_bytes`` are allocated.
+
+    Each tile is masked and filtered together with a halo of the size of
+    ``op``, so the responses in its core are those of the whole image; the
+    halo is then dropped. The image is only read, tile by tile, so it may
+    be a memory-mapped stack (see zstack_store.py). The rescaling limits
+    are those of the whole image (from :func:`masked_quantiles` unless
+    ``limits`` is given).
+    '''
+    if limits is None:
+        limits = rescaling_limits(
+            masked_quantiles(image, img_limes, max_bytes, mask, background),
+            rescale_thr
+        )
+    tile = tile_shape(image.shape, op, max_bytes)
+
+    indices = []
+    values = []
+    for core, outer in tiles(image.shape, tile, op.shape):
+        filtered = filter_image(
+            masked(
+                image[outer], None if mask is None else mask[outer[:2]],
+                background
+            ),
+            op, img_limes, rescale_thr, limits
+        )
+        filtered = filtered[tuple(
+            slice(c.start - o.start, c.stop - o.start)
+            for c, o in zip(core, outer)
+        )]
+        # NaN (of a rescaling between equal limits) sorts above every
+        # threshold in count_objects_series, so it is kept here as well
+        above = np.flatnonzero(~(filtered <= threshold))
+        coordinates = np.unravel_index(above, filtered.shape)
+        indices.append(np.ravel_multi_index(
+            tuple(i + c.start for i, c in zip(coordinates, core)),
+            image.shape
+        ))
+        values.append(filtered.ravel()[above])
+        # release the tile before the next one is filtered
+        filtered = None
+    return np.concatenate(indices), np.concatenate(values)
+
+
+def count_spots_tiled(image, op, thresholds, img_limes, rescale_thr,
+                      max_bytes, limits=None, mask=None, background=0):
+    '''
+    :func:`count_spots` of ``masked(image, mask, background)`` (without
+    hole filling) in no more than ``max_bytes`` besides the image and the
+    voxels above the lowest threshold. Spots across tile borders are
+    counted once, so the counts are those of the whole image.
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+    if len(thresholds) == 0:
+        return np.zeros(0, dtype=np.int64)
+    indices, values = filtered_foreground(
+        image, op, img_limes, rescale_thr, thresholds.min(), max_bytes,
+        limits, mask, background
+    )
+    return count_objects_sparse(image.shape, indices, values, thresholds)
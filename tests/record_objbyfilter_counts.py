@@ -0,0 +1,136 @@
+'''
+Record the spot counts of cpsub.ObjByFilter for the fixture images in
+tests/data, against which test_objbyfilter_fixtures.py checks the python
+backend.
+
+Run on a machine with MATLAB, its Python engine and JtLibrary::
+
+    python tests/record_objbyfilter_counts.py --library_path <JtLibrary>
+
+This calls cpsub.ObjByFilter once per threshold, like the scripts did
+before ObjByFilterSeries.m, and writes objbyfilter_counts.json.
+``--write_images`` regenerates the fixture images first.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COUNTS_FILE = os.path.join(DATA_DIR, 'objbyfilter_counts.json')
+
+IMG_LIMES = [0.01, 0.995]
+RESCALE_THR = [0.0, 200.0, 1000.0, 4000.0]
+
+THRESHOLDS = [0.0, 0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.15, 0.2]
+
+# name: (image, arguments of cpsub.fspecialCP3D, close holes)
+CASES = {
+    '2D': ('spots_2d', ('2D LoG', 6.0), False),
+    '2D_close_holes': ('spots_2d', ('2D LoG', 6.0), True),
+    '3D': ('spots_3d', ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0), False),
+    '3D_close_holes': ('spots_3d', ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0), True),
+}
+
+
+def image_path(name):
+    return os.path.join(DATA_DIR, 'objbyfilter_%s.npy' % name)
+
+
+def make_images():
+    '''
+    Poisson background with Gaussian spots, and a ring (2D) or a shell (3D)
+    around a spot, whose count depends on hole filling
+    '''
+    images = dict()
+    for name, shape in [('spots_2d', (64, 64)), ('spots_3d', (40, 40, 16))]:
+        random = np.random.RandomState(7)
+        grid = np.indices(shape).astype(np.float64)
+        image = random.poisson(100, size=shape).astype(np.float64)
+        for _ in range(12):
+            centre = [random.uniform(0, n) for n in shape]
+            distance2 = sum((g - c) ** 2 for g, c in zip(grid, centre))
+            image += random.uniform(500, 3000) * np.exp(-distance2 / 4.0)
+        # z-planes are further apart than pixels
+        centre = [20.0, 20.0, 7.5][:len(shape)]
+        scale = [1.0, 1.0, 2.0][:len(shape)]
+        radius = np.sqrt(sum(
+            ((g - c) * s) ** 2 for g, c, s in zip(grid, centre, scale)
+        ))
+        image += 2500 * np.exp(-(radius - 9.0) ** 2 / 2.0)
+        image += 2500 * np.exp(-radius ** 2 / 2.0)
+        images[name] = np.clip(image, 0, 65535).astype(np.uint16)
+    return images
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='record_objbyfilter_counts',
+        description=('Records the spot counts of cpsub.ObjByFilter for the '
+                     'fixture images of the tests.')
+    )
+    parser.add_argument(
+        '--library_path', type=str,
+        default='~/repositories/JtLibrary/matlab/jtlibrary/',
+        help='JtLibrary directory added to the MATLAB path'
+    )
+    parser.add_argument(
+        '--write_images', action='store_true',
+        help='regenerate the fixture images before recording'
+    )
+    return(parser.parse_args())
+
+
+def main(args):
+    if args.write_images:
+        for name, image in make_images().items():
+            np.save(image_path(name), image)
+
+    import matlab
+    import matlab.engine
+
+    sys.path.insert(0, ROOT_DIR)
+    import matlab_transfer
+
+    eng = matlab.engine.start_matlab()
+    eng.addpath(os.path.expanduser(args.library_path), nargout=0)
+    eng.workspace['iImgLimes'] = matlab.double(IMG_LIMES)
+    eng.workspace['iRescaleThr'] = matlab.double(RESCALE_THR)
+
+    counts = dict()
+    for case, (name, filter_args, close_holes) in sorted(CASES.items()):
+        matlab_transfer.put_array(eng, 'image', np.load(image_path(name)))
+        eng.eval('op = cpsub.fspecialCP3D({0});'.format(', '.join(
+            "'%s'" % a if isinstance(a, str) else repr(float(a))
+            for a in filter_args
+        )), nargout=0)
+        counts[case] = []
+        for threshold in THRESHOLDS:
+            eng.workspace['threshold'] = float(threshold)
+            eng.eval(
+                'n = cpsub.ObjByFilter(double(image), op, threshold, '
+                'iImgLimes, iRescaleThr, [], {0}, [], []);'.format(
+                    'true' if close_holes else 'false'
+                ),
+                nargout=0
+            )
+            counts[case].append(int(eng.workspace['n']))
+        print(case, counts[case])
+
+    with open(COUNTS_FILE, 'w') as f:
+        json.dump({
+            'matlab': eng.version(),
+            'library_path': args.library_path,
+            'thresholds': THRESHOLDS,
+            'counts': counts
+        }, f, indent=2, sort_keys=True)
+    eng.quit()
+
+
+if __name__ == '__main__':
+    main(parse_arguments())
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import histogram_percentile
+
+
+Q = [0, 0.1, 1, 2.5, 25, 50, 63.7, 99, 99.5, 99.99, 100]
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.int32])
+def test_percentiles_equal_np_percentile(dtype):
+    random = np.random.RandomState(0)
+    info = np.iinfo(dtype)
+    image = random.randint(
+        max(info.min, -5000), min(info.max, 60000), size=(37, 53)
+    ).astype(dtype)
+    offset, counts = histogram_percentile.histogram(image)
+    assert np.array_equal(
+        histogram_percentile.percentiles(offset, counts, Q),
+        np.percentile(image, Q)
+    )
+    assert histogram_percentile.percentiles(offset, counts, 50.0) == \
+        np.percentile(image, 50.0)
+
+
+def test_pooled_percentiles_are_those_of_all_pixels():
+    random = np.random.RandomState(1)
+    images = [
+        random.poisson(lam, size=(20, 30)).astype(np.uint16)
+        for lam in [5, 300, 2000]
+    ]
+    offset, counts = histogram_percentile.pool(
+        histogram_percentile.histogram(image) for image in images
+    )
+    assert np.array_equal(
+        histogram_percentile.percentiles(offset, counts, Q),
+        np.percentile(np.concatenate([i.ravel() for i in images]), Q)
+    )
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 1000])
+def test_hazen_percentiles_equal_np_percentile(size):
+    image = np.random.RandomState(size).randint(0, 500, size=size)
+    offset, counts = histogram_percentile.histogram(image.astype(np.uint16))
+    assert np.allclose(
+        histogram_percentile.percentiles(offset, counts, Q, method='hazen'),
+        np.percentile(image, Q, method='hazen')
+    )
+
+
+def test_invalid_input():
+    with pytest.raises(TypeError):
+        histogram_percentile.histogram(np.zeros(3, dtype=np.float32))
+    with pytest.raises(ValueError):
+        histogram_percentile.histogram(np.zeros(0, dtype=np.uint16))
+    with pytest.raises(ValueError):
+        histogram_percentile.percentiles(0, np.ones(3), [101])
+    with pytest.raises(ValueError):
+        histogram_percentile.percentiles(0, np.ones(3), [50], method='nearest')
@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import image_cache
+from image_cache import ArrayCache
+
+
+def _array(seed, size=4096):
+    # random bytes, so that every file has about the same compressed size
+    return np.random.RandomState(seed).randint(0, 256, size, dtype=np.uint8)
+
+
+def _files(directory):
+    return sorted(
+        os.path.join(root, filename)
+        for root, _, filenames in os.walk(directory)
+        for filename in filenames if filename.endswith('.npz')
+    )
+
+
+def _total(directory):
+    return sum(os.path.getsize(path) for path in _files(directory))
+
+
+def _age(cache, key, mtime):
+    os.utime(cache._path(key), (mtime, mtime))
+
+
+def test_round_trip(tmp_path):
+    cache = ArrayCache(str(tmp_path))
+    assert cache.get('missing') is None
+    cache.put(('site', 1), _array(0))
+    assert np.array_equal(cache.get(('site', 1)), _array(0))
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    directory = str(tmp_path)
+    cache = ArrayCache(directory, max_bytes=None)
+    cache.put('probe', _array(0))
+    size = _total(directory)
+
+    # room for five files before and four after an eviction
+    cache = ArrayCache(directory, max_bytes=int(5.5 * size))
+    for mtime, key in enumerate(['a', 'b', 'c', 'd'], start=1000):
+        cache.put(key, _array(ord(key)))
+        _age(cache, key, mtime)
+    _age(cache, 'probe', 999)
+    assert cache.get('a') is not None  # now the most recently used
+
+    cache.put('e', _array(5))
+    assert [cache.get(key) is None for key in ['probe', 'a', 'b', 'c']] == \
+        [True, False, True, False]
+    assert cache.get('e') is not None
+    assert cache.size() == _total(directory) <= \
+        image_cache.EVICTION_TARGET * cache.max_bytes
+
+
+def test_puts_below_the_cap_do_not_scan_the_cache(tmp_path, monkeypatch):
+    cache = ArrayCache(str(tmp_path), max_bytes=image_cache.GB)
+    cache.put('first', _array(0))
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, '_scan', lambda: scans.append(1) or scan())
+    for seed in range(20):
+        cache.put(seed, _array(seed))
+    # replacing a file counts it once
+    cache.put(0, _array(0))
+    assert scans == []
+    assert cache.size() == _total(str(tmp_path))
+
+
+def test_size_is_recounted_without_a_counter(tmp_path):
+    cache = ArrayCache(str(tmp_path), max_bytes=image_cache.GB)
+    for seed in range(3):
+        cache.put(seed, _array(seed))
+    os.remove(os.path.join(str(tmp_path), '.size'))
+    assert cache.size() == _total(str(tmp_path))
+
+
+def _put_many(directory, max_bytes, worker, count):
+    cache = ArrayCache(directory, max_bytes)
+    for i in range(count):
+        # every worker also puts the keys shared by all of them
+        cache.put((worker, i), _array(100 * worker + i))
+        cache.put(('shared', i), _array(i))
+
+
+@pytest.mark.parametrize('max_bytes', [None, 40000])
+def test_concurrent_puts(tmp_path, max_bytes):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=_put_many, args=(directory, max_bytes, w, 15))
+        for w in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * 4
+
+    cache = ArrayCache(directory, max_bytes)
+    stored = [
+        (w, i) for w in list(range(4)) + ['shared'] for i in range(15)
+        if cache.get((w, i)) is not None
+    ]
+    for w, i in stored:
+        seed = i if w == 'shared' else 100 * w + i
+        assert np.array_equal(cache.get((w, i)), _array(seed))
+    assert not [path for path in os.listdir(directory) if '.tmp' in path]
+    if max_bytes is None:
+        assert len(stored) == 75
+    else:
+        assert 0 < len(stored) < 75
+        assert cache.size() == _total(directory) <= max_bytes
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import intermediates
+
+
+def _frame():
+    return pd.DataFrame({
+        'well': ['D05', 'D05', 'E05'],
+        'site_x': np.array([0, 1, 0], dtype=np.int64),
+        'threshold': np.array([0.02, 0.03, 0.04], dtype=np.float64),
+        'count': np.array([7, 3, 0], dtype=np.int32),
+        'corrected': [True, False, True]
+    }, columns=['well', 'site_x', 'threshold', 'count', 'corrected'])
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / ('sites' + intermediates.EXTENSION))
+    intermediates.write_table(_frame(), path)
+    return path
+
+
+def test_round_trip(path):
+    pd.testing.assert_frame_equal(intermediates.read_table(path), _frame())
+    assert intermediates.read_schema(path).names == list(_frame().columns)
+
+
+@pytest.mark.parametrize('columns', [
+    ['count'], ['threshold', 'well'], ['corrected', 'site_x', 'count'], []
+])
+def test_read_only_some_columns(path, columns):
+    frame = intermediates.read_table(path, columns)
+    assert list(frame.columns) == columns
+    pd.testing.assert_frame_equal(frame, _frame()[columns])
+    table = intermediates.read_arrow(path, columns)
+    assert table.column_names == columns
+    assert table.num_rows == 3
+
+
+def test_read_unknown_column(path):
+    with pytest.raises(KeyError):
+        intermediates.read_table(path, ['well', 'spots'])
+
+
+def test_read_columns_of_an_indexed_table(tmp_path):
+    path = str(tmp_path / 'indexed.arrow')
+    indexed = _frame().set_index(['well', 'site_x'])
+    intermediates.write_table(indexed, path)
+    pd.testing.assert_frame_equal(
+        intermediates.read_table(path, ['count']), indexed[['count']]
+    )
+    # the index columns are read for the index only
+    assert intermediates.read_arrow(path, ['count']).column_names == ['count']
+
+
+def test_read_columns_of_an_empty_table(tmp_path):
+    path = str(tmp_path / 'empty.arrow')
+    intermediates.write_table(_frame().iloc[:0], path)
+    frame = intermediates.read_table(path, ['threshold', 'count'])
+    assert len(frame) == 0
+    assert frame.dtypes.tolist() == [np.float64, np.int32]
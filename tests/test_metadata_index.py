@@ -0,0 +1,13 @@
+import importlib
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize('module', ['metadata_index', 'plan_sites'])
+def test_import_without_tmclient(module, monkeypatch):
+    # the site selection stage of benchmarks/stages.py runs without tmclient
+    monkeypatch.setitem(sys.modules, 'tmclient', None)
+    monkeypatch.delitem(sys.modules, 'metadata_index', raising=False)
+    monkeypatch.delitem(sys.modules, module, raising=False)
+    importlib.import_module(module)
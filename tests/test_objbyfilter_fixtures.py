@@ -0,0 +1,39 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import spot_detection
+from record_objbyfilter_counts import (
+    CASES, COUNTS_FILE, IMG_LIMES, RESCALE_THR, THRESHOLDS, image_path,
+    make_images
+)
+
+
+def _recorded():
+    if not os.path.exists(COUNTS_FILE):
+        pytest.skip(
+            'no counts recorded from MATLAB yet; run '
+            'tests/record_objbyfilter_counts.py where MATLAB and JtLibrary '
+            'are installed'
+        )
+    with open(COUNTS_FILE) as f:
+        recorded = json.load(f)
+    assert recorded['thresholds'] == THRESHOLDS
+    return recorded['counts']
+
+
+@pytest.mark.parametrize('name', sorted(set(c[0] for c in CASES.values())))
+def test_fixture_images_are_reproducible(name):
+    assert np.array_equal(np.load(image_path(name)), make_images()[name])
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_counts_equal_matlab_objbyfilter(case):
+    counts = _recorded()
+    name, filter_args, close_holes = CASES[case]
+    assert spot_detection.count_spots(
+        np.load(image_path(name)), spot_detection.fspecial_cp3d(*filter_args),
+        THRESHOLDS, IMG_LIMES, RESCALE_THR, close_holes
+    ).tolist() == counts[case]
@@ -0,0 +1,97 @@
+'''
+Every GC3Pie Application runs its script on a worker that only has the
+files listed in its inputs, so those must include every module of the
+repository that the script imports, directly or through other modules.
+'''
+import ast
+import os
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PIPELINES = ['optimise_spot_detection.py', 'optimise_spot_detection_3D.py']
+
+
+def parse(filename):
+    with open(os.path.join(ROOT, filename)) as f:
+        return ast.parse(f.read(), filename)
+
+
+def local_imports(filename, seen=None):
+    '''Modules of the repository imported by ``filename``, recursively'''
+    if seen is None:
+        seen = set()
+    for node in ast.walk(parse(filename)):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = name.split('.')[0] + '.py'
+            if module not in seen and os.path.isfile(
+                    os.path.join(ROOT, module)):
+                seen.add(module)
+                local_imports(module, seen)
+    return seen
+
+
+def strings(node):
+    return set(
+        child.value for child in ast.walk(node)
+        if isinstance(child, ast.Constant) and isinstance(child.value, str)
+    )
+
+
+def applications():
+    '''(pipeline, class, script, inputs) of every Application'''
+    for pipeline in PIPELINES:
+        for cls in parse(pipeline).body:
+            if not isinstance(cls, ast.ClassDef) or not any(
+                    getattr(base, 'id', None) == 'Application'
+                    for base in cls.bases):
+                continue
+            init = next(
+                node for node in cls.body
+                if isinstance(node, ast.FunctionDef)
+                and node.name == '__init__'
+            )
+            call = next(
+                node for node in ast.walk(init)
+                if isinstance(node, ast.Call)
+                and getattr(node.func, 'attr', None) == '__init__'
+            )
+            keywords = dict((kw.arg, kw.value) for kw in call.keywords)
+            scripts = [
+                value for value in strings(keywords['arguments'])
+                if value.endswith('.py')
+            ]
+            inputs = strings(keywords['inputs'])
+            # lists of inputs assembled in variables before the call
+            names = set(
+                node.id for node in ast.walk(keywords['inputs'])
+                if isinstance(node, ast.Name)
+            )
+            for node in ast.walk(init):
+                if isinstance(node, ast.Assign) and any(
+                        getattr(target, 'id', None) in names
+                        for target in node.targets):
+                    inputs |= strings(node.value)
+                elif isinstance(node, ast.Call) and getattr(
+                        getattr(node.func, 'value', None), 'id',
+                        None) in names:
+                    inputs |= strings(node)
+            for script in scripts:
+                yield pipeline, cls.name, script, inputs
+
+
+@pytest.mark.parametrize('script, inputs', [
+    pytest.param(script, inputs, id='%s:%s' % (pipeline, name))
+    for pipeline, name, script, inputs in applications()
+])
+def test_inputs_cover_local_imports(script, inputs):
+    required = local_imports(script) | set([script])
+    assert sorted(required - inputs) == []
@@ -0,0 +1,124 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import intermediates
+import metadata_index
+import plan_sites
+
+
+NEGATIVE = ['B02', 'B03', 'C02']
+
+POSITIVE = ['D05', 'D06', 'E05']
+
+
+def _sites(sites_per_well=12, plates=('plate01', 'plate02')):
+    # every site of a few wells of two plates; the sites of D06 are larger
+    rows = []
+    for plate in plates:
+        for well in NEGATIVE + POSITIVE + ['F10']:
+            for i in range(sites_per_well):
+                rows.append({
+                    'plate': plate, 'well': well,
+                    'site_y': i // 4, 'site_x': i % 4,
+                    'height': 2160 if well == 'D06' else 1080,
+                    'width': 2560
+                })
+    return pd.DataFrame(rows)
+
+
+def _controls():
+    return pd.concat([
+        pd.DataFrame({'control': 'negative', 'well': NEGATIVE}),
+        pd.DataFrame({'control': 'positive', 'well': POSITIVE})
+    ], ignore_index=True)
+
+
+def _site_ids(plan):
+    return list(zip(plan.well, plan.site_y, plan.site_x))
+
+
+def test_selection_is_reproducible_with_the_seed():
+    first = plan_sites.select_sites(_sites(), 'plate01', _controls(), 5, 7)
+    again = plan_sites.select_sites(_sites(), 'plate01', _controls(), 5, 7)
+    other = plan_sites.select_sites(_sites(), 'plate01', _controls(), 5, 8)
+    pd.testing.assert_frame_equal(first, again)
+    assert _site_ids(first) != _site_ids(other)
+    # the row order of the metadata index does not matter
+    shuffled = _sites().sample(frac=1.0, random_state=0)
+    pd.testing.assert_frame_equal(
+        first,
+        plan_sites.select_sites(shuffled, 'plate01', _controls(), 5, 7)
+    )
+
+
+@pytest.mark.parametrize('n_per_well', [1, 5, 12, 20])
+def test_selection_has_no_duplicate_sites(n_per_well):
+    plan = plan_sites.select_sites(
+        _sites(), 'plate01', _controls(), n_per_well, 0
+    )
+    assert len(set(_site_ids(plan))) == len(plan)
+    # up to n_per_well sites of every control well, none of others
+    assert plan.groupby('well').size().to_dict() == {
+        well: min(n_per_well, 12) for well in NEGATIVE + POSITIVE
+    }
+    assert set(plan.control[plan.well.isin(NEGATIVE)]) == {'negative'}
+    assert set(plan.control[plan.well.isin(POSITIVE)]) == {'positive'}
+    # consecutive sites come from different wells
+    assert (plan.well.values[1:] != plan.well.values[:-1]).all()
+
+
+def _balance(plan, column):
+    # smallest and largest number of sites of each value of ``column`` in
+    # any batch
+    counts = pd.crosstab(plan[column], plan.batch)
+    return counts.min(axis=1), counts.max(axis=1)
+
+
+@pytest.mark.parametrize('n_batches', [2, 3, 4, 7])
+def test_batches_are_balanced_per_well_and_control(n_batches):
+    plan = plan_sites.select_sites(_sites(), 'plate01', _controls(), 12, 3)
+    plan['batch'] = plan_sites.assign_batches(
+        plan.cost.values, plan.well.values, n_batches, plan.control.values
+    )
+    assert sorted(plan.batch.unique()) == list(range(n_batches))
+    for column in ['well', 'control']:
+        lowest, highest = _balance(plan, column)
+        assert (highest - lowest <= 1).all(), column
+
+    # the costs of the batches differ by no more than the largest site
+    loads = plan.groupby('batch').cost.sum()
+    assert loads.max() - loads.min() <= plan.cost.max()
+
+
+def test_main_writes_disjoint_batches(tmp_path):
+    index = tmp_path / 'metadata_index'
+    index.mkdir()
+    intermediates.write_table(
+        _sites(), str(index / metadata_index.SITES_FILENAME)
+    )
+    output = tmp_path / 'plan'
+    output.mkdir()
+    plan_sites.main(argparse.Namespace(
+        metadata_index=str(index), plate='plate02',
+        negative_wells=NEGATIVE, positive_wells=POSITIVE,
+        n_sites=2, n_batches=3, seed=1, output_dir=str(output),
+        site_queue=None
+    ))
+
+    plan = intermediates.read_table(str(output / plan_sites.PLAN_FILENAME))
+    batches = [
+        intermediates.read_table(
+            str(output / plan_sites.batch_filename(batch_id))
+        )
+        for batch_id in range(3)
+    ]
+    sites = [site for batch in batches for site in _site_ids(batch)]
+    assert sorted(sites) == sorted(_site_ids(plan))
+    assert len(set(sites)) == len(sites) == 6 * 2 * 3
+    assert [len(batch) for batch in batches] == [12, 12, 12]
+    assert np.array_equal(
+        np.unique(plan.well), sorted(NEGATIVE + POSITIVE)
+    )
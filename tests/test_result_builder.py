@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from result_builder import ResultBuilder
+
+
+COLUMNS = [
+    ('well', object),
+    ('site_x', np.int64),
+    ('threshold', np.float64),
+    ('count', np.int32),
+    ('corrected', bool)
+]
+
+
+def _check_dtypes(frame):
+    assert list(frame.columns) == [name for name, _ in COLUMNS]
+    for name, dtype in COLUMNS:
+        if dtype is object:
+            # pandas 3 infers its string dtype for strings
+            assert pd.api.types.is_string_dtype(frame[name]), name
+        else:
+            assert frame[name].dtype == np.dtype(dtype), name
+
+
+@pytest.mark.parametrize('capacity', [1, 3, 1024])
+def test_append_keeps_the_column_dtypes(capacity):
+    table = ResultBuilder(COLUMNS, capacity=capacity)
+    for i in range(10):
+        # values of other types are cast to the column dtype
+        table.append(
+            well='D%02d' % i, site_x=np.int8(i), threshold=i,
+            count=float(2 * i), corrected=i % 2
+        )
+    frame = table.to_frame()
+    _check_dtypes(frame)
+    assert len(table) == len(frame) == 10
+    assert frame.well.tolist() == ['D%02d' % i for i in range(10)]
+    assert frame.threshold.tolist() == [float(i) for i in range(10)]
+    assert frame['count'].tolist() == [2 * i for i in range(10)]
+    assert frame.corrected.tolist() == [bool(i % 2) for i in range(10)]
+
+
+@pytest.mark.parametrize('capacity', [1, 4, 1024])
+def test_extend_keeps_the_column_dtypes(capacity):
+    table = ResultBuilder(COLUMNS, capacity=capacity)
+    thresholds = np.linspace(0.01, 0.05, 5, dtype=np.float32)
+    for i, well in enumerate(['D05', 'E05']):
+        # scalars are shared by all rows
+        table.extend(
+            well=well, site_x=i, threshold=thresholds,
+            count=np.arange(5, dtype=np.int64)[::-1], corrected=True
+        )
+    frame = table.to_frame()
+    _check_dtypes(frame)
+    assert frame.well.tolist() == ['D05'] * 5 + ['E05'] * 5
+    assert frame.site_x.tolist() == [0] * 5 + [1] * 5
+    assert np.array_equal(frame.threshold, np.tile(thresholds, 2))
+    assert frame['count'].tolist() == [4, 3, 2, 1, 0] * 2
+    assert frame.corrected.all()
+
+
+def test_extend_with_scalars_and_no_rows():
+    table = ResultBuilder(COLUMNS)
+    table.extend(well='D05', site_x=1, threshold=0.02, count=3,
+                 corrected=False)
+    table.extend(well=[], site_x=[], threshold=[], count=[], corrected=[])
+    frame = table.to_frame()
+    _check_dtypes(frame)
+    assert frame.values.tolist() == [['D05', 1, 0.02, 3, False]]
+
+
+def test_empty_table_has_the_column_dtypes():
+    frame = ResultBuilder(COLUMNS).to_frame()
+    assert len(frame) == 0
+    _check_dtypes(frame)
+
+
+def test_object_columns_hold_a_value_per_row():
+    table = ResultBuilder([('site', np.int64), ('counts', object)])
+    table.append(site=0, counts=np.array([3, 2, 0]))
+    table.append(site=1, counts=[1])
+    frame = table.to_frame()
+    assert frame.counts[0].tolist() == [3, 2, 0]
+    assert frame.counts[1] == [1]
+
+
+def test_frames_do_not_change_with_later_rows():
+    table = ResultBuilder([('count', np.int64)], capacity=4)
+    table.extend(count=[1, 2])
+    frame = table.to_frame()
+    table.extend(count=[3, 4])
+    frame.loc[0, 'count'] = 10
+    assert frame['count'].tolist() == [10, 2]
+    assert table.to_frame()['count'].tolist() == [1, 2, 3, 4]
+
+
+def test_invalid_rows():
+    table = ResultBuilder(COLUMNS)
+    with pytest.raises(ValueError, match='expected values for columns'):
+        table.append(well='D05', site_x=0, threshold=0.02, count=1)
+    with pytest.raises(ValueError, match='different lengths'):
+        table.extend(well='D05', site_x=[0, 1], threshold=[0.02],
+                     count=1, corrected=True)
+    assert len(table) == 0
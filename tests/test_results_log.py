@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import results_log
+
+
+PARAMETERS = dict(
+    filter=('2D LoG', 6.0),
+    img_limes=[0.01, 0.995],
+    rescale_thr=[100.0, 120.0, 400.0, 500.0]
+)
+
+
+def _log_site(log, well, thresholds, counts):
+    log.append(
+        well=well, site_x=0, site_y=0,
+        threshold=np.asarray(thresholds), spot_count=np.asarray(counts)
+    )
+
+
+def test_restart_after_a_truncated_line(tmp_path):
+    path = str(tmp_path / 'spot_count_000.log')
+    log = results_log.ResultsLog(path, PARAMETERS)
+    _log_site(log, 'A01', [0.02, 0.03], [12, 5])
+    _log_site(log, 'A02', [0.02, 0.03], [8, 1])
+    log.close()
+    # killed while writing the third site
+    with open(path, 'ab') as f:
+        f.write(b'{"site_x": 0, "site_y": 0, "spot_co')
+
+    log = results_log.ResultsLog(path, PARAMETERS)
+    assert [r['well'] for r in log.records()] == ['A01', 'A02']
+    done = log.done(['well', 'site_x', 'site_y'], 'threshold')
+    assert done[('A01', 0, 0)] == {0.02, 0.03}
+    assert results_log.remaining(
+        done, ('A03', 0, 0), np.array([0.02, 0.03])
+    ).tolist() == [0.02, 0.03]
+    _log_site(log, 'A03', [0.02, 0.03], [3, 0])
+    log.close()
+
+    log = results_log.ResultsLog(path, PARAMETERS)
+    assert [r['well'] for r in log.records()] == ['A01', 'A02', 'A03']
+    log.close()
+
+
+def test_truncated_header_starts_a_new_log(tmp_path):
+    path = str(tmp_path / 'spot_count_000.log')
+    with open(path, 'wb') as f:
+        f.write(b'{"_parameters": {"filt')
+    log = results_log.ResultsLog(path, PARAMETERS)
+    _log_site(log, 'A01', [0.02], [4])
+    log.close()
+    assert len(results_log.ResultsLog(path, PARAMETERS)) == 1
+
+
+def test_rerun_with_other_parameters_is_refused(tmp_path):
+    path = str(tmp_path / 'spot_count_000.log')
+    log = results_log.ResultsLog(path, PARAMETERS)
+    _log_site(log, 'A01', [0.02, 0.03], [12, 5])
+    log.close()
+
+    changed = dict(PARAMETERS, rescale_thr=[100.0, 120.0, 400.0, 600.0])
+    with pytest.raises(ValueError, match='other parameters'):
+        results_log.ResultsLog(path, changed)
+    # the same parameters, given as other types, are accepted
+    same = dict(PARAMETERS, img_limes=(0.01, 0.995))
+    assert len(results_log.ResultsLog(path, same)) == 1
+
+
+def test_select_keeps_the_thresholds_of_this_run(tmp_path):
+    log = results_log.ResultsLog(str(tmp_path / 'a.log'), PARAMETERS)
+    _log_site(log, 'A01', [0.01, 0.02, 0.03], [20, 12, 5])
+    _log_site(log, 'A02', [0.05], [0])
+    selected = list(results_log.select(
+        log.records(), 'threshold', np.array([0.02, 0.03, 0.04])
+    ))
+    assert len(selected) == 1
+    assert selected[0]['well'] == 'A01'
+    assert selected[0]['threshold'].tolist() == [0.02, 0.03]
+    assert selected[0]['spot_count'].tolist() == [12, 5]
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import search_thresholds
+from search_thresholds import (
+    choose, pilot_sites, relative_slope, search, sweep_range
+)
+
+
+def _counting(positive, negative=lambda t: np.zeros(len(t))):
+    # count() of search(), remembering the thresholds of each call
+    calls = []
+
+    def count(thresholds):
+        calls.append(list(thresholds))
+        return negative(thresholds), positive(thresholds)
+
+    return count, calls
+
+
+def _plateau(centre, curvature=1e5, level=50.0):
+    # positive counts that are flattest at ``centre``
+    return lambda t: level + curvature * (np.asarray(t) - centre) ** 2
+
+
+def test_relative_slope():
+    thresholds = [0.01, 0.02, 0.03, 0.04]
+    assert np.allclose(relative_slope(thresholds, [40, 40, 40, 40]), 0.0)
+    assert np.allclose(
+        relative_slope(thresholds, [80, 40, 20, 10]),
+        [4000 / 80, 3000 / 40, 1500 / 20, 1000 / 10]
+    )
+    # no spots: no plateau
+    assert relative_slope(thresholds, [9, 3, 0, 0]).tolist()[2:] == \
+        [np.inf, np.inf]
+    assert relative_slope([0.02], [5]).tolist() == [0.0]
+    assert relative_slope([0.02], [0]).tolist() == [np.inf]
+
+
+def test_choose_the_plateau_of_the_separated_thresholds():
+    thresholds = [0.01, 0.02, 0.03, 0.04, 0.05]
+    positive = [100, 100, 60, 50, 20]
+    # flattest at the lowest thresholds, but the negative control has as
+    # many spots there
+    negative = [100, 90, 2, 1, 0]
+    assert choose(thresholds, negative, positive) == 3
+    # the best separation reached, if it is below min_separation
+    assert choose(thresholds, negative, positive, min_separation=1.1) == 4
+    assert choose(thresholds, [0] * 5, [0] * 5) == 0
+
+
+def test_search_finds_the_plateau():
+    count, calls = _counting(_plateau(0.033))
+    chosen, (lower, upper), tried = search(
+        count, 0.0, 0.06, 0.01, points=5, tolerance=0.001
+    )
+    assert abs(chosen - 0.033) <= 0.001
+    assert lower <= chosen <= upper
+    assert chosen in tried
+    # every threshold is counted once
+    counted = [t for thresholds in calls for t in thresholds]
+    assert len(counted) == len(set(counted)) == len(tried)
+
+
+def test_search_at_the_edge_of_the_range():
+    # the positive counts are flattest at the end of the coarse grid
+    count, _ = _counting(_plateau(0.08, curvature=100.0))
+    chosen, (lower, upper), tried = search(count, 0.0, 0.05, 0.01)
+    assert chosen == upper == max(tried)
+    assert lower < upper
+    assert np.isclose(chosen, 0.04)
+
+
+def test_search_converges():
+    count, calls = _counting(_plateau(0.0271))
+    chosen, _, _ = search(
+        count, 0.0, 0.06, 0.01, points=5, tolerance=1e-4, max_rounds=50
+    )
+    assert abs(chosen - 0.0271) <= 1e-3
+    # the interval shrinks by half each round
+    assert len(calls) < 20
+
+    count, calls = _counting(_plateau(0.0271))
+    coarse, (lower, upper), _ = search(
+        count, 0.0, 0.06, 0.01, points=5, tolerance=1e-4, max_rounds=0
+    )
+    assert len(calls) == 1
+    assert np.isclose(coarse, 0.03)
+    assert np.allclose([lower, upper], [0.02, 0.04])
+
+
+@pytest.mark.parametrize('lower,upper,points', [
+    (0.02, 0.04, 5), (0.0, 1.0, 2), (0.031, 0.032, 3)
+])
+def test_sweep_range(lower, upper, points):
+    start, end, step = sweep_range(lower, upper, points)
+    assert np.allclose(
+        np.arange(start, end, step), np.linspace(lower, upper, points)
+    )
+
+
+@pytest.mark.parametrize('lower,upper,points', [
+    (0.03, 0.03, 5), (0.0, 0.0, 5), (0.02, 0.04, 1), (0.04, 0.02, 3)
+])
+def test_sweep_range_of_a_single_threshold(lower, upper, points):
+    start, end, step = sweep_range(lower, upper, points)
+    assert np.arange(start, end, step).tolist() == [lower]
+
+
+def _sites(controls):
+    return pd.DataFrame({
+        'control': controls,
+        'well': ['A%02d' % i for i in range(len(controls))],
+        'site_x': 0,
+        'site_y': 0
+    })
+
+
+def test_pilot_sites():
+    sites = _sites(['positive', 'negative', 'positive', 'negative'] * 3)
+    pilot = pilot_sites(sites, 2)
+    assert sorted(pilot['control']) == ['negative'] * 2 + ['positive'] * 2
+    assert pilot['well'].tolist() == ['A00', 'A01', 'A02', 'A03']
+
+
+@pytest.mark.parametrize('controls,n,message', [
+    (['negative', 'positive', 'mock'], 1, 'unknown controls mock'),
+    (['positive', 'positive'], 1, 'no sites of the negative control'),
+    ([], 1, 'no sites of the negative and positive control'),
+    (['negative', 'positive'], 0, 'at least one pilot site'),
+])
+def test_pilot_sites_of_invalid_controls(controls, n, message):
+    with pytest.raises(ValueError, match=message):
+        pilot_sites(_sites(controls), n)
+
+
+def test_tmclient_is_imported_by_main_only():
+    assert not hasattr(search_thresholds, 'TmClient')
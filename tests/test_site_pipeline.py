@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+import site_pipeline
+from site_pipeline import prefetch
+
+
+class _Loads(object):
+    # load() of prefetch that counts the items loaded and not yet consumed
+
+    def __init__(self, delays=None, fail_at=None):
+        self.delays = delays or {}
+        self.fail_at = fail_at
+        self.loaded = []
+        self.held = 0
+        self.most_held = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, item):
+        with self._lock:
+            self.held += 1
+            self.most_held = max(self.most_held, self.held)
+        time.sleep(self.delays.get(item, 0.0))
+        if item == self.fail_at:
+            raise IOError('download of site %d failed' % item)
+        self.loaded.append(item)
+        return 'image %d' % item
+
+    def consumed(self):
+        with self._lock:
+            self.held -= 1
+
+
+def test_items_are_yielded_in_order():
+    # later items load faster than earlier ones
+    loads = _Loads(delays={0: 0.03, 1: 0.02, 2: 0.01, 5: 0.02})
+    results = list(prefetch(loads, range(8), max_in_flight=3))
+    assert results == [(i, 'image %d' % i) for i in range(8)]
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 2, 4])
+def test_loaded_items_are_bounded(max_in_flight):
+    loads = _Loads()
+    for item, data in prefetch(loads, range(20), max_in_flight):
+        # a slow consumer lets the loader run as far ahead as it may
+        time.sleep(0.005)
+        assert data == 'image %d' % item
+        loads.consumed()
+    assert loads.most_held == max_in_flight
+    assert loads.loaded == list(range(20))
+
+
+def test_load_errors_are_raised_in_order():
+    loads = _Loads(fail_at=3)
+    consumed = []
+    with pytest.raises(IOError, match='site 3'):
+        for item, _ in prefetch(loads, range(10), max_in_flight=2):
+            consumed.append(item)
+    assert consumed == [0, 1, 2]
+    # nothing is loaded after the failed item
+    time.sleep(0.05)
+    assert loads.loaded == [0, 1, 2]
+
+
+def test_errors_of_the_items_are_raised():
+    def items():
+        yield 0
+        raise ValueError('no more sites')
+
+    results = prefetch(lambda item: item, items())
+    assert next(results) == (0, 0)
+    with pytest.raises(ValueError, match='no more sites'):
+        next(results)
+
+
+def test_loading_stops_when_the_consumer_quits():
+    loads = _Loads()
+    results = prefetch(loads, range(100), max_in_flight=2)
+    assert next(results)[0] == 0
+    results.close()
+    time.sleep(0.05)
+    # the item being consumed, one ahead and at most one more that was
+    # waiting for a slot
+    assert len(loads.loaded) <= 3
+
+
+def test_max_in_flight():
+    assert site_pipeline.max_in_flight(2) == 3
+    # three items of 100 bytes fit next to the one the consumer holds
+    assert site_pipeline.max_in_flight(5, item_bytes=100, memory=400) == 3
+    assert site_pipeline.max_in_flight(5, item_bytes=100, memory=50) == 1
+    assert site_pipeline.max_in_flight(1, item_bytes=0, memory=50) == 2
+    with pytest.raises(ValueError):
+        next(prefetch(lambda item: item, range(3), max_in_flight=0))
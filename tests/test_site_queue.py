@@ -0,0 +1,46 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import site_queue
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    path = str(tmp_path / 'sites.db')
+    site_queue.create(path, pd.DataFrame({
+        'well': ['A01', 'A01', 'B02'],
+        'site_y': [0, 0, 1],
+        'site_x': [0, 1, 0]
+    }))
+    return path
+
+
+def test_workers_claim_every_site_once(queue_path):
+    first = site_queue.SiteQueue(queue_path, worker='first')
+    second = site_queue.SiteQueue(queue_path, worker='second')
+    claimed = [first.claim(), second.claim(), first.claim()]
+    assert [site_id for site_id, _ in claimed] == [1, 2, 3]
+    assert claimed[2][1]['well'] == 'B02'
+    assert second.claim() is None
+
+    first.complete([1, 2, 3])
+    second.complete([2])
+    assert first.completed() == [1, 3]
+    assert second.completed() == [2]
+
+
+def test_claim_reports_the_lock_it_could_not_get(queue_path):
+    blocker = sqlite3.connect(queue_path, isolation_level=None)
+    blocker.execute('BEGIN IMMEDIATE')
+    try:
+        queue = site_queue.SiteQueue(
+            queue_path, worker='late', lock_timeout=0.5
+        )
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+            queue.claim()
+    finally:
+        blocker.execute('ROLLBACK')
+        blocker.close()
+    assert queue.claim()[0] == 1
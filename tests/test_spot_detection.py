@@ -0,0 +1,201 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import spot_detection
+
+
+IMG_LIMES = [0.01, 0.995]
+RESCALE_THR = [0.0, 200.0, 1000.0, 4000.0]
+
+
+def _spots_image(shape, n_spots, seed):
+    random = np.random.RandomState(seed)
+    image = random.poisson(100, size=shape).astype(np.float64)
+    grid = np.indices(shape)
+    for _ in range(n_spots):
+        centre = [random.uniform(0, n) for n in shape]
+        distance2 = sum((g - c) ** 2 for g, c in zip(grid, centre))
+        image += random.uniform(500, 3000) * np.exp(-distance2 / 4.0)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def _labelled_counts(filtered, thresholds, close_holes=False):
+    structure = np.ones((3,) * filtered.ndim, dtype=bool)
+    counts = []
+    for threshold in thresholds:
+        mask = filtered > threshold
+        if close_holes:
+            mask = ndimage.binary_fill_holes(mask)
+        counts.append(ndimage.label(mask, structure=structure)[1])
+    return counts
+
+
+def test_2d_log_kernel_matches_fspecial():
+    # -fspecial('log', 3, 0.5) and -fspecial('log') (5 x 5, sigma 0.5)
+    # as printed by MATLAB
+    np.testing.assert_allclose(
+        spot_detection.dense_kernel(spot_detection._log_filter((3, 3), 0.5)),
+        -np.array([
+            [0.4038, 0.8021, 0.4038],
+            [0.8021, -4.8233, 0.8021],
+            [0.4038, 0.8021, 0.4038]
+        ]),
+        atol=1e-4
+    )
+    np.testing.assert_allclose(
+        spot_detection.dense_kernel(spot_detection._log_filter((5, 5), 0.5)),
+        -np.array([
+            [0.0448, 0.0468, 0.0564, 0.0468, 0.0448],
+            [0.0468, 0.3167, 0.7146, 0.3167, 0.0468],
+            [0.0564, 0.7146, -4.9048, 0.7146, 0.0564],
+            [0.0468, 0.3167, 0.7146, 0.3167, 0.0468],
+            [0.0448, 0.0468, 0.0564, 0.0468, 0.0448]
+        ]),
+        atol=1e-4
+    )
+
+
+@pytest.mark.parametrize('filter_args', [
+    ('2D LoG', 6.0),
+    ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+])
+def test_log_kernel_is_the_dense_formula(filter_args):
+    op = spot_detection.fspecial_cp3d(*filter_args)
+    if filter_args[0] == '2D LoG':
+        sigma = (filter_args[1] - 1.0) / 3.0
+    else:
+        sigma = filter_args[2]
+    axes = np.meshgrid(
+        *[np.arange(n) - (n - 1.0) / 2.0 for n in op.shape], indexing='ij'
+    )
+    r2 = sum(x ** 2 for x in axes)
+    gaussian = np.exp(-r2 / (2 * sigma ** 2))
+    gaussian /= gaussian.sum()
+    log = gaussian * (r2 - len(op.shape) * sigma ** 2) / sigma ** 4
+    log -= log.mean()
+
+    kernel = spot_detection.dense_kernel(op)
+    assert kernel.shape == op.shape
+    np.testing.assert_allclose(kernel, -log, atol=1e-6)
+    assert abs(kernel.sum()) < 1e-6
+
+
+def test_filter_image_correlates_with_the_kernel():
+    op = spot_detection.fspecial_cp3d('2D LoG', 6.0)
+    image = _spots_image((40, 50), 10, seed=0)
+    rescaled = spot_detection.rescale_image(image, IMG_LIMES, RESCALE_THR)
+    # imfilter centres the even-sized kernel at (n - 1) / 2
+    expected = ndimage.correlate(
+        rescaled.astype(np.float64), spot_detection.dense_kernel(op),
+        mode=spot_detection.BOUNDARY_MODE, origin=-1
+    )
+    np.testing.assert_allclose(
+        spot_detection.filter_image(image, op, IMG_LIMES, RESCALE_THR),
+        expected, atol=1e-4
+    )
+
+
+@pytest.mark.parametrize('close_holes', [False, True])
+@pytest.mark.parametrize('shape, filter_args', [
+    ((64, 64), ('2D LoG', 6.0)),
+    ((32, 32, 6), ('3D LoG, Raj', 5.0, 4.0 / 3, 5.0))
+])
+def test_count_spots_labels_every_threshold(shape, filter_args, close_holes):
+    op = spot_detection.fspecial_cp3d(*filter_args)
+    image = _spots_image(shape, 15, seed=1)
+    filtered = spot_detection.filter_image(image, op, IMG_LIMES, RESCALE_THR)
+    thresholds = np.concatenate([
+        np.linspace(filtered.min(), filtered.max(), 25),
+        [filtered.max() + 1.0]
+    ])[::-1]
+
+    counts = spot_detection.count_spots(
+        image, op, thresholds, IMG_LIMES, RESCALE_THR, close_holes
+    )
+    assert counts.tolist() == _labelled_counts(
+        filtered, thresholds, close_holes
+    )
+    assert counts.max() > 1
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_tiled_counts_are_those_of_the_whole_image(masked):
+    op = spot_detection.fspecial_cp3d('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+    image = _spots_image((70, 60, 5), 30, seed=2)
+    mask = None
+    if masked:
+        mask = np.zeros(image.shape[:2], dtype=bool)
+        mask[10:50, 5:45] = True
+    thresholds = np.linspace(0.0, 0.05, 20)
+
+    expected = spot_detection.count_spots(
+        spot_detection.masked(image, mask, 100), op, thresholds,
+        IMG_LIMES, RESCALE_THR
+    )
+    max_bytes = 100000
+    assert spot_detection.tile_shape(image.shape, op, max_bytes)[0] < 35
+    counts = spot_detection.count_spots_tiled(
+        image, op, thresholds, IMG_LIMES, RESCALE_THR, max_bytes,
+        mask=mask, background=100
+    )
+    assert counts.tolist() == expected.tolist()
+    assert expected.max() > 1
+
+
+def _peak_allocation(function, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _histogram_bytes(image):
+    # the few histograms of the grey values alive at a time
+    return 4 * 8 * (int(image.max()) + 1)
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_masked_quantiles_stay_within_the_budget(masked):
+    image = _spots_image((160, 150, 8), 40, seed=3)
+    mask = None
+    if masked:
+        mask = np.zeros(image.shape[:2], dtype=bool)
+        mask[20:120, 30:140] = True
+    max_bytes = image.nbytes // 8
+
+    quantiles, peak = _peak_allocation(
+        spot_detection.masked_quantiles, image, IMG_LIMES, max_bytes,
+        mask, 115
+    )
+    assert quantiles == spot_detection.image_quantiles(
+        spot_detection.masked(image, mask, 115), IMG_LIMES
+    )
+    assert peak < max_bytes + _histogram_bytes(image)
+
+
+@pytest.mark.parametrize('budget', [0.5, 1, 2])
+def test_tiled_filtering_stays_within_the_budget(budget):
+    op = spot_detection.fspecial_cp3d('3D LoG, Raj', 5.0, 4.0 / 3, 5.0)
+    image = _spots_image((160, 150, 8), 40, seed=3)
+    mask = np.zeros(image.shape[:2], dtype=bool)
+    mask[20:120, 30:140] = True
+    max_bytes = int(budget * image.nbytes)
+
+    # the rescaling limits are computed from the image as well
+    (indices, values), peak = _peak_allocation(
+        spot_detection.filtered_foreground, image, op, IMG_LIMES,
+        RESCALE_THR, 0.05, max_bytes, mask=mask, background=115
+    )
+    filtered = spot_detection.filter_image(
+        spot_detection.masked(image, mask, 115), op, IMG_LIMES, RESCALE_THR
+    )
+    assert sorted(indices.tolist()) == \
+        np.flatnonzero(filtered > 0.05).tolist()
+    # the image is too large to be filtered whole
+    assert spot_detection.FILTER_BYTES_PER_VOXEL * image.size > max_bytes
+    assert peak < max_bytes + _histogram_bytes(image)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import threshold_sweep
+from threshold_sweep import count_objects_series, count_objects_sparse
+
+
+def _labelled_counts(image, thresholds, close_holes=False):
+    structure = np.ones((3,) * image.ndim, dtype=bool)
+    counts = []
+    for threshold in thresholds:
+        mask = image > threshold
+        if close_holes:
+            mask = ndimage.binary_fill_holes(mask)
+        counts.append(ndimage.label(mask, structure=structure)[1])
+    return counts
+
+
+def _smooth_noise(shape, seed):
+    random = np.random.RandomState(seed)
+    return ndimage.gaussian_filter(random.normal(size=shape), 1.5)
+
+
+@pytest.mark.parametrize('close_holes', [False, True])
+@pytest.mark.parametrize('shape', [(50, 70), (20, 25, 6), (1, 40)])
+def test_series_counts_match_labelling(shape, close_holes):
+    image = _smooth_noise(shape, seed=len(shape))
+    # unsorted, with duplicates and thresholds outside the image range
+    thresholds = np.concatenate([
+        np.random.RandomState(0).uniform(image.min(), image.max(), 30),
+        [0.0, 0.0, image.min() - 1.0, image.max(), image.max() + 1.0]
+    ])
+    counts = count_objects_series(image, thresholds, close_holes)
+    assert counts.tolist() == _labelled_counts(image, thresholds, close_holes)
+
+
+def test_ties_with_thresholds_are_background():
+    image = np.array([
+        [1.0, 1.0, 0.0, 2.0],
+        [0.0, 0.0, 0.0, 2.0],
+        [3.0, 0.0, 1.0, 0.0]
+    ])
+    thresholds = [0.0, 1.0, 2.0, 3.0]
+    assert count_objects_series(image, thresholds).tolist() == \
+        _labelled_counts(image, thresholds) == [3, 2, 1, 0]
+
+
+def test_sparse_counts_match_dense_counts():
+    image = _smooth_noise((30, 40, 5), seed=3)
+    thresholds = np.linspace(0.0, image.max(), 15)[::-1]
+    above = np.flatnonzero(image > thresholds.min())
+    counts = count_objects_sparse(
+        image.shape, above, image.ravel()[above], thresholds
+    )
+    assert counts.tolist() == count_objects_series(image, thresholds).tolist()
+    assert counts.tolist() == _labelled_counts(image, thresholds)
+
+
+def test_check_thresholds_catches_wrong_counts(monkeypatch):
+    image = _smooth_noise((30, 30), seed=4)
+    thresholds = np.linspace(image.min(), image.max(), 10)
+    count_objects_series(image, thresholds, check_thresholds=10)
+
+    def off_by_one(levels, n_levels):
+        return np.arange(n_levels) + 1
+
+    monkeypatch.setattr(
+        threshold_sweep, '_count_objects_union_find', off_by_one
+    )
+    with pytest.raises(RuntimeError):
+        count_objects_series(image, thresholds, check_thresholds=2)
@@ -0,0 +1,146 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from site_fetcher import SiteFetcher
+from zstack_store import ZStackStore, stored_fetcher
+
+
+SITE = dict(
+    plate_name='plate01', well_name='D05', well_pos_y=1, well_pos_x=2,
+    channel_name='wavelength-2'
+)
+
+SHAPE = (13, 17, 5)
+
+
+def _stack(shape=SHAPE, seed=0):
+    # values over the whole uint16 range, so that no cast would go unseen
+    random = np.random.RandomState(seed)
+    return random.randint(0, 2 ** 16, size=shape).astype(np.uint16)
+
+
+def _write(store, stack, **site):
+    stored = store.create(shape=stack.shape, **site)
+    stored[...] = stack
+    store.commit(stack=stored, **site)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(tmp_path, compress):
+    store = ZStackStore(str(tmp_path), 'experiment', compress)
+    assert store.get(**SITE) is None
+    _write(store, _stack(), **SITE)
+
+    stack = store.get(**SITE)
+    assert stack.dtype == np.uint16
+    assert stack.shape == SHAPE
+    assert np.array_equal(stack, _stack())
+    # corrected images are stored apart
+    assert store.get(correct=True, **SITE) is None
+
+
+def test_mapped_stacks_are_copy_on_write(tmp_path):
+    store = ZStackStore(str(tmp_path), 'experiment')
+    _write(store, _stack(), **SITE)
+    stack = store.get(**SITE)
+    assert isinstance(stack.base, np.memmap)
+    # each z-plane is one contiguous chunk of the file
+    assert stack[:, :, 3].flags['C_CONTIGUOUS']
+    stack[...] = 0
+    assert np.array_equal(store.get(**SITE), _stack())
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_reopen_a_partially_written_store(tmp_path, compress):
+    store = ZStackStore(str(tmp_path), 'experiment', compress)
+    committed = dict(SITE, well_pos_x=0)
+    _write(store, _stack(seed=1), **committed)
+    # a job that died while filling the stack of a site left it
+    # uncommitted in its temporary file
+    partial = store.create(shape=SHAPE, **SITE)
+    partial[:, :, :2] = _stack()[:, :, :2]
+    path = store._path(correct=False, **SITE)
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    if compress:
+        np.save(temporary, partial)
+        os.rename(temporary + '.npy', temporary)
+    else:
+        partial.base.flush()
+    del partial
+    os.rename(temporary, '%s.%d.tmp' % (path, _dead_pid()))
+    # that of a running job is kept
+    running = '%s.%d.tmp' % (store._path(correct=True, **SITE), os.getppid())
+    open(running, 'w').close()
+
+    reopened = ZStackStore(str(tmp_path), 'experiment', compress)
+    assert sorted(os.listdir(reopened.directory)) == sorted([
+        os.path.basename(store._path(correct=False, **committed)),
+        os.path.basename(running)
+    ])
+    assert reopened.get(**SITE) is None
+    assert np.array_equal(reopened.get(**committed), _stack(seed=1))
+    _write(reopened, _stack(), **SITE)
+    assert np.array_equal(reopened.get(**SITE), _stack())
+
+
+class _Client(object):
+
+    def __init__(self, downloads, fail_at=None):
+        self.downloads = downloads
+        self.fail_at = fail_at
+
+    def download_channel_image(self, channel_name, zplane=0, **site):
+        self.downloads.append((channel_name, zplane))
+        if zplane == self.fail_at:
+            raise IOError('download of z-plane %d failed' % zplane)
+        if channel_name == 'dapi':
+            return np.ones(SHAPE[:2], dtype=np.uint16)
+        return _stack()[:, :, zplane]
+
+
+def _fetch(fetcher):
+    return fetcher.fetch_site(
+        'plate01', 'D05', 1, 2, ['dapi'], 'wavelength-2', SHAPE
+    )
+
+
+def test_stored_fetcher_downloads_each_stack_once(tmp_path):
+    downloads = []
+    fetcher = stored_fetcher(
+        SiteFetcher(lambda: _Client(downloads), max_workers=3),
+        'experiment', str(tmp_path)
+    )
+    try:
+        for _ in range(2):
+            images, stack = _fetch(fetcher)
+            assert np.array_equal(stack, _stack())
+            assert np.array_equal(images['dapi'], np.ones(SHAPE[:2]))
+    finally:
+        fetcher.close()
+    assert sorted(downloads) == sorted(
+        [('dapi', 0)] * 2 + [('wavelength-2', z) for z in range(SHAPE[2])]
+    )
+
+
+def test_stored_fetcher_discards_failed_stacks(tmp_path):
+    fetcher = stored_fetcher(
+        SiteFetcher(lambda: _Client([], fail_at=3), max_workers=1),
+        'experiment', str(tmp_path)
+    )
+    try:
+        with pytest.raises(IOError, match='z-plane 3'):
+            _fetch(fetcher)
+    finally:
+        fetcher.close()
+    directory = os.path.join(str(tmp_path), 'experiment')
+    assert os.listdir(directory) == []
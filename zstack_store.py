@@ -0,0 +1,209 @@
+'''
+Local store of the z-stacks of sites.
+
+The 3D spot count jobs assemble the FISH stack of a site in memory from its
+z-planes. With a store, the planes are written straight into one .npy file
+per site as they are downloaded, each z-plane a contiguous chunk of the
+file. Later runs, and other jobs on the same node, map the file with
+``np.memmap`` instead of downloading and assembling the stack again: only
+the parts of the stack that are used are read from disk, and processes on
+one node share them through the page cache. Stacks are mapped
+copy-on-write, so changes a job makes to its stack are never written back.
+Stacks are written to temporary files and renamed into place once they
+are filled; the temporary files of jobs that died before are removed when
+the store is opened.
+
+With ``compress``, a stack is stored as an .npz archive of compressed
+z-planes instead, which takes less disk space but is read into memory in
+full.
+'''
+import errno
+import os
+
+import numpy as np
+
+
+class ZStackStore(object):
+    '''
+    Stacks of the sites of ``experiment_name`` in ``directory``
+    '''
+
+    def __init__(self, directory, experiment_name, compress=False):
+        self.directory = os.path.join(directory, experiment_name)
+        self.compress = compress
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        _remove_stale_temporaries(self.directory)
+
+    def _path(self, plate_name, well_name, well_pos_y, well_pos_x,
+              channel_name, correct):
+        filename = '{0}_{1}_y{2:03d}_x{3:03d}_{4}{5}{6}'.format(
+            plate_name, well_name, int(well_pos_y), int(well_pos_x),
+            channel_name, '_corrected' if correct else '',
+            '.npz' if self.compress else '.npy'
+        )
+        return os.path.join(self.directory, filename)
+
+    def get(self, plate_name, well_name, well_pos_y, well_pos_x,
+            channel_name, correct=False):
+        '''
+        Return the (height, width, z) stack of the site, mapped
+        copy-on-write unless the store is compressed, or ``None``
+        '''
+        path = self._path(
+            plate_name, well_name, well_pos_y, well_pos_x, channel_name,
+            correct
+        )
+        try:
+            if self.compress:
+                with np.load(path) as archive:
+                    return np.stack([
+                        archive['z%04d' % z]
+                        for z in range(len(archive.files))
+                    ], axis=-1)
+            planes = np.load(path, mmap_mode='c')
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                return None
+            raise
+        return planes.transpose(1, 2, 0)
+
+    def create(self, plate_name, well_name, well_pos_y, well_pos_x,
+               channel_name, shape, correct=False):
+        '''
+        Return an empty (height, width, z) uint16 stack for the site to be
+        filled and passed to :meth:`commit`
+        '''
+        path = self._path(
+            plate_name, well_name, well_pos_y, well_pos_x, channel_name,
+            correct
+        )
+        if self.compress:
+            return np.zeros(shape, dtype=np.uint16)
+        planes = np.lib.format.open_memmap(
+            '%s.%d.tmp' % (path, os.getpid()), mode='w+', dtype=np.uint16,
+            shape=(shape[2], shape[0], shape[1])
+        )
+        return planes.transpose(1, 2, 0)
+
+    def commit(self, plate_name, well_name, well_pos_y, well_pos_x,
+               channel_name, stack, correct=False):
+        '''
+        Store the stack returned by :meth:`create` once it is filled
+        '''
+        path = self._path(
+            plate_name, well_name, well_pos_y, well_pos_x, channel_name,
+            correct
+        )
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        if self.compress:
+            with open(temporary, 'wb') as f:
+                np.savez_compressed(f, **dict(
+                    ('z%04d' % z, stack[:, :, z])
+                    for z in range(stack.shape[2])
+                ))
+        else:
+            stack.base.flush()
+        os.rename(temporary, path)
+
+    def discard(self, plate_name, well_name, well_pos_y, well_pos_x,
+                channel_name, correct=False):
+        '''Remove the file of a stack that could not be filled'''
+        path = self._path(
+            plate_name, well_name, well_pos_y, well_pos_x, channel_name,
+            correct
+        )
+        try:
+            os.remove('%s.%d.tmp' % (path, os.getpid()))
+        except OSError:
+            pass
+
+
+def _remove_stale_temporaries(directory):
+    # temporary files of stacks whose jobs died before the commit; the
+    # store is local to a node, so their process ids are ours
+    for filename in os.listdir(directory):
+        parts = filename.rsplit('.', 2)
+        if len(parts) != 3 or parts[2] != 'tmp' or not parts[1].isdigit():
+            continue
+        try:
+            os.kill(int(parts[1]), 0)
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError:
+                    pass
+
+
+class StoredSiteFetcher(object):
+    '''
+    Wraps a :class:`site_fetcher.SiteFetcher` so that the stacks of
+    ``fetch_site`` are read from a :class:`ZStackStore` when possible and
+    written into it otherwise. All other attributes are those of the
+    wrapped fetcher.
+    '''
+
+    def __init__(self, fetcher, store):
+        self._fetcher = fetcher
+        self._store = store
+
+    def __getattr__(self, name):
+        return getattr(self._fetcher, name)
+
+    def fetch_site(self, plate_name, well_name, well_pos_y, well_pos_x,
+                   channels, stack_channel, stack_shape, correct=False,
+                   stack=None):
+        site = dict(
+            plate_name=plate_name,
+            well_name=well_name,
+            well_pos_y=well_pos_y,
+            well_pos_x=well_pos_x,
+            channel_name=stack_channel,
+            correct=correct
+        )
+        stored = None
+        if stack_channel is not None:
+            stored = self._store.get(**site)
+        if stored is not None and stored.shape == tuple(stack_shape):
+            images, _ = self._fetcher.fetch_site(
+                plate_name, well_name, well_pos_y, well_pos_x, channels,
+                None, stack_shape, correct
+            )
+            return images, stored
+        if stack_channel is None:
+            return self._fetcher.fetch_site(
+                plate_name, well_name, well_pos_y, well_pos_x, channels,
+                stack_channel, stack_shape, correct, stack
+            )
+
+        stack = self._store.create(shape=stack_shape, **site)
+        try:
+            images, stack = self._fetcher.fetch_site(
+                plate_name, well_name, well_pos_y, well_pos_x, channels,
+                stack_channel, stack_shape, correct, stack
+            )
+            self._store.commit(stack=stack, **site)
+        except Exception:
+            self._store.discard(**site)
+            raise
+        if self._store.compress:
+            return images, stack
+        # map the stored stack copy-on-write, like later runs do
+        return images, self._store.get(**site)
+
+
+def stored_fetcher(fetcher, experiment_name, store_dir, compress=False):
+    '''
+    Return ``fetcher`` wrapped in a z-stack store in ``store_dir``, or
+    ``fetcher`` itself if ``store_dir`` is ``None``.
+    '''
+    if store_dir is None:
+        return fetcher
+    return StoredSiteFetcher(
+        fetcher, ZStackStore(store_dir, experiment_name, compress)
+    )